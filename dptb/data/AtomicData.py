@@ -74,6 +74,7 @@ _DEFAULT_EDGE_FIELDS: Set[str] = {
     AtomicDataDict.EDGE_OVERLAP_KEY,
     AtomicDataDict.EDGE_HAMILTONIAN_KEY,
     AtomicDataDict.EDGE_TYPE_KEY,
+    AtomicDataDict.EDGE_ROTATION_KEY,
 }
 
 _DEFAULT_ENV_FIELDS: Set[str] = {
@@ -94,6 +95,7 @@ _DEFAULT_ONSITENV_FIELDS: Set[str] = {
     AtomicDataDict.ONSITENV_EMBEDDING_KEY,
     AtomicDataDict.ONSITENV_FEATURES_KEY,
     AtomicDataDict.ONSITENV_CUTOFF_KEY,
+    AtomicDataDict.ONSITENV_ROTATION_KEY,
 }
 
 _DEFAULT_GRAPH_FIELDS: Set[str] = {
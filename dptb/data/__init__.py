@@ -18,7 +18,7 @@ from .dataset import (
     ABACUSInMemoryDataset,
     DefaultDataset
 )
-from .dataloader import DataLoader, Collater, PartialSampler
+from .dataloader import DataLoader, Collater, PartialSampler, BucketBatchSampler
 from .build import build_dataset
 from .interfaces import block_to_feature, feature_to_block
 from .transforms import OrbitalMapper
@@ -42,6 +42,7 @@ __all__ = [
     DataLoader,
     Collater,
     PartialSampler,
+    BucketBatchSampler,
     OrbitalMapper,
     build_dataset,
     _NODE_FIELDS,
@@ -69,6 +69,10 @@ EDGE_LENGTH_KEY: Final[str] = "edge_lengths"
 ENV_LENGTH_KEY: Final[str] = "env_lengths"
 # A [n_edge] tensor of the lengths of ONSITENV_VECTORS
 ONSITENV_LENGTH_KEY: Final[str] = "onsitenv_lengths"
+# A [n_edge, sum_l (2l+1)^2] tensor of the flattened SK rotation matrices D^l (l = 0..lmax) of EDGE_VECTORS
+EDGE_ROTATION_KEY: Final[str] = "edge_rotation"
+# A [n_edge, sum_l (2l+1)^2] tensor of the flattened SK rotation matrices D^l (l = 0..lmax) of ONSITENV_VECTORS
+ONSITENV_ROTATION_KEY: Final[str] = "onsitenv_rotation"
 # [n_edge, dim] (possibly equivariant) attributes of each edge
 EDGE_ATTRS_KEY: Final[str] = "edge_attrs"
 ENV_ATTRS_KEY: Final[str] = "env_attrs"
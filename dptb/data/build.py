@@ -1,5 +1,6 @@
 import inspect
 import os
+import re
 from copy import deepcopy
 import glob
 from importlib import import_module
@@ -10,9 +11,10 @@ from dptb.data.dataset._hdf5_dataset import HDF5Dataset
 from dptb.data.dataset.lmdb_dataset import LMDBDataset
 from dptb import data
 from dptb.data.transforms import TypeMapper, OrbitalMapper
-from dptb.data import AtomicDataset, register_fields
+from dptb.data import AtomicDataset, AtomicInMemoryDataset, register_fields
 from dptb.utils import instantiate, get_w_prefix
 from dptb.utils.tools import j_loader
+from dptb.utils.constants import anglrMId
 from dptb.utils.argcheck import normalize_setinfo, normalize_lmdbsetinfo
 from dptb.utils.argcheck import collect_cutoffs 
 from dptb.utils.argcheck import get_cutoffs_from_model_options
@@ -130,6 +132,7 @@ class DatasetBuilder:
         get_overlap: bool = False,
         get_DM: bool = False,
         get_eigenvalues: bool = False,
+        cache_geometry: bool = False,
         # common_options
         orthogonal: bool = False,
         basis: str = None, 
@@ -145,6 +148,7 @@ class DatasetBuilder:
             - prefix (str, optional): Load selected trajectory folders with the specified prefix.
             - get_Hamiltonian (bool, optional): Load the Hamiltonian file to edges of the graph or not.
             - get_eigenvalues (bool, optional): Load the eigenvalues to the graph or not.
+            - cache_geometry (bool, optional): Precompute the edge geometry and SK rotation matrices once, for static structures.
             e.g.     
             type = "DefaultDataset",
             root = "foo/bar/data_files_here",
@@ -274,6 +278,14 @@ class DatasetBuilder:
         else:
             raise ValueError(f"Not support dataset type: {type}.")
         
+        if cache_geometry:
+            if not isinstance(dataset, AtomicInMemoryDataset):
+                log.warning(f"The geometry cache is only supported for in-memory datasets, but {dataset_type} is not. Skipping it.")
+            else:
+                assert idp is not None, "The basis should be provided to cache the SK rotation matrices."
+                lmax = max(anglrMId[re.findall(r"[a-z]", orb)[0]] for orb in idp.full_basis)
+                dataset.cache_geometry(lmax=lmax)
+
         if not self.if_check_cutoffs:
             log.warning("The cutoffs in data and model are not checked. be careful!")
 
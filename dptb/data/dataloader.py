@@ -1,9 +1,16 @@
-from typing import List, Optional, Iterator
+from typing import List, Optional, Iterator, Tuple, Dict
+from itertools import accumulate
+import logging
+import re
 
 import torch
 from torch.utils.data import Sampler
 
 from dptb.utils.torch_geometric import Batch, Data, Dataset
+from dptb.data import AtomicDataDict
+from dptb.data.AtomicData import AtomicData
+
+log = logging.getLogger(__name__)
 
 class Collater(object):
     """Collate a list of ``AtomicData``.
@@ -17,6 +24,8 @@ class Collater(object):
         exclude_keys: List[str] = [],
     ):
         self._exclude_keys = set(exclude_keys)
+        # (keys, {key: (cat_dim, is_nested, is_incremented)}) of the last collated data type
+        self._schema = None
 
     @classmethod
     def for_dataset(
@@ -31,9 +40,99 @@ class Collater(object):
 
     def collate(self, batch: List[Data]) -> Batch:
         """Collate a list of data"""
+        schema = self._get_schema(batch)
+        if schema is not None:
+            return self._collate_atomic_data(batch, schema)
+
         out = Batch.from_data_list(batch, exclude_keys=self._exclude_keys)
         return out
 
+    def _get_schema(self, batch: List[Data]) -> Optional[Tuple[tuple, Dict[str, tuple]]]:
+        """Get how each field of the ``AtomicData`` in ``batch`` is concatenated, or `None` if the fast path does not apply.
+
+        The schema only depends on the keys of the data, so it is computed once and reused for the following batches.
+        """
+        if len(batch) == 0 or not all(type(d) is AtomicData for d in batch):
+            return None
+
+        all_keys = set(batch[0].keys)
+        if any(set(d.keys) != all_keys for d in batch) or any(d.num_nodes is None for d in batch):
+            return None
+        keys = tuple(sorted(all_keys - self._exclude_keys))
+
+        if self._schema is None or self._schema[0] != keys:
+            data = batch[0]
+            fields = {}
+            for key in keys:
+                item = data[key]
+                if not isinstance(item, torch.Tensor):
+                    return None
+                cat_dim = data.__cat_dim__(key, item)
+                if item.dim() == 0:
+                    cat_dim = None
+                # same rule as `Data.__inc__`: only `*index*` and `*face*` fields are shifted by the number of nodes
+                incremented = bool(re.search("(index|face)", key))
+                fields[key] = (cat_dim, item.is_nested, incremented)
+            self._schema = (keys, fields)
+
+        return self._schema
+
+    def _collate_atomic_data(self, data_list: List[AtomicData], schema: Tuple[tuple, Dict[str, tuple]]) -> Batch:
+        """A specialized ``Batch.from_data_list`` for ``AtomicData`` with the same output and batch info.
+
+        Each field is concatenated with a single call into a tensor allocated to the summed size, and the node offsets
+        of the index fields are added to the concatenated tensor at once instead of item by item.
+        """
+        keys, fields = schema
+        n_graphs = len(data_list)
+
+        batch = Batch()
+        for key in data_list[0].__dict__.keys():
+            if key[:2] != "__" and key[-2:] != "__":
+                batch[key] = None
+
+        num_nodes = [d.num_nodes for d in data_list]
+        node_cumsum = list(accumulate([0] + num_nodes))
+        node_offsets = torch.tensor(node_cumsum, dtype=torch.long)
+
+        slices, cumsum, cat_dims = {}, {}, {}
+        for key in keys:
+            cat_dim, nested, incremented = fields[key]
+            items = [d[key] for d in data_list]
+            if nested:
+                sizes = [item.size(0) for item in items]
+                value = torch.nested.as_nested_tensor([part for item in items for part in item.unbind()])
+            elif cat_dim is None:
+                sizes = [1] * n_graphs
+                value = torch.stack(items, dim=0)
+            else:
+                sizes = [item.shape[cat_dim] for item in items]
+                value = torch.cat(items, dim=cat_dim)
+                if incremented and value.dtype != torch.bool:
+                    shift = torch.repeat_interleave(node_offsets[:-1], torch.tensor(sizes, dtype=torch.long))
+                    shape = [1] * value.dim()
+                    shape[cat_dim] = -1
+                    value += shift.view(shape).to(device=value.device, dtype=value.dtype)
+
+            batch[key] = value
+            cat_dims[key] = cat_dim
+            slices[key] = list(accumulate([0] + sizes))
+            cumsum[key] = node_cumsum if incremented else [0] * (n_graphs + 1)
+
+        device = data_list[0][keys[0]].device if len(keys) > 0 else None
+        batch.batch = torch.repeat_interleave(
+            torch.arange(n_graphs, dtype=torch.long), torch.tensor(num_nodes, dtype=torch.long)
+            ).to(device)
+        batch.ptr = node_offsets.to(device)
+        batch.__num_graphs__ = n_graphs
+        batch.__data_class__ = data_list[0].__class__
+        batch.__slices__ = slices
+        batch.__cumsum__ = cumsum
+        batch.__cat_dims__ = cat_dims
+        batch.__num_nodes_list__ = [getattr(d, "__num_nodes__", None) for d in data_list]
+
+        return batch
+
     def __call__(self, batch: List[Data]) -> Batch:
         """Collate a list of data"""
         return self.collate(batch)
@@ -55,6 +154,11 @@ class DataLoader(torch.utils.data.DataLoader):
         if "collate_fn" in kwargs:
             del kwargs["collate_fn"]
 
+        if kwargs.get("num_workers", 0) == 0:
+            # the worker options are only meaningful (and only accepted by torch) with worker processes
+            kwargs.pop("prefetch_factor", None)
+            kwargs.pop("persistent_workers", None)
+
         super(DataLoader, self).__init__(
             dataset,
             batch_size,
@@ -161,3 +265,143 @@ class PartialSampler(Sampler[int]):
 
     def __len__(self) -> int:
         return self.num_samples_per_epoch
+
+
+class BucketBatchSampler(Sampler[List[int]]):
+    r"""Packs structures of similar size into batches bounded by an atom/edge/orbital budget.
+
+    Structures are sorted by their (orbital, edge, atom) counts, with ties broken randomly, and then
+    greedily packed into batches until adding the next structure would exceed any of the budgets.
+    Batches therefore hold many small cells or a few large slabs, keeping the memory and time of each
+    step roughly constant. A structure that alone exceeds the budget forms a batch of its own.
+
+    The order is deterministic w.r.t. ``seed`` and the epoch number, which is advanced on each call
+    to ``__iter__`` or set explicitly by `set_epoch` (e.g. when restarting).
+
+    Args:
+        data_source (Dataset): dataset to sample from
+        max_atoms (int): maximum number of atoms in a batch. If `None`, not limited.
+        max_edges (int): maximum number of edges in a batch. If `None`, not limited.
+        max_orbitals (int): maximum number of orbitals in a batch, the orbitals per atom are
+            taken from the ``OrbitalMapper`` of the dataset. If `None`, not limited.
+        max_batch_size (int): maximum number of structures in a batch. If `None`, not limited.
+        shuffle (bool): whether to shuffle the order of batches and the structures of equal size.
+        seed (int): the seed of the sampling order.
+        num_replicas (int): the number of processes of the distributed training. Each process iterates
+            over every ``num_replicas``-th batch, starting from ``rank``. The batches are padded by repeating
+            the first ones, so that all processes have the same number of batches.
+        rank (int): the rank of this process in the distributed training.
+    """
+
+    def __init__(
+        self,
+        data_source: Dataset,
+        max_atoms: Optional[int] = None,
+        max_edges: Optional[int] = None,
+        max_orbitals: Optional[int] = None,
+        max_batch_size: Optional[int] = None,
+        shuffle: bool = True,
+        seed: int = 0,
+        num_replicas: int = 1,
+        rank: int = 0,
+    ) -> None:
+        assert any(b is not None for b in [max_atoms, max_edges, max_orbitals, max_batch_size]), \
+            "At least one budget of the batch should be given."
+        self.data_source = data_source
+        self.budget = torch.tensor(
+            [b if b is not None else torch.iinfo(torch.long).max for b in [max_orbitals, max_edges, max_atoms]],
+            dtype=torch.long
+            )
+        self.max_batch_size = max_batch_size if max_batch_size is not None else len(data_source)
+        self.shuffle = shuffle
+        self.seed = seed
+        assert 0 <= rank < num_replicas, "The rank should be in [0, num_replicas)."
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self._epoch = 0
+        # [num_structures, 3] of (orbitals, edges, atoms), in the order of the dataset's indices
+        self.sizes = self.structure_sizes(data_source)
+        n_exceed = (self.sizes > self.budget).any(dim=1).sum().item()
+        if n_exceed > 0:
+            log.warning(f"{n_exceed} structures exceed the batch budget alone, they will be put in single-structure batches.")
+
+    @staticmethod
+    def structure_sizes(dataset: Dataset) -> torch.Tensor:
+        """Count the orbitals, edges and atoms of every structure in ``dataset``."""
+        idp = getattr(dataset, "type_mapper", None)
+        atom_norb = getattr(idp, "atom_norb", None)
+        data = getattr(dataset, "data", None)
+
+        if isinstance(data, Batch) and data.__slices__ is not None:
+            # in-memory datasets: read the sizes from the slices of the stored batch without touching the samples
+            natoms = torch.as_tensor(data.__slices__[AtomicDataDict.POSITIONS_KEY]).diff()
+            nedges = torch.as_tensor(data.__slices__[AtomicDataDict.EDGE_INDEX_KEY]).diff()
+            if atom_norb is not None:
+                if AtomicDataDict.ATOM_TYPE_KEY in data:
+                    atom_types = data[AtomicDataDict.ATOM_TYPE_KEY]
+                else:
+                    atom_types = idp.transform(data[AtomicDataDict.ATOMIC_NUMBERS_KEY])
+                norbs = torch.zeros(len(natoms), dtype=torch.long).index_add_(
+                    0, data[AtomicDataDict.BATCH_KEY], atom_norb[atom_types.flatten()]
+                    )
+            else:
+                norbs = natoms
+            sizes = torch.stack([norbs, nedges, natoms], dim=1)
+            return sizes[torch.as_tensor(list(dataset.indices()), dtype=torch.long)]
+
+        sizes = []
+        for i in range(len(dataset)):
+            sample = dataset[i]
+            natoms = sample.num_nodes
+            nedges = sample[AtomicDataDict.EDGE_INDEX_KEY].shape[1]
+            if atom_norb is not None:
+                norbs = atom_norb[sample[AtomicDataDict.ATOM_TYPE_KEY].flatten()].sum().item()
+            else:
+                norbs = natoms
+            sizes.append([norbs, nedges, natoms])
+
+        return torch.tensor(sizes, dtype=torch.long).reshape(-1, 3)
+
+    def set_epoch(self, epoch: int) -> None:
+        self._epoch = epoch
+
+    def _batches(self, epoch: int) -> List[List[int]]:
+        rng = torch.Generator()
+        rng.manual_seed(self.seed + epoch)
+
+        if self.shuffle:
+            order = torch.randperm(len(self.sizes), generator=rng)
+        else:
+            order = torch.arange(len(self.sizes))
+        # stable sorts from the least to the most significant key keep the random order within equal sizes
+        for col in reversed(range(self.sizes.shape[1])):
+            order = order[torch.sort(self.sizes[order, col], stable=True)[1]]
+
+        sizes, budget = self.sizes.tolist(), self.budget.tolist()
+        batches, current, total = [], [], [0, 0, 0]
+        for i in order.tolist():
+            exceed = any(t + s > b for t, s, b in zip(total, sizes[i], budget))
+            if len(current) > 0 and (exceed or len(current) >= self.max_batch_size):
+                batches.append(current)
+                current, total = [], [0, 0, 0]
+            current.append(i)
+            total = [t + s for t, s in zip(total, sizes[i])]
+        if len(current) > 0:
+            batches.append(current)
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=rng).tolist()]
+
+        if self.num_replicas > 1:
+            n_total = len(batches) + (-len(batches) % self.num_replicas)
+            batches = [batches[i % len(batches)] for i in range(self.rank, n_total, self.num_replicas)]
+
+        return batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        batches = self._batches(self._epoch)
+        self._epoch += 1
+        yield from batches
+
+    def __len__(self) -> int:
+        return len(self._batches(self._epoch))
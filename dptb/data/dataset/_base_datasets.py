@@ -1,3 +1,4 @@
+import os
 import numpy as np
 import logging
 import inspect
@@ -25,7 +26,13 @@ from dptb.data import (
 from dptb.utils.batch_ops import bincount
 from dptb.utils.regressor import solver
 from dptb.utils.savenload import atomic_write
-from dptb.data.AtomicData import _NESTED_FIELDS
+from ._cache import (
+    CACHE_FORMAT_VERSION,
+    hash_files,
+    read_manifest,
+    save_batch_cache,
+    load_batch_cache,
+)
 from ..transforms import TypeMapper
 
 
@@ -157,15 +164,16 @@ class AtomicInMemoryDataset(AtomicDataset):
         # Then pre-process the data if disk files are not found
         super().__init__(root=root, type_mapper=type_mapper)
         if self.data is None:
-            self.data, include_frames = torch.load(self.processed_paths[0])
-            for k,v in self.data:
-                if k in _NESTED_FIELDS:
-                    self.data[k] = torch.nested.as_nested_tensor(v)
-            if not np.all(include_frames == self.include_frames):
-                raise ValueError(
-                    f"the include_frames is changed. "
-                    f"please delete the processed folder and rerun {self.processed_paths[0]}"
-                )
+            # the cache is identified by the content of the raw inputs rather than by the parameters alone,
+            # a stale cache (e.g. the raw files were regenerated in place) is rebuilt instead of silently reused.
+            manifest = read_manifest(self.processed_dir)
+            if manifest is not None \
+                and manifest.get("format_version") == CACHE_FORMAT_VERSION \
+                    and manifest.get("content_hash") == self.content_hash():
+                self.data, _ = load_batch_cache(self.processed_dir, manifest=manifest)
+            else:
+                logging.info(f"The processed data in {self.processed_dir} is outdated, reprocessing.")
+                self.process()
 
     def len(self):
         if self.data is None:
@@ -178,7 +186,21 @@ class AtomicInMemoryDataset(AtomicDataset):
 
     @property
     def processed_file_names(self) -> List[str]:
-        return ["data.pth", "params.yaml"]
+        return ["manifest.json"]
+
+    def raw_content_paths(self) -> List[str]:
+        """The raw files whose content identifies the processed data cache."""
+        paths = [p for p in self.raw_paths if os.path.isfile(p)]
+        # datasets assembled from trajectory folders are identified by every file in those folders.
+        for folder in getattr(self, "info_files", None) or {}:
+            for dirpath, _, filenames in os.walk(os.path.join(self.root, folder)):
+                paths.extend(os.path.join(dirpath, f) for f in filenames)
+        return paths
+
+    def content_hash(self) -> str:
+        """Hash of the raw file contents and the parameters used to build this dataset."""
+        buffer = yaml.dump(self._get_parameters()).encode("ascii")
+        return hash_files(self.raw_content_paths(), root=self.root, extra=buffer)
 
     def get_data(
         self,
@@ -285,27 +307,68 @@ class AtomicInMemoryDataset(AtomicDataset):
         # it doesn't matter if they overwrite each others cached'
         # datasets. It only matters that they don't simultaneously try
         # to write the _same_ file, corrupting it.
-        with atomic_write(self.processed_paths[0], binary=True) as f:
-            for k,v in data:
-                if k in _NESTED_FIELDS:
-                    # need to unbind the nested tensor before saving
-                    data[k] = list(v.unbind())
-            torch.save((data, self.include_frames), f)
-        with atomic_write(self.processed_paths[1], binary=False) as f:
+        save_batch_cache(
+            data, 
+            self.processed_dir, 
+            content_hash=self.content_hash(), 
+            include_frames=self.include_frames,
+            )
+        with atomic_write(os.path.join(self.processed_dir, "params.yaml"), binary=False) as f:
             yaml.dump(self._get_parameters(), f)
 
         logging.info("Cached processed data to disk")
 
-        for k,v in data:
-            if k in _NESTED_FIELDS:
-                # need to nest the tensor after saving
-                data[k] = torch.nested.as_nested_tensor(v)
-
         self.data = data
 
     def get(self, idx):
         return self.data.get_example(idx)
 
+    def cache_geometry(self, lmax: int = 0):
+        """
+        Precompute the geometry of all structures once and store it alongside the data, so that the models do not
+        recompute it at every step when the structures are fixed (e.g. when fitting SK parameters to eigenvalues).
+
+        The edge (and onsite environment) vectors and lengths are stored, together with the flattened SK rotation
+        matrices D^l for l = 0..lmax. ``AtomicDataDict.with_edge_vectors``/``with_onsitenv_vectors`` and
+        ``SKHamiltonian`` use the stored fields when they are present in the data. The cache is kept in memory
+        only and should not be used when gradients with respect to the positions or the cell are needed.
+
+        Args:
+            lmax (int): the largest angular momentum of the basis used by the model.
+        """
+        from dptb.nn.tensor_product import sk_rotation_matrices
+
+        data = AtomicData.to_AtomicDataDict(self.data)
+        for key in [
+            AtomicDataDict.EDGE_VECTORS_KEY, AtomicDataDict.EDGE_LENGTH_KEY,
+            AtomicDataDict.ONSITENV_VECTORS_KEY, AtomicDataDict.ONSITENV_LENGTH_KEY
+            ]:
+            data.pop(key, None)
+
+        data = AtomicDataDict.with_edge_vectors(data, with_lengths=True)
+        geometry = {
+            AtomicDataDict.EDGE_INDEX_KEY: {
+                AtomicDataDict.EDGE_VECTORS_KEY: data[AtomicDataDict.EDGE_VECTORS_KEY],
+                AtomicDataDict.EDGE_LENGTH_KEY: data[AtomicDataDict.EDGE_LENGTH_KEY],
+                AtomicDataDict.EDGE_ROTATION_KEY: sk_rotation_matrices(data[AtomicDataDict.EDGE_VECTORS_KEY], lmax),
+            }
+        }
+        if AtomicDataDict.ONSITENV_INDEX_KEY in data:
+            data = AtomicDataDict.with_onsitenv_vectors(data, with_lengths=True)
+            geometry[AtomicDataDict.ONSITENV_INDEX_KEY] = {
+                AtomicDataDict.ONSITENV_VECTORS_KEY: data[AtomicDataDict.ONSITENV_VECTORS_KEY],
+                AtomicDataDict.ONSITENV_LENGTH_KEY: data[AtomicDataDict.ONSITENV_LENGTH_KEY],
+                AtomicDataDict.ONSITENV_ROTATION_KEY: sk_rotation_matrices(data[AtomicDataDict.ONSITENV_VECTORS_KEY], lmax),
+            }
+
+        # the new fields are sliced like the index they belong to
+        for index_key, fields in geometry.items():
+            for key, value in fields.items():
+                self.data[key] = value.detach()
+                self.data.__slices__[key] = self.data.__slices__[index_key]
+                self.data.__cumsum__[key] = [0] * len(self.data.__slices__[index_key])
+                self.data.__cat_dims__[key] = 0
+
     def _selectors(
         self,
         stride: int = 1,
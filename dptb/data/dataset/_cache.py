@@ -0,0 +1,146 @@
+"""
+Flat binary cache for the processed ``Batch`` of an ``AtomicInMemoryDataset``.
+
+Every tensor field of the batch is written as a raw array ``<key>.bin``, and a
+``manifest.json`` records the dtype and shape of each field together with the
+batching metadata (``__slices__``, ``__cumsum__``, ...) and a content hash of
+the raw inputs. Loading maps the arrays with ``torch.from_file`` in private
+(copy-on-write) mode, so several jobs reading the same cache share the page
+cache instead of unpickling a private copy each.
+"""
+from typing import Any, Dict, List, Optional, Tuple
+import os
+import json
+import math
+import hashlib
+from importlib import import_module
+
+import torch
+
+from dptb.utils.torch_geometric import Batch
+from dptb.utils.savenload import atomic_write, atomic_write_group
+
+MANIFEST_NAME = "manifest.json"
+CACHE_FORMAT_VERSION = 1
+
+
+def hash_files(paths: List[str], root: Optional[str] = None, extra: bytes = b"") -> str:
+    """Hash the content of ``paths``, together with their names relative to ``root`` and ``extra``."""
+    h = hashlib.sha1(extra)
+    for path in sorted(paths):
+        name = os.path.relpath(path, root) if root is not None else os.path.basename(path)
+        h.update(name.encode("utf-8"))
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def _dtype_name(dtype: torch.dtype) -> str:
+    return str(dtype).split(".")[-1]
+
+
+def _to_json(value):
+    if isinstance(value, torch.Tensor):
+        return value.tolist()
+    return value
+
+
+def _from_json(value):
+    # cumsum entries of tuple-valued increments were tensors before saving
+    if isinstance(value, list):
+        return torch.tensor(value)
+    return value
+
+
+def read_manifest(cache_dir: str) -> Optional[Dict[str, Any]]:
+    path = os.path.join(cache_dir, MANIFEST_NAME)
+    if not os.path.isfile(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_batch_cache(
+    data: Batch,
+    cache_dir: str,
+    content_hash: str,
+    include_frames: Optional[List[int]] = None,
+) -> None:
+    """Write ``data`` to ``cache_dir`` as flat per-field arrays plus a manifest.
+
+    All files of one cache are renamed into place as a group, and the manifest is
+    the last of them, so a concurrent reader never sees a half written cache.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    fields = {}
+    with atomic_write_group():
+        for key, item in data:
+            if not isinstance(item, torch.Tensor):
+                raise TypeError(f"Only tensor fields can be cached, but `{key}` is {type(item)}.")
+            field = {"file": f"{key}.bin", "dtype": _dtype_name(item.dtype)}
+            if item.is_nested:
+                parts = item.unbind()
+                field["nested_shapes"] = [list(p.shape) for p in parts]
+                flat = torch.cat([p.reshape(-1) for p in parts]) if len(parts) > 0 else torch.empty(0, dtype=item.dtype)
+            else:
+                field["shape"] = list(item.shape)
+                flat = item.reshape(-1)
+            flat = flat.detach().cpu().contiguous()
+            field["numel"] = flat.numel()
+            with atomic_write(os.path.join(cache_dir, field["file"]), binary=True) as f:
+                f.write(flat.view(torch.uint8).numpy().data)
+            fields[key] = field
+
+        manifest = {
+            "format_version": CACHE_FORMAT_VERSION,
+            "content_hash": content_hash,
+            "include_frames": None if include_frames is None else [int(i) for i in include_frames],
+            "data_class": f"{data.__data_class__.__module__}.{data.__data_class__.__name__}",
+            "num_graphs": data.num_graphs,
+            "num_nodes_list": data.__num_nodes_list__,
+            "slices": data.__slices__,
+            "cumsum": {k: [_to_json(c) for c in v] for k, v in data.__cumsum__.items()},
+            "cat_dims": data.__cat_dims__,
+            "fields": fields,
+        }
+        with atomic_write(os.path.join(cache_dir, MANIFEST_NAME), binary=False) as f:
+            json.dump(manifest, f)
+
+
+def load_batch_cache(cache_dir: str, manifest: Optional[Dict[str, Any]] = None) -> Tuple[Batch, Dict[str, Any]]:
+    """Map the cache in ``cache_dir`` back into a ``Batch`` without copying the flat fields."""
+    if manifest is None:
+        manifest = read_manifest(cache_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"No {MANIFEST_NAME} found in {cache_dir}.")
+
+    data = Batch()
+    for key, field in manifest["fields"].items():
+        dtype = getattr(torch, field["dtype"])
+        if field["numel"] == 0:
+            flat = torch.empty(0, dtype=dtype)
+        else:
+            # shared=False maps the file MAP_PRIVATE: pages are shared until written to
+            flat = torch.from_file(
+                os.path.join(cache_dir, field["file"]), shared=False, size=field["numel"], dtype=dtype
+                )
+        if "nested_shapes" in field:
+            parts, start = [], 0
+            for shape in field["nested_shapes"]:
+                n = math.prod(shape)
+                parts.append(flat[start:start+n].view(shape))
+                start += n
+            data[key] = torch.nested.as_nested_tensor(parts)
+        else:
+            data[key] = flat.view(field["shape"])
+
+    module_name, class_name = manifest["data_class"].rsplit(".", 1)
+    data.__data_class__ = getattr(import_module(module_name), class_name)
+    data.__num_graphs__ = manifest["num_graphs"]
+    data.__num_nodes_list__ = manifest["num_nodes_list"]
+    data.__slices__ = manifest["slices"]
+    data.__cumsum__ = {k: [_from_json(c) for c in v] for k, v in manifest["cumsum"].items()}
+    data.__cat_dims__ = manifest["cat_dims"]
+
+    return data, manifest
@@ -25,6 +25,43 @@ import logging
 
 log = logging.getLogger(__name__)
 
+class _H5File(object):
+    """
+    A read-only h5py file, opened lazily and once per process.
+
+    h5py file handles are neither fork safe nor picklable, so the file is reopened when it is accessed from another
+    process than the one that opened it, e.g. a forked or spawned DataLoader worker, and only its path is pickled.
+    """
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._file = None
+        self._pid = None
+
+    @property
+    def file(self) -> h5py.File:
+        if self._pid != os.getpid():
+            self._file = h5py.File(self.filename, "r")
+            self._pid = os.getpid()
+        return self._file
+
+    def __getitem__(self, key):
+        return self.file[key]
+
+    def __contains__(self, key):
+        return key in self.file
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def __len__(self):
+        return len(self.file)
+
+    def keys(self):
+        return self.file.keys()
+
+    def __getstate__(self):
+        return {"filename": self.filename, "_file": None, "_pid": None}
+
 class _TrajData(object):
     '''
     Input files format in a trajectory (shape):
@@ -85,17 +122,17 @@ class _TrajData(object):
 
         if get_Hamiltonian==True:
             assert os.path.exists(os.path.join(self.root, "hamiltonians.h5")), "Hamiltonian file not found."
-            self.data["hamiltonian_blocks"] = h5py.File(os.path.join(self.root, "hamiltonians.h5"), "r")
+            self.data["hamiltonian_blocks"] = _H5File(os.path.join(self.root, "hamiltonians.h5"))
         if get_overlap==True:
             assert os.path.exists(os.path.join(self.root, "overlaps.h5")), "Overlap file not found."
-            self.data["overlap_blocks"] = h5py.File(os.path.join(self.root, "overlaps.h5"), "r")
+            self.data["overlap_blocks"] = _H5File(os.path.join(self.root, "overlaps.h5"))
         if get_DM==True:
             assert os.path.exists(os.path.join(self.root, "density_matrices.h5")) or os.path.exists(os.path.join(self.root, "DM.h5")), "Density Matrix file not found."
             if os.path.exists(os.path.join(self.root, "density_matrices.h5")):
-                self.data["DM_blocks"] = h5py.File(os.path.join(self.root, "density_matrices.h5"), "r")
+                self.data["DM_blocks"] = _H5File(os.path.join(self.root, "density_matrices.h5"))
             else:
-                self.data["DM_blocks"] = h5py.File(os.path.join(self.root, "DM.h5"), "r")
-        
+                self.data["DM_blocks"] = _H5File(os.path.join(self.root, "DM.h5"))
+
     @classmethod
     def from_text_data(cls,
                        root: str, 
@@ -3,7 +3,6 @@ import os
 import glob
 
 import numpy as np
-import h5py
 from ase import Atoms
 from ase.io import Trajectory
 import pickle
@@ -22,7 +21,7 @@ from dptb.data.AtomicDataDict import with_edge_vectors
 from dptb.nn.hamiltonian import E3Hamiltonian
 from tqdm import tqdm
 import logging
-from dptb.data.dataset._default_dataset import DefaultDataset
+from dptb.data.dataset._default_dataset import DefaultDataset, _H5File
 
 
 
@@ -61,16 +60,15 @@ class _HDF5_TrajData(object):
         
         if get_Hamiltonian:
             assert os.path.exists(os.path.join(root, "hamiltonian.h5")), "Hamiltonian file not found."
-            self.data["hamiltonian_blocks"] = h5py.File(os.path.join(self.root, "hamiltonians.h5"), "r")
+            self.data["hamiltonian_blocks"] = _H5File(os.path.join(self.root, "hamiltonians.h5"))
 
         if get_overlap:
             assert os.path.exists(os.path.join(root, "overlap.h5")), "Overlap file not found."
-            self.data["overlap_blocks"] = h5py.File(os.path.join(self.root, "overlap.h5"), "r")
+            self.data["overlap_blocks"] = _H5File(os.path.join(self.root, "overlap.h5"))
         
         if get_DM:
             assert os.path.exists(os.path.join(root, "DM.h5")), "DM file not found."
-            self.data["DM_blocks"] = h5py.File(os.path.join(self.root, "DM.h5"), "r")
-
+            self.data["DM_blocks"] = _H5File(os.path.join(self.root, "DM.h5"))
 
     def toAtomicDataList(self, idp: TypeMapper = None):
         data_list = []
@@ -75,6 +75,25 @@ class LMDBDataset(AtomicDataset):
                 self.index_map += list(range(txn.stat()['entries']))
             db_env.close()
 
+        # lmdb environments are opened lazily and kept per process, since a handle must not be
+        # shared across the fork of DataLoader workers, nor be pickled into spawned ones.
+        self._db_envs = {}
+        self._db_pid = None
+
+    def _get_env(self, file: str):
+        if self._db_pid != os.getpid():
+            self._db_envs = {}
+            self._db_pid = os.getpid()
+        if file not in self._db_envs:
+            self._db_envs[file] = lmdb.open(os.path.join(self.root, file), readonly=True, lock=False)
+        return self._db_envs[file]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_db_envs"] = {}
+        state["_db_pid"] = None
+        return state
+
     def len(self):
         return self.num_graphs
     
@@ -98,7 +117,7 @@ class LMDBDataset(AtomicDataset):
                 extract_zip(download_path, self.raw_dir)
 
     def get(self, idx):
-        db_env = lmdb.open(os.path.join(self.root, self.file_map[idx]), readonly=True, lock=False)
+        db_env = self._get_env(self.file_map[idx])
         with db_env.begin() as txn:
             data_dict = txn.get(self.index_map[int(idx)].to_bytes(length=4, byteorder='big'))
             data_dict = pickle.loads(data_dict)
@@ -139,7 +158,6 @@ class LMDBDataset(AtomicDataset):
             if not (self.get_Hamiltonian or self.get_DM):
                 blocks = False
         
-        db_env.close()
         atomicdata = AtomicData.from_points(
             pos=pos.reshape(-1,3),
             cell=cell.reshape(3,3),
@@ -0,0 +1,83 @@
+from typing import Optional
+import time
+import logging
+import torch
+from ase.io import read
+from dptb.nn.build import build_model
+from dptb.data import AtomicData, AtomicDataDict
+from dptb.utils.argcheck import get_cutoffs_from_model_options
+from dptb.utils.tools import j_loader
+from dptb import __version__
+
+log = logging.getLogger(__name__)
+
+def deploy(
+        init_model: str,
+        output: str,
+        structure: Optional[str]=None,
+        compile: bool=False,
+        log_level: int=logging.INFO,
+        log_path: Optional[str]=None,
+        **kwargs
+):
+    """
+    Freeze a trained model into a standalone artifact, that can be loaded by `load_deployed` without the
+    model and common options.
+
+    The model is put in eval mode, its weights stop requiring gradients, and the whole module is saved together
+    with the config of the checkpoint. If a `structure` file is given, the frozen model is run on it, and with
+    `compile`, `torch.compile` is checked to reproduce the eager hamiltonian on it.
+    """
+    model = build_model(init_model)
+    model.eval()
+    for p in model.parameters():
+        p.requires_grad_(False)
+
+    if init_model.split(".")[-1] == "json":
+        config = j_loader(init_model)
+    else:
+        config = torch.load(init_model, map_location="cpu")["config"]
+
+    if structure is not None:
+        check_deployed(model, structure, compile=compile)
+
+    torch.save({"model": model, "config": config, "version": __version__}, output)
+    log.info(f"The model {init_model} has been deployed to {output}.")
+
+def load_deployed(path: str, device: Optional[str]=None) -> torch.nn.Module:
+    """load the frozen model saved by `deploy`."""
+    f = torch.load(path, map_location=device if device is not None else "cpu", weights_only=False)
+    if f["version"] != __version__:
+        log.warning(f"The model was deployed with DeePTB {f['version']}, but is loaded with {__version__}.")
+    return f["model"]
+
+def check_deployed(model: torch.nn.Module, structure: str, compile: bool=False):
+    """run the model on `structure`, and compare the eager and compiled hamiltonian if `compile`."""
+    if compile and not hasattr(torch, "compile"):
+        raise RuntimeError(f"torch.compile requires torch>=2.0, but torch {torch.__version__} is installed.")
+    r_max, er_max, oer_max = get_cutoffs_from_model_options(model.model_options)
+    atomic_data = AtomicData.from_ase(read(structure), r_max=r_max, er_max=er_max, oer_max=oer_max)
+
+    def _data():
+        return model.idp(AtomicData.to_AtomicDataDict(atomic_data.to(model.device)))
+
+    fields = [AtomicDataDict.EDGE_FEATURES_KEY, AtomicDataDict.NODE_FEATURES_KEY]
+    with torch.inference_mode():
+        start = time.time()
+        ref = model(_data())
+        log.info(f"eager forward: {time.time() - start:.4f} s.")
+        if not compile:
+            return
+
+        compiled = torch.compile(model, backend="inductor", dynamic=True)
+        compiled(_data())
+        start = time.time()
+        out = compiled(_data())
+        log.info(f"compiled forward: {time.time() - start:.4f} s.")
+
+    atol = 1e-5 if model.dtype == torch.float32 else 1e-10
+    for field in fields:
+        if not torch.allclose(ref[field], out[field], atol=atol):
+            log.error(f"The compiled model differs from the eager model in {field}.")
+            raise RuntimeError(f"The compiled model differs from the eager model in {field}.")
+    log.info("The compiled model reproduces the eager model.")
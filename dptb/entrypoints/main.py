@@ -10,6 +10,7 @@ from dptb.entrypoints.bond import bond
 from dptb.entrypoints.nrl2json import nrl2json
 from dptb.entrypoints.pth2json import pth2json
 from dptb.entrypoints.data import data
+from dptb.entrypoints.deploy import deploy
 from dptb.utils.loggers import set_log_handles
 from dptb.utils.config_check import check_config_train
 from dptb.entrypoints.collectskf import skf2pth, skf2nnsk
@@ -238,6 +239,13 @@ def main_parser() -> argparse.ArgumentParser:
         help="The output files in training.",
     )
 
+    parser_train.add_argument(
+        "--nproc",
+        type=int,
+        default=1,
+        help="The number of processes of the data-parallel training on CPU. Not needed when launched by torchrun.",
+    )
+
     parser_test = subparsers.add_parser(
         "test",
         parents=[parser_log],
@@ -395,6 +403,44 @@ def main_parser() -> argparse.ArgumentParser:
     )
 
 
+    # deploy
+    parser_deploy = subparsers.add_parser(
+        "deploy",
+        parents=[parser_log],
+        help="Freeze a trained model into a standalone artifact",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser_deploy.add_argument(
+        "-i",
+        "--init-model",
+        type=str,
+        required=True,
+        help="The checkpoint of the trained model.",
+    )
+
+    parser_deploy.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        default="deployed.pth",
+        help="The output file of the frozen model.",
+    )
+
+    parser_deploy.add_argument(
+        "-s",
+        "--structure",
+        type=str,
+        default=None,
+        help="A structure file to check the frozen model on.",
+    )
+
+    parser_deploy.add_argument(
+        "--compile",
+        action="store_true",
+        help="Check that torch.compile reproduces the eager model on the structure.",
+    )
+
     return parser
 
 def parse_args(args: Optional[List[str]] = None) -> argparse.Namespace:
@@ -458,3 +504,6 @@ def main():
 
     elif args.command == 'skf2nn':
         skf2nnsk(**dict_args)
+
+    elif args.command == 'deploy':
+        deploy(**dict_args)
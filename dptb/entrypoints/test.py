@@ -72,16 +72,21 @@ def _test(
 
     f = torch.load(run_opt["init_model"])
     jdata["model_options"] = f["config"]["model_options"]
+    ema_state = f.get("ema_state_dict")
     del f
     
     test_datasets = build_dataset(**jdata["data_options"]["test"], **jdata["common_options"])
     model = build_model(run_opt["init_model"], model_options=jdata["model_options"], common_options=jdata["common_options"])
+    if ema_state is not None and jdata["test_options"].get("use_ema", True):
+        log.info("Testing the moving average of the weights saved in the checkpoint.")
+        model.load_state_dict(ema_state["shadow"], strict=False)
     model.eval()
     tester = Tester(
         test_options=jdata["test_options"],
         common_options=jdata["common_options"],
         model = model,
         test_datasets=test_datasets,
+        results_path=os.path.join(run_opt["results_path"], "test_results.jsonl") if output else None,
     )
 
     # register the plugin in tester, to tract training info
@@ -91,8 +96,6 @@ def _test(
     
     for q in tester.plugin_queues.values():
         heapq.heapify(q)
-    
-    tester.build()
 
     if output:
         # output training configurations:
@@ -104,5 +107,15 @@ def _test(
     tester.run()
 
     end_time = time.time()
+    if output and tester.analysis is not None and hasattr(tester.analysis, "stats"):
+        with open(os.path.join(run_opt["results_path"], "hamil_analysis.json"), "w") as fp:
+            json.dump(_to_list(tester.analysis.stats), fp, indent=4)
     log.info("finished testing")
-    log.info(f"wall time: {(end_time - start_time):.3f} s")
\ No newline at end of file
+    log.info(f"wall time: {(end_time - start_time):.3f} s")
+
+def _to_list(stats):
+    if isinstance(stats, torch.Tensor):
+        return stats.tolist()
+    elif isinstance(stats, dict):
+        return {k: _to_list(v) for k, v in stats.items()}
+    return stats
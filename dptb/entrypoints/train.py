@@ -5,10 +5,13 @@ from dptb.plugins.monitor import TrainLossMonitor, LearningRateMonitor, Validati
 from dptb.plugins.train_logger import Logger
 from dptb.utils.argcheck import normalize, collect_cutoffs
 from dptb.plugins.saver import Saver
+from dptb.plugins.profiler import Profiler
+from dptb.plugins.async_validation import AsyncValidationer
 from typing import Dict, List, Optional, Any
 from dptb.utils.tools import j_loader, setup_seed, j_must_have
 from dptb.utils.constants import dtype_dict
 from dptb.utils.loggers import set_log_handles
+from dptb.utils.distributed import init_distributed, cleanup_distributed, is_main_process, launch
 import heapq
 import logging
 import torch
@@ -32,8 +35,23 @@ def train(
         output: str,
         log_level: int,
         log_path: Optional[str],
+        nproc: int=1,
         **kwargs
 ):
+    if nproc > 1 and int(os.environ.get("WORLD_SIZE", 1)) == 1:
+        # start the data-parallel training on this machine, each process runs this function again.
+        launch(train, nproc, INPUT=INPUT, init_model=init_model, restart=restart, output=output, 
+               log_level=log_level, log_path=log_path, nproc=1, **kwargs)
+        return
+
+    # with torchrun or the launch above, join the gloo process group. Only rank 0 writes the outputs and logs.
+    init_distributed(backend="gloo")
+    main_process = is_main_process()
+    if not main_process:
+        output = None
+        log_path = None
+        log_level = max(log_level, logging.WARNING)
+
     run_opt = {
         "init_model": init_model,
         "restart": restart,
@@ -204,15 +222,33 @@ def train(
     
     # register the plugin in trainer, to tract training info
     log_field = ["train_loss", "lr"]
-    if validation_datasets:
+    async_validation = jdata["train_options"].get("async_validation", {}).get("enable", False) and validation_datasets is not None
+    async_validation = async_validation and main_process
+    if async_validation:
+        validationer = AsyncValidationer(
+            interval=[(jdata["train_options"]["validation_freq"], 'iteration'), (1, 'epoch')],
+            max_pending=jdata["train_options"]["async_validation"].get("max_pending", 2),
+            num_threads=jdata["train_options"]["async_validation"].get("num_threads", 1),
+            )
+        trainer.register_plugin(validationer)
+        log_field.append("validation_loss")
+    elif validation_datasets and main_process:
         trainer.register_plugin(Validationer())
         log_field.append("validation_loss")
     trainer.register_plugin(TrainLossMonitor())
     trainer.register_plugin(LearningRateMonitor())
-    if jdata["train_options"]["use_tensorboard"]:
+    if jdata["train_options"]["use_tensorboard"] and main_process:
         trainer.register_plugin(TensorBoardMonitor(interval=[(jdata["train_options"]["display_freq"], 'iteration'), (1, 'epoch')]))
-    trainer.register_plugin(Logger(log_field,
-        interval=[(jdata["train_options"]["display_freq"], 'iteration'), (1, 'epoch')]))
+    if main_process:
+        trainer.register_plugin(Logger(log_field,
+            interval=[(jdata["train_options"]["display_freq"], 'iteration'), (1, 'epoch')]))
+    profiler_options = jdata["train_options"].get("profiler", {})
+    if profiler_options.get("enable", False) and main_process:
+        profile_path = None
+        if output:
+            profile_path = os.path.join(str(output), "profile")
+            Path(profile_path).mkdir(exist_ok=True, parents=True)
+        trainer.register_plugin(Profiler(log_freq=profiler_options.get("log_freq", 100), trace_freq=profiler_options.get("trace_freq", 0)), output=profile_path)
     
     for q in trainer.plugin_queues.values():
         heapq.heapify(q)
@@ -222,16 +258,33 @@ def train(
         with open(os.path.join(output, "train_config.json"), "w") as fp:
             json.dump(jdata, fp, indent=4)
 
-        trainer.register_plugin(Saver(
+        saver = Saver(
             #interval=[(jdata["train_options"].get("save_freq"), 'epoch'), (1, 'iteration')] if jdata["train_options"].get(
             #    "save_freq") else None))
             interval=[(jdata["train_options"].get("save_freq"), 'iteration'),  (1, 'epoch')] if jdata["train_options"].get(
-                "save_freq") else None), checkpoint_path=checkpoint_path)
+                "save_freq") else None,
+            async_save=jdata["train_options"].get("async_save", False),
+            min_interval=jdata["train_options"].get("save_min_interval", 0.),
+            max_pending=jdata["train_options"].get("max_pending_saves", 2),
+            best_from_validation=async_validation,
+            )
+        trainer.register_plugin(saver, checkpoint_path=checkpoint_path)
         # add a plugin to save the training parameters of the model, with model_output as given path
 
     start_time = time.time()
 
     trainer.run(trainer.train_options["num_epoch"])
+    if async_validation:
+        # the results of the last snapshots may still select the best checkpoint.
+        validationer.finish()
+    if output:
+        # wait for the checkpoints still being written in the background.
+        saver.finish()
+    if trainer.profiler is not None:
+        # stop the trace that may still be running after the last iteration.
+        trainer.profiler.finish()
+
+    cleanup_distributed()
 
     end_time = time.time()
     log.info("finished training")
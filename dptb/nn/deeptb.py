@@ -11,6 +11,7 @@ from dptb.nn.nnsk import NNSK
 from dptb.nn.dftbsk import DFTBSK
 from e3nn.o3 import Linear
 from dptb.nn.rescale import E3PerSpeciesScaleShift, E3PerEdgeSpeciesScaleShift
+from dptb.nn.mixed_precision import autocast_modules
 import logging
 
 log = logging.getLogger(__name__)
@@ -259,6 +260,22 @@ class NNENV(nn.Module):
                     )
 
 
+    def enable_autocast(self, dtype: Union[str, torch.dtype]=torch.bfloat16):
+        """
+        Run the tensor products and MLPs of the embedding and the overlap prediction in `dtype`.
+
+        The scale/shift of the predictions, the Hamiltonian transform and the loss stay in the model dtype, which
+        should be float32, since `torch.autocast` leaves the float64 tensors unchanged.
+        """
+        if isinstance(dtype, str):
+            dtype = getattr(torch, dtype)
+        if self.dtype != torch.float32:
+            raise ValueError(f"The mixed precision requires the float32 dtype in common_options, but it is {self.dtype}.")
+        n = autocast_modules(self.embedding, dtype=dtype)
+        if hasattr(self, "edge_prediction_s"):
+            n += autocast_modules(self.edge_prediction_s, dtype=dtype)
+        log.info(f"Autocast {n} modules of the model to {dtype}.")
+
     def forward(self, data: AtomicDataDict.Type):
         if data.get(AtomicDataDict.EDGE_TYPE_KEY, None) is None:
             self.idp(data)
@@ -0,0 +1,88 @@
+import torch
+from typing import List, Union
+from dptb.utils._xitorch._impls.interpolate.interp_1d import _get_spline_mat_inv
+
+
+class SKTable:
+    """
+    The Slater-Koster integral tables of all the bond types, stored as precomputed piecewise polynomial coefficients.
+
+    The tables share one distance grid. On each interval [x_i, x_i+1], the integral is y = p0 + p1*t + p2*t^2 + p3*t^3
+    with t = (r - x_i) / (x_i+1 - x_i). For the linear method p2 = p3 = 0. For the cspline method the coefficients
+    are the same as the not-a-knot cubic spline of `Interp1D`. When the grid is uniform, which is the case for
+    the .skf files, the interval is located by index arithmetic instead of a search.
+
+    The distances outside the grid give zero integrals.
+    """
+    def __init__(
+            self,
+            x: torch.Tensor,
+            y: Union[torch.Tensor, List[torch.Tensor]],
+            method: str = 'linear',
+            ) -> None:
+        """
+        :param x: the distance grid, shape (nx,)
+        :param y: the tables, shape (n_bond, n_ingrl, nx). A list of tables is concatenated along the integral dimension,
+            so that e.g. the hopping and overlap integrals are evaluated together.
+        :param method: 'linear' or 'cspline'
+        """
+        assert method in ['linear', 'cspline'], "Only linear and cspline are supported."
+        if isinstance(y, (list, tuple)):
+            self.split = [iy.shape[1] for iy in y]
+            y = torch.cat(y, dim=1)
+        else:
+            self.split = [y.shape[1]]
+        assert y.dim() == 3 and y.shape[-1] == x.shape[0], "The shape of the sk table is not correct."
+
+        self.method = method
+        self.n_bond, self.n_ingrl, nx = y.shape
+        self.x = x
+        self.x_min, self.x_max = x[0].item(), x[-1].item()
+        dx = x[1:] - x[:-1]
+        self.uniform = bool(torch.allclose(dx, dx[0].expand_as(dx), rtol=1e-5, atol=1e-8))
+        self.dx = dx[0].item()
+
+        yl = y[..., :-1]
+        dy = y[..., 1:] - yl
+        if method == 'linear':
+            coeffs = [yl, dy]
+        else:
+            ks = torch.matmul(_get_spline_mat_inv(x, "not-a-knot"), y.unsqueeze(-1)).squeeze(-1)
+            a = ks[..., :-1] * dx - dy
+            b = -ks[..., 1:] * dx + dy
+            coeffs = [yl, dy + a, b - 2 * a, a - b]
+
+        # shape (n_bond * (nx-1), n_ingrl, n_coeff), so that one gather gives all the integrals of an edge.
+        self.coeffs = torch.stack(coeffs, dim=-1).transpose(1, 2).reshape(-1, self.n_ingrl, len(coeffs)).contiguous()
+
+    def __call__(self, rij: torch.Tensor, bond_type: torch.Tensor) -> Union[torch.Tensor, List[torch.Tensor]]:
+        """
+        Evaluate the integrals of all the edges at once.
+
+        :param rij: the bond lengths, shape (n_edge,)
+        :param bond_type: the bond type index of each edge, shape (n_edge,)
+        :return: the integrals of shape (n_edge, n_ingrl), or a list of them when the table is built from a list.
+        """
+        rij = rij.flatten()
+        nx = self.x.shape[0]
+        if self.uniform:
+            s = (rij - self.x_min) / self.dx
+            idx = s.detach().floor().long().clamp(0, nx - 2)
+            t = s - idx
+        else:
+            idx = (torch.searchsorted(self.x, rij.detach().contiguous(), right=False) - 1).clamp(0, nx - 2)
+            xl = self.x[idx]
+            t = (rij - xl) / (self.x[idx + 1] - xl)
+
+        coeffs = self.coeffs[bond_type.flatten() * (nx - 1) + idx] # shape (n_edge, n_ingrl, n_coeff)
+        t = t.unsqueeze(-1).to(coeffs.dtype)
+        out = coeffs[..., -1]
+        for i in range(coeffs.shape[-1] - 2, -1, -1):
+            out = out * t + coeffs[..., i]
+
+        out_range = (rij < self.x_min) | (rij > self.x_max)
+        out = out.masked_fill(out_range.unsqueeze(-1), 0.)
+
+        if len(self.split) == 1:
+            return out
+        return list(torch.split(out, self.split, dim=1))
@@ -1,5 +1,6 @@
 from dptb.nn.dftb.sk_param import SKParam
 from dptb.nn.dftb.hopping_dftb import HoppingIntp
+from dptb.nn.dftb.sk_table import SKTable
 import torch
 from torch import nn
 from dptb.nn.sktb.hopping import HoppingFormula
@@ -7,7 +8,6 @@ from dptb.nn.sktb import OnsiteFormula, bond_length_list
 from dptb.nn.sktb.cov_radiiDB import Covalent_radii
 from dptb.nn.sktb.bondlengthDB import atomic_radius_v1
 from dptb.utils.constants import atomic_num_dict
-from functorch import vmap
 import matplotlib.pyplot as plt
 from torch.optim import Adam, LBFGS, RMSprop, SGD
 from torch.optim.lr_scheduler import ExponentialLR, CosineAnnealingLR
@@ -38,19 +38,30 @@ class dftb:
         self.overlap = HoppingIntp(num_ingrls=self.param["Overlap"].shape[1])
         self.bond_types = self.idp_sk.bond_types
         self.bond_type_to_index = {bt: i for i, bt in enumerate(self.idp_sk.bond_types)}
+        self.sktable = SKTable(x=self.param["Distance"].to(device=self.device, dtype=self.dtype), 
+                               y=[self.param["Hopping"].to(device=self.device, dtype=self.dtype), 
+                                  self.param["Overlap"].to(device=self.device, dtype=self.dtype)], 
+                               method=self.hopping.intp_method)
 
-    def __call__(self, r, bond_indices = None, mode="hopping"):
-        out = []
+    def skints(self, r, bond_indices = None):
+        """
+        The hopping and overlap integrals of the bonds `bond_indices` at the distances r of shape (n_bond, n_r), 
+        evaluated for all the bonds at once. Both are returned in the shape (n_bond, n_r, n_ingrls).
+        """
         if bond_indices is None:
             bond_indices = torch.arange(len(self.idp_sk.bond_types), device=self.device)
 
         assert len(bond_indices) == len(r), "The bond_indices and r should have the same length."
+        bond_type = torch.as_tensor(bond_indices, device=self.device).reshape(-1, 1).expand_as(r)
+        hopping, overlap = self.sktable(r, bond_type)
         
-        for i, ind in enumerate(bond_indices):
-            out.append(self.hopping.get_skhij(rij=r[i], xx=self.param["Distance"].to(device=self.device, dtype=self.dtype), 
-                                              yy=self.param[mode[0].upper()+mode[1:]][ind].to(device=self.device, dtype=self.dtype)))
+        return hopping.reshape(r.shape[0], r.shape[1], -1), overlap.reshape(r.shape[0], r.shape[1], -1)
+
+    def __call__(self, r, bond_indices = None, mode="hopping"):
+        assert mode in ["hopping", "overlap"], "The mode should be hopping or overlap."
+        hopping, overlap = self.skints(r, bond_indices=bond_indices)
         
-        return torch.stack(out)
+        return hopping if mode == "hopping" else overlap
     
 class DFTB2NNSK(nn.Module):
 
@@ -196,10 +207,15 @@ class DFTB2NNSK(nn.Module):
         return model 
     
 
-    def step(self, r):
-        assert r.shape[0] == len(self.curr_bond_indices)
+    def _nnsk_skints(self, r, bond_indices, params):
+        """
+        Evaluate the nnsk formula with the parameters `params` of shape (n_bond_types, n_ingrls, n_paras)
+        at the distances r of shape (n_bond,) or (n_bond, n_r), for all the bonds `bond_indices` at once.
+        """
+        assert r.shape[0] == len(bond_indices)
+        shape = r.shape
+        bond_ind_r_shp = bond_indices.reshape([-1] + [1] * (r.dim() - 1)).expand(shape).reshape(-1)
         r = r.reshape(-1)
-        bond_ind_r_shp = self.curr_bond_indices.reshape(-1)
 
         edge_number = self.idp_sk.untransform_bond(bond_ind_r_shp).T
         r0 = self.atomic_radius_list[edge_number-1].sum(0).to(device=self.device, dtype=self.dtype)  # bond length r0 = r1 + r2. (r1, r2 are atomic radii of the two atoms)
@@ -213,33 +229,75 @@ class DFTB2NNSK(nn.Module):
             assert isinstance(self.rs, (int,float))
             r_cutoffs = self.rs
         
-        hopping = self.nnsk_hopping.get_skhij(
+        skints = self.nnsk_hopping.get_skhij(
             rij=r,
-            paraArray=self.hopping_params[bond_ind_r_shp], # [N_edge, n_pairs, n_paras],
+            paraArray=params[bond_ind_r_shp], # [N_edge, n_pairs, n_paras],
             rs=r_cutoffs,
             w=self.w,
             r0=r0
             ) # [N_edge, n_pairs]
         
-        overlap = self.nnsk_overlap.get_skhij(
-            rij=r,
-            paraArray=self.overlap_params[bond_ind_r_shp], # [N_edge, n_pairs, n_paras],
-            rs=r_cutoffs,
-            w=self.w,
-            r0=r0
-            )
+        return skints.reshape(*shape, -1)
+
+    def step(self, r, bond_indices=None):
+        if bond_indices is None:
+            bond_indices = self.curr_bond_indices
+        hopping = self._nnsk_skints(r, bond_indices, self.hopping_params)
+        overlap = self._nnsk_skints(r, bond_indices, self.overlap_params)
         return hopping, overlap
 
     def forward(self, r, bond_indices):
         self.curr_bond_indices = bond_indices
-        hopping, overlap = vmap(self.step,in_dims=1)(r)
+        hopping, overlap = self.step(r, bond_indices)
+        dftb_hopping, dftb_overlap = self.dftb.skints(r, bond_indices=bond_indices)
 
-        dftb_hopping = self.dftb(r, bond_indices = self.curr_bond_indices, mode="hopping").permute(1,0,2)
-        dftb_overlap = self.dftb(r, bond_indices = self.curr_bond_indices, mode="overlap").permute(1,0,2)
-
-        return hopping, overlap, dftb_hopping, dftb_overlap
+        return hopping.permute(1,0,2), overlap.permute(1,0,2), dftb_hopping.permute(1,0,2), dftb_overlap.permute(1,0,2)
     
-            
+    def get_r_range(self, bond_indices, r_min=None, r_max=None):
+        if r_min is None and r_max is None:
+            assert self.r_min is not None and self.r_max is not None, "When both r_min and r_max  are None. cal_rcuts=True when initializing the DFTB2NNSK object."
+            return self.r_min[bond_indices], self.r_max[bond_indices]
+        else:
+            assert r_min is not None and r_max is not None, "bothr_min and r_max should be provided or both None."
+            return torch.tensor(r_min, device=self.device, dtype=self.dtype), torch.tensor(r_max, device=self.device, dtype=self.dtype)
+
+    def warm_start(self, r, dftb_hopping, dftb_overlap, powers=(0., 0.5, 1., 2., 4.)):
+        """
+        Initialize the parameters of all the bond types by linear least squares on the grid r of shape (n_bond_types, n_r).
+
+        The powerlaw and polyNpow formulas are linear in all the parameters but the last one, which sets the power.
+        For each candidate power the linear parameters are solved in closed form, and for each integral the power
+        with the smallest residual is kept.
+
+        Returns:
+            bool: True if the parameters are initialized.
+        """
+        if self.functype not in ['powerlaw', 'poly1pow', 'poly2pow', 'poly3pow', 'poly4pow']:
+            log.warning(f"The warm start is not supported for the {self.functype} formula, the random initialization is kept.")
+            return False
+
+        bond_indices = torch.arange(r.shape[0], device=self.device)
+        num_paras = self.nnsk_hopping.num_paras
+        with torch.no_grad():
+            for params, ref in [(self.hopping_params, dftb_hopping), (self.overlap_params, dftb_overlap)]:
+                best_res = torch.full(ref.shape[::2], float("inf"), device=self.device, dtype=self.dtype)
+                for power in powers:
+                    # column j of the design matrix is the formula with the j-th linear parameter set to 1.
+                    basis = torch.zeros(num_paras-1, r.shape[0], 1, num_paras, device=self.device, dtype=self.dtype)
+                    basis[..., -1] = power
+                    for j in range(num_paras-1):
+                        basis[j, ..., j] = 1.
+                    design = torch.stack([self._nnsk_skints(r, bond_indices, basis[j])[..., 0] for j in range(num_paras-1)], dim=-1)
+                    sol = torch.linalg.lstsq(design, ref).solution # [n_bond, n_paras-1, n_pairs]
+                    res = (design @ sol - ref).square().sum(1) # [n_bond, n_pairs]
+                    mask = res < best_res
+                    best_res = torch.where(mask, res, best_res)
+                    params.data[..., :-1][mask] = sol.transpose(1, 2)[mask]
+                    params.data[..., -1][mask] = power
+        self.symmetrize()
+
+        return True
+
     def optimize(self, r_min=None, r_max=None, nstep=None, nsample=None, lr=None, dis_freq=None, viz=False):
         """
         Optimize the parameters of the neural network model.
@@ -258,6 +316,10 @@ class DFTB2NNSK(nn.Module):
             viz (bool): Whether to visualize the optimized results.
             max_elmt_batch (int): max_elmt_batch^2 defines The maximum number of bond types to optimize in each batch.
              ie. if max_elmt_batch=4, we will optimize 16 bond types in each batch.
+            fixed_grid (bool): read from train_options. If True, r is a fixed uniform grid of nsample points and the
+             dftb reference integrals are computed once, instead of resampling r every step.
+            warm_start (bool): read from train_options. If True, the parameters are initialized by linear least squares
+             on the fixed grid before the optimization, see `warm_start`.
 
         Returns:
             bool: True if the optimization is successful.
@@ -273,29 +335,43 @@ class DFTB2NNSK(nn.Module):
         if dis_freq is None:
             dis_freq = int(self.train_options["dis_freq"])
         if nsample is None:
-            nsample = int(self.train_options.get("n_samples",256))
+            nsample = int(self.train_options.get("nsample",256))
         
         save_freq = self.train_options.get("save_freq", 1)
+        fixed_grid = self.train_options.get("fixed_grid", False)
+        total_bond_types = len(self.idp_sk.bond_types)
+        batch_size = max_elmt_batch**2
+        if self.train_options["optimizer"].get("type") == "LBFGS":
+            # LBFGS needs a deterministic objective and keeps a single curvature history, 
+            # so all the bond types are fitted together on the fixed grid.
+            fixed_grid = True
+            batch_size = total_bond_types
 
         optimizer = get_optimizer(model_param=[self.hopping_params, self.overlap_params], **self.train_options["optimizer"])
         lrscheduler = get_lr_scheduler(optimizer=optimizer, **self.train_options["lr_scheduler"])  # add optmizer
 
+        if fixed_grid or self.train_options.get("warm_start", False):
+            all_bond_indices = torch.arange(total_bond_types, device=self.device)
+            r_min_, r_max_ = self.get_r_range(all_bond_indices, r_min=r_min, r_max=r_max)
+            r_grid = torch.linspace(0, 1, steps=nsample, device=self.device, dtype=self.dtype).reshape(1,-1) * (r_max_ - r_min_) + r_min_
+            r_grid = r_grid.expand(total_bond_types, -1).contiguous()
+            with torch.no_grad():
+                dftb_hopping_grid, dftb_overlap_grid = self.dftb.skints(r_grid, bond_indices=all_bond_indices)
+            if self.train_options.get("warm_start", False):
+                self.warm_start(r_grid, dftb_hopping_grid, dftb_overlap_grid)
+
         self.loss = torch.tensor(0., device=self.device, dtype=self.dtype)
         def closure():
             optimizer.zero_grad()
-            if r_min is None and r_max is None:
-                assert self.r_min is not None and self.r_max is not None, "When both r_min and r_max  are None. cal_rcuts=True when initializing the DFTB2NNSK object."
-                r_min_ = self.r_min[self.curr_bond_indices]
-                r_max_ = self.r_max[self.curr_bond_indices]
+            if fixed_grid:
+                hopping, overlap = self.step(r_grid[self.curr_bond_indices], self.curr_bond_indices)
+                dftb_hopping = dftb_hopping_grid[self.curr_bond_indices]
+                dftb_overlap = dftb_overlap_grid[self.curr_bond_indices]
             else:
-                assert r_min is not None and r_max is not None, "bothr_min and r_max should be provided or both None."
-                r_min_ = torch.tensor(r_min)
-                r_max_ = r_max
-            
-            # 用 gauss 分布的随机数，重点采样在 r_min 和 r_max范围中心区域的值
-            r = self.truncated_normal(shape=[len(self.curr_bond_indices),nsample], min_val=r_min_, max_val=r_max_, stdsigma=0.5, device=self.device, dtype=self.dtype)
-           
-            hopping, overlap, dftb_hopping, dftb_overlap = self(r, bond_indices=self.curr_bond_indices)
+                r_min_, r_max_ = self.get_r_range(self.curr_bond_indices, r_min=r_min, r_max=r_max)
+                # 用 gauss 分布的随机数，重点采样在 r_min 和 r_max范围中心区域的值
+                r = self.truncated_normal(shape=[len(self.curr_bond_indices),nsample], min_val=r_min_, max_val=r_max_, stdsigma=0.5, device=self.device, dtype=self.dtype)
+                hopping, overlap, dftb_hopping, dftb_overlap = self(r, bond_indices=self.curr_bond_indices)
 
             # self.loss = (hopping - dftb_hopping).abs().mean() + \
             #    torch.nn.functional.mse_loss(hopping, dftb_hopping).sqrt() + \
@@ -312,8 +388,6 @@ class DFTB2NNSK(nn.Module):
             self.loss.backward()
             return self.loss
 
-        total_bond_types = len(self.idp_sk.bond_types)
-    
         for istep in range(nstep):
             # 如果 total_bond_types 太大, 会导致内存不够, 可以考虑分批次优化, 每次优化一部分的bond_types
             # 我们定义一次优化最大的bond_types数量为 max_elmt_batch^2    
@@ -324,8 +398,8 @@ class DFTB2NNSK(nn.Module):
             total_ovl_mae = 0
             total_ovl_rmse = 0
 
-            for i in range(0, total_bond_types, max_elmt_batch**2):
-                curr_indices = torch.arange(i, min(i+max_elmt_batch**2, total_bond_types),device=self.device)
+            for i in range(0, total_bond_types, batch_size):
+                curr_indices = torch.arange(i, min(i+batch_size, total_bond_types),device=self.device)
                 self.curr_bond_indices = bond_indices_all[curr_indices]
                 optimizer.step(closure)
                 total_loss += self.loss.item()
@@ -335,7 +409,7 @@ class DFTB2NNSK(nn.Module):
                 total_ovl_rmse += self.loss_ovl_rmse.item()
 
                 if istep % dis_freq == 0:
-                    loginfo = (f"Batch {istep:6d}, subset [{i:3d}{min(i+max_elmt_batch**2, total_bond_types):3d}]: "
+                    loginfo = (f"Batch {istep:6d}, subset [{i:3d}{min(i+batch_size, total_bond_types):3d}]: "
                              f"Loss {self.loss.item():7.4f}, "
                              f"Hop MAE {self.loss_hop_mae.item():7.4f}, "
                              f"Hop RMSE {self.loss_hop_rmse.item():7.4f}, "
@@ -344,12 +418,12 @@ class DFTB2NNSK(nn.Module):
                              f"LR {lrscheduler.get_last_lr()[0]:8.6f}")
                     log.info(loginfo)
                         
-            if istep % dis_freq == 0 and total_bond_types > max_elmt_batch**2:
-                total_loss = total_loss / ((total_bond_types + max_elmt_batch**2 - 1) // max_elmt_batch**2)
-                total_hop_mae = total_hop_mae / ((total_bond_types + max_elmt_batch**2 - 1) // max_elmt_batch**2)
-                total_hop_rmse = total_hop_rmse / ((total_bond_types + max_elmt_batch**2 - 1) // max_elmt_batch**2)
-                total_ovl_mae = total_ovl_mae / ((total_bond_types + max_elmt_batch**2 - 1) // max_elmt_batch**2)
-                total_ovl_rmse = total_ovl_rmse / ((total_bond_types + max_elmt_batch**2 - 1) // max_elmt_batch**2)
+            if istep % dis_freq == 0 and total_bond_types > batch_size:
+                total_loss = total_loss / ((total_bond_types + batch_size - 1) // batch_size)
+                total_hop_mae = total_hop_mae / ((total_bond_types + batch_size - 1) // batch_size)
+                total_hop_rmse = total_hop_rmse / ((total_bond_types + batch_size - 1) // batch_size)
+                total_ovl_mae = total_ovl_mae / ((total_bond_types + batch_size - 1) // batch_size)
+                total_ovl_rmse = total_ovl_rmse / ((total_bond_types + batch_size - 1) // batch_size)
 
                 loginfo=(f"Batch {istep} Summary: "
                          f"Loss {total_loss:.4f}, "
@@ -382,21 +456,12 @@ class DFTB2NNSK(nn.Module):
             bond_type = f"{atom_a}-{atom_b}"
             bond_index = torch.tensor([self.idp_sk.bond_types.index(bond_type)])
             self.curr_bond_indices = bond_index
-            if r_min is None and r_max is None:
-                assert self.r_min is not None and self.r_max is not None, "When both r_min and r_max  are None. cal_rcuts=True when initializing the DFTB2NNSK object."
-                r_min_ = self.r_min[bond_index]
-                r_max_ = self.r_max[bond_index]
-            else:
-                assert r_min is not None and r_max is not None, "bothr_min and r_max should be provided or both None."
-                r_min_ = r_min
-                r_max_ = r_max
+            r_min_, r_max_ = self.get_r_range(bond_index, r_min=r_min, r_max=r_max)
 
             r = torch.linspace(0, 1, steps=100).reshape(1,-1).repeat(len(self.curr_bond_indices),1) * (r_max_ - r_min_) + r_min_
 
-            hops = vmap(self.step,in_dims=1)(r)
- 
-            dftb_hopping = self.dftb(r, bond_indices = self.curr_bond_indices, mode="hopping").permute(1,0,2)
-            dftb_overlap = self.dftb(r, bond_indices = self.curr_bond_indices, mode="overlap").permute(1,0,2)
+            hopping, overlap, dftb_hopping, dftb_overlap = self(r, bond_indices=self.curr_bond_indices)
+            hops = (hopping, overlap)
 
             r = r.numpy()
             fig = plt.figure(figsize=(6,4))
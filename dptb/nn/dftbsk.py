@@ -6,6 +6,7 @@ from .sktb import OnsiteFormula
 from dptb.nn.dftb.hopping_dftb import HoppingIntp
 from dptb.nn.hamiltonian import SKHamiltonian
 from dptb.nn.dftb.sk_param import SKParam
+from dptb.nn.dftb.sk_table import SKTable
 import logging
 
 log = logging.getLogger(__name__)
@@ -106,21 +107,16 @@ class DFTBSK(torch.nn.Module):
         edge_number = self.idp_sk.untransform_bond(edge_index).T
         rij = data[AtomicDataDict.EDGE_LENGTH_KEY]
 
-        data[AtomicDataDict.EDGE_FEATURES_KEY] = torch.zeros((len(edge_index), self.idp_sk.reduced_matrix_element), dtype=self.dtype, device=self.device)
-        
         if hasattr(self, "overlap"):
-            data[AtomicDataDict.EDGE_OVERLAP_KEY] = torch.zeros((len(edge_index), self.idp_sk.reduced_matrix_element), dtype=self.dtype, device=self.device)
             data[AtomicDataDict.NODE_OVERLAP_KEY] = self.overlaponsite_param[data[AtomicDataDict.ATOM_TYPE_KEY].flatten()]
             data[AtomicDataDict.NODE_OVERLAP_KEY][:,self.idp_sk.mask_diag] = 1.
 
-        for ibtype in self.idp_sk.bond_types:
-            ibtype_idx = self.idp_sk.bond_to_type[ibtype]
-            mask = edge_index == ibtype_idx
-            
-            data[AtomicDataDict.EDGE_FEATURES_KEY][mask] = self.hopping_fn.get_skhij(rij[mask], xx=self.distance_param, yy=self.hopping_param[ibtype_idx])
-            
-            if hasattr(self, "overlap"):
-                data[AtomicDataDict.EDGE_OVERLAP_KEY][mask] = self.hopping_fn.get_skhij(rij[mask], xx=self.distance_param, yy=self.overlap_param[ibtype_idx])
+        # all the bond types, and the hopping and overlap integrals, are evaluated by one table gather.
+        sktable = self._get_sktable()
+        if hasattr(self, "overlap"):
+            data[AtomicDataDict.EDGE_FEATURES_KEY], data[AtomicDataDict.EDGE_OVERLAP_KEY] = sktable(rij, edge_index)
+        else:
+            data[AtomicDataDict.EDGE_FEATURES_KEY] = sktable(rij, edge_index)
 
         atomic_numbers = self.idp_sk.untransform_atom(data[AtomicDataDict.ATOM_TYPE_KEY].flatten())
         
@@ -139,6 +135,22 @@ class DFTBSK(torch.nn.Module):
                 data = self.overlap(data)
 
         return data
+
+    def _get_sktable(self) -> SKTable:
+        """
+        The spline coefficients are rebuilt only when the sk param buffers are replaced or modified,
+        e.g. by `load_state_dict` or `to`.
+        """
+        tables = [self.hopping_param]
+        if hasattr(self, "overlap"):
+            tables.append(self.overlap_param)
+        key = tuple((t.data_ptr(), t._version) for t in [self.distance_param] + tables)
+        if getattr(self, "_sktable_key", None) != key:
+            self._sktable = SKTable(x=self.distance_param.to(self.dtype), y=[t.to(self.dtype) for t in tables], 
+                                   method=self.hopping_fn.intp_method)
+            self._sktable_key = key
+
+        return self._sktable
     
     @classmethod
     def from_reference(
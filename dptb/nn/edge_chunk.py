@@ -0,0 +1,26 @@
+from typing import Optional, List
+import torch
+from torch.utils.checkpoint import checkpoint as _checkpoint
+
+def edge_chunks(n_edge: int, max_edge_chunk: Optional[int]=None) -> List[slice]:
+    """
+    Split the `n_edge` active edges into slices of at most `max_edge_chunk` edges.
+
+    The per-edge work of the message passing layers is done one slice at a time, so that the intermediate
+    tensors (the rotated features and the messages of the tensor products) only exist for one slice.
+    A single slice is returned if `max_edge_chunk` is None.
+    """
+    if max_edge_chunk is None or n_edge <= max_edge_chunk:
+        return [slice(0, n_edge)]
+    assert max_edge_chunk > 0, "max_edge_chunk should be a positive integer."
+    return [slice(i, min(i + max_edge_chunk, n_edge)) for i in range(0, n_edge, max_edge_chunk)]
+
+def run_chunk(fn, *args, checkpoint: bool=False):
+    """call `fn(*args)`, and recompute its activations in the backward instead of keeping them if `checkpoint`."""
+    if checkpoint and torch.is_grad_enabled():
+        return _checkpoint(fn, *args, use_reentrant=False)
+    return fn(*args)
+
+def cat_chunks(tensors: List[torch.Tensor]) -> torch.Tensor:
+    """concatenate the outputs of the slices along the edge dimension, without a copy for a single slice."""
+    return tensors[0] if len(tensors) == 1 else torch.cat(tensors, dim=0)
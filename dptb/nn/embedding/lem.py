@@ -24,6 +24,7 @@ from dptb.data.transforms import OrbitalMapper
 from ..type_encode.one_hot import OneHotAtomEncoding
 from dptb.nn.norm import SeperableLayerNorm
 from dptb.data.AtomicDataDict import with_edge_vectors, with_batch
+from dptb.nn.edge_chunk import edge_chunks, run_chunk, cat_chunks
 
 from math import ceil
 
@@ -56,6 +57,9 @@ class Lem(torch.nn.Module):
             res_update: bool = True,
             res_update_ratios: Optional[List[float]] = None,
             res_update_ratios_learnable: bool = False,
+            # memory:
+            max_edge_chunk: Optional[int] = None,
+            edge_chunk_checkpoint: bool = False,
             dtype: Union[str, torch.dtype] = torch.float32,
             device: Union[str, torch.device] = torch.device("cpu"),
             **kwargs,
@@ -73,6 +77,10 @@ class Lem(torch.nn.Module):
         if isinstance(device, str):
             device = torch.device(device)
         self.device = device
+        # the edges are updated by chunks of at most max_edge_chunk edges, with the activations of each chunk
+        # recomputed in the backward if edge_chunk_checkpoint. Both can be changed on a trained model.
+        self.max_edge_chunk = max_edge_chunk
+        self.edge_chunk_checkpoint = edge_chunk_checkpoint
         
         if basis is not None:
             self.idp = OrbitalMapper(basis, method="e3tb")
@@ -204,7 +212,9 @@ class Lem(torch.nn.Module):
                     edge_vector, 
                     atom_type, 
                     cutoff_coeffs, 
-                    active_edges
+                    active_edges,
+                    max_edge_chunk=self.max_edge_chunk,
+                    checkpoint=self.edge_chunk_checkpoint,
                 )
 
         data[_keys.NODE_FEATURES_KEY] = self.out_node(node_features)
@@ -669,35 +679,42 @@ class UpdateNode(torch.nn.Module):
                 "_res_update_params", res_update_params
             )
 
-    def forward(self, latents, node_features, edge_features, atom_type, node_onehot, edge_index, edge_vector, active_edges):
-        edge_center = edge_index[0]
-        edge_neighbor = edge_index[1]
-
-        new_node_features = self.sln(node_features)
+    def _message(self, latents, new_node_features, edge_features, edge_center, edge_vector):
+        """the weighted messages of a chunk of active edges, all the edge inputs are restricted to the chunk."""
         message = self.tp(
             torch.cat(
-                [new_node_features[edge_center[active_edges]], self.sln_e(edge_features)]
-                , dim=-1), edge_vector[active_edges], latents[active_edges]) # full_out_irreps
+                [new_node_features[edge_center], self.sln_e(edge_features)]
+                , dim=-1), edge_vector, latents) # full_out_irreps
         
         message = self.activation(message)
         message = self.lin_post(message)
         scalars = message[:, :self.irreps_out[0].dim]
+        assert len(scalars.shape) == 2
 
         # get the attention scores
         # weights = self.env_embed_mlps(self.latent_act(latents[active_edges]))
         # weights = torch_geometric.utils.softmax(weights, edge_center[active_edges], num_nodes=node_features.shape[0])
-        weights = self.env_embed_mlps(latents[active_edges])
-        new_node_features = scatter(
-            self._env_weighter(message, weights),
-            edge_center[active_edges],
-            dim=0,
-        )
+        weights = self.env_embed_mlps(latents)
+        return self._env_weighter(message, weights)
+
+    def forward(self, latents, node_features, edge_features, atom_type, node_onehot, edge_index, edge_vector, active_edges, max_edge_chunk=None, checkpoint=False):
+        edge_center = edge_index[0]
+
+        new_node_features = self.sln(node_features)
+        # the messages are accumulated on the nodes chunk by chunk
+        messages = torch.zeros(node_features.shape[0], self.irreps_out.dim, dtype=node_features.dtype, device=node_features.device)
+        for chunk in edge_chunks(active_edges.shape[0], max_edge_chunk):
+            active = active_edges[chunk]
+            messages = messages.index_add(
+                0, edge_center[active],
+                run_chunk(self._message, latents[active], new_node_features, edge_features[chunk], edge_center[active], edge_vector[active], checkpoint=checkpoint)
+                )
+        new_node_features = messages
 
         if self.env_sum_normalizations.ndim < 1:
             norm_const = self.env_sum_normalizations
         else:
             norm_const = self.env_sum_normalizations[atom_type.flatten()].unsqueeze(-1)
-        assert len(scalars.shape) == 2
 
         new_node_features = new_node_features * norm_const
 
@@ -844,19 +861,16 @@ class UpdateEdge(torch.nn.Module):
                 "_res_update_params", res_update_params
             )
     
-    def forward(self, latents, node_features, node_onehot, edge_features, edge_index, edge_vector, cutoff_coeffs, active_edges):
-        edge_center = edge_index[0]
-        edge_neighbor = edge_index[1]
-
-        new_node_features = self.sln_n(node_features)
+    def _edge_update(self, latents, new_node_features, node_onehot, edge_features, edge_center, edge_neighbor, edge_vector, cutoff_coeffs):
+        """the updated features and latents of a chunk of active edges, all the edge inputs are restricted to the chunk."""
         new_edge_features = self.tp(
             torch.cat(
                 [
-                    new_node_features[edge_center[active_edges]],
+                    new_node_features[edge_center],
                     self.sln_e(edge_features),
-                    new_node_features[edge_neighbor[active_edges]]
+                    new_node_features[edge_neighbor]
                     ]
-                , dim=-1), edge_vector[active_edges], latents[active_edges]) # full_out_irreps
+                , dim=-1), edge_vector, latents) # full_out_irreps
         
         scalars = new_edge_features[:, :self.tp.irreps_out[0].dim]
         assert len(scalars.shape) == 2
@@ -866,36 +880,56 @@ class UpdateEdge(torch.nn.Module):
         scalars = new_edge_features[:, :self.irreps_in[0].dim]
         assert len(scalars.shape) == 2
 
-        weights = self.edge_embed_mlps(latents[active_edges])
+        weights = self.edge_embed_mlps(latents)
         new_edge_features = self._edge_weighter(new_edge_features, weights)
 
         # update latent
         latent_inputs_to_cat = [
-            node_onehot[edge_center[active_edges]],
-            self.ln(latents[active_edges]),
+            node_onehot[edge_center],
+            self.ln(latents),
             scalars,
-            node_onehot[edge_neighbor[active_edges]],
+            node_onehot[edge_neighbor],
         ]
 
         new_latents = self.latents(torch.cat(latent_inputs_to_cat, dim=-1))
-        new_latents = cutoff_coeffs[active_edges].unsqueeze(-1) * new_latents
+        new_latents = cutoff_coeffs.unsqueeze(-1) * new_latents
         
         if self.res_update:
             update_coefficients = self._res_update_params.sigmoid()
             coefficient_old = torch.rsqrt(update_coefficients.square() + 1)
             coefficient_new = update_coefficients * coefficient_old
             edge_features = coefficient_new * new_edge_features + coefficient_old * self.linear_res(edge_features)
-
-            latents = torch.index_copy(
-                latents, 0, active_edges, 
-                coefficient_new * new_latents + coefficient_old * latents[active_edges]
-            )
+            new_latents = coefficient_new * new_latents + coefficient_old * latents
         else:
             edge_features = new_edge_features
-            latents = torch.index_copy(
-                latents, 0, active_edges, 
-                new_latents
-            )
+
+        return edge_features, new_latents
+
+    def forward(self, latents, node_features, node_onehot, edge_features, edge_index, edge_vector, cutoff_coeffs, active_edges, max_edge_chunk=None, checkpoint=False):
+        edge_center = edge_index[0]
+        edge_neighbor = edge_index[1]
+
+        new_node_features = self.sln_n(node_features)
+        edge_chunk_features, latent_chunks = [], []
+        for chunk in edge_chunks(active_edges.shape[0], max_edge_chunk):
+            active = active_edges[chunk]
+            chunk_features, chunk_latents = run_chunk(
+                self._edge_update,
+                latents[active],
+                new_node_features,
+                node_onehot,
+                edge_features[chunk],
+                edge_center[active],
+                edge_neighbor[active],
+                edge_vector[active],
+                cutoff_coeffs[active],
+                checkpoint=checkpoint,
+                )
+            edge_chunk_features.append(chunk_features)
+            latent_chunks.append(chunk_latents)
+
+        edge_features = cat_chunks(edge_chunk_features)
+        latents = torch.index_copy(latents, 0, active_edges, cat_chunks(latent_chunks))
 
         return edge_features, latents
     
@@ -964,9 +998,9 @@ class Layer(torch.nn.Module):
             device=device,
         )
 
-    def forward(self, latents, node_features, edge_features, node_onehot, edge_index, edge_vector, atom_type, cutoff_coeffs, active_edges):
+    def forward(self, latents, node_features, edge_features, node_onehot, edge_index, edge_vector, atom_type, cutoff_coeffs, active_edges, max_edge_chunk=None, checkpoint=False):
         
-        edge_features, latents = self.edge_update(latents, node_features, node_onehot, edge_features, edge_index, edge_vector, cutoff_coeffs, active_edges)
-        node_features = self.node_update(latents, node_features, edge_features, atom_type, node_onehot, edge_index, edge_vector, active_edges)
+        edge_features, latents = self.edge_update(latents, node_features, node_onehot, edge_features, edge_index, edge_vector, cutoff_coeffs, active_edges, max_edge_chunk=max_edge_chunk, checkpoint=checkpoint)
+        node_features = self.node_update(latents, node_features, edge_features, atom_type, node_onehot, edge_index, edge_vector, active_edges, max_edge_chunk=max_edge_chunk, checkpoint=checkpoint)
 
         return latents, node_features, edge_features
\ No newline at end of file
@@ -7,10 +7,50 @@ import torch
 import numpy as np
 import torch.nn as nn
 from dptb.nn.hr2hk import HR2HK
-from typing import Union, Optional, Dict, List
+from typing import Union, Optional, Dict, List, Tuple
 from dptb.data.transforms import OrbitalMapper
 from dptb.data import AtomicDataDict
 
+class BroadenedEigvalsh(torch.autograd.Function):
+    """
+    The eigenvalues of a batch of hermitian matrices, with a backward that stays stable at degeneracies.
+
+    The backward of an eigenvalue is dA = v v^H, which depends on the arbitrary basis chosen by the solver
+    inside a degenerate subspace. Here the gradients of the eigenvalues are first averaged with the Lorentzian
+    weights eta^2 / ((e_i - e_j)^2 + eta^2), so that the gradient of a degenerate subspace is spread evenly over
+    its projector, and the backward dA = V diag(g) V^H reuses the eigenvectors of the forward.
+    """
+
+    @staticmethod
+    def forward(ctx, A, broadening):
+        eigvals, eigvecs = torch.linalg.eigh(A)
+        ctx.save_for_backward(eigvals, eigvecs)
+        ctx.broadening = broadening
+        return eigvals
+
+    @staticmethod
+    def backward(ctx, grad_eigvals):
+        eigvals, eigvecs = ctx.saved_tensors
+        if ctx.broadening > 0:
+            diff = eigvals.unsqueeze(-1) - eigvals.unsqueeze(-2)
+            weight = ctx.broadening**2 / (diff**2 + ctx.broadening**2)
+            grad_eigvals = (weight @ grad_eigvals.unsqueeze(-1)).squeeze(-1) / weight.sum(dim=-1)
+        grad_A = (eigvecs * grad_eigvals.unsqueeze(-2).type_as(eigvecs)) @ eigvecs.transpose(-1, -2).conj()
+        return grad_A, None
+
+def eigvalsh(A: torch.Tensor, broadening: float=1e-4) -> torch.Tensor:
+    """the eigenvalues of the hermitian matrices A, differentiable with `BroadenedEigvalsh` when a gradient is required."""
+    if torch.is_grad_enabled() and A.requires_grad:
+        return BroadenedEigvalsh.apply(A, broadening)
+    return torch.linalg.eigvalsh(A)
+
+def cholesky_reduce(H: torch.Tensor, S: torch.Tensor) -> torch.Tensor:
+    """reduce the generalized eigenproblem H x = e S x to the standard one of L^-1 H L^-H, with S = L L^H."""
+    L = torch.linalg.cholesky(S)
+    X = torch.linalg.solve_triangular(L, H, upper=False)
+    return torch.linalg.solve_triangular(L, X.transpose(-1, -2).conj(), upper=False).transpose(-1, -2).conj()
+
+
 class Eigenvalues(nn.Module):
     def __init__(
             self,
@@ -22,9 +62,11 @@ class Eigenvalues(nn.Module):
             s_edge_field: str = None,
             s_node_field: str = None,
             s_out_field: str = None,
+            broadening: float = 1e-4,
             dtype: Union[str, torch.dtype] = torch.float32, 
             device: Union[str, torch.device] = torch.device("cpu")):
         super(Eigenvalues, self).__init__()
+        self.broadening = broadening
 
         self.h2k = HR2HK(
             idp=idp, 
@@ -72,17 +114,56 @@ class Eigenvalues(nn.Module):
             data = self.h2k(data)
             if self.overlap:
                 data = self.s2k(data)
-                chklowt = torch.linalg.cholesky(data[self.s_out_field])
-                chklowtinv = torch.linalg.inv(chklowt)
-                data[self.h_out_field] = (chklowtinv @ data[self.h_out_field] @ torch.transpose(chklowtinv,dim0=1,dim1=2).conj())
+                data[self.h_out_field] = cholesky_reduce(data[self.h_out_field], data[self.s_out_field])
             else:
                 data[self.h_out_field] = data[self.h_out_field]
             
-            eigvals.append(torch.linalg.eigvalsh(data[self.h_out_field]))
+            eigvals.append(eigvalsh(data[self.h_out_field], self.broadening))
         data[self.out_field] = torch.nested.as_nested_tensor([torch.cat(eigvals, dim=0)])
         if nested:
             data[AtomicDataDict.KPOINT_KEY] = torch.nested.as_nested_tensor([kpoints])
         else:
             data[AtomicDataDict.KPOINT_KEY] = kpoints
 
-        return data
\ No newline at end of file
+        return data
+
+    def batched(self, data: AtomicDataDict.Type) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+        """
+        Compute the eigenvalues of all structures in a batch, grouping the structures with the same number of
+        orbitals and k-points into one batched H(k) construction and diagonalization.
+
+        Returns
+        -------
+        List[Tuple[torch.Tensor, torch.Tensor]]
+            the graph indices of each group and their eigenvalues of shape [len(group), nk, norb].
+        """
+        atom_types = data[AtomicDataDict.ATOM_TYPE_KEY].flatten()
+        batch = data.get(AtomicDataDict.BATCH_KEY)
+        if batch is None:
+            batch = torch.zeros_like(atom_types)
+        num_graphs = int(batch.max()) + 1
+        norb = torch.zeros(num_graphs, dtype=torch.long, device=batch.device).index_add_(
+            0, batch, self.h2k.idp.atom_norb[atom_types])
+        kpoints = data[AtomicDataDict.KPOINT_KEY]
+        if kpoints.is_nested:
+            nk = [kp.shape[0] for kp in kpoints.unbind()]
+        else:
+            nk = [kpoints.shape[0]] * num_graphs
+
+        groups = {}
+        for g, key in enumerate(zip(norb.tolist(), nk)):
+            groups.setdefault(key, []).append(g)
+        groups = [torch.tensor(g, dtype=torch.long, device=batch.device) for g in groups.values()]
+
+        hks = self.h2k.batched(data, groups)
+        if self.overlap:
+            sks = self.s2k.batched(data, groups)
+
+        out = []
+        for i, group in enumerate(groups):
+            hk = hks[i]
+            if self.overlap:
+                hk = cholesky_reduce(hk, sks[i])
+            out.append((group, eigvalsh(hk, self.broadening)))
+
+        return out
@@ -13,7 +13,7 @@ from dptb.data.transforms import OrbitalMapper
 from dptb.data import AtomicDataDict
 import re
 from torch_runstats.scatter import scatter
-from dptb.nn.tensor_product import wigner_D
+from dptb.nn.tensor_product import wigner_D, sk_rotation_matrices
 from dptb.nn.sktb.socbasic import get_soc_matrix_cubic_basis
 from dptb.utils.tools import float2comlex
 #TODO: 1. jit acceleration 2. GPU support 3. rotate AB and BA bond together.
@@ -67,7 +67,8 @@ class E3Hamiltonian(torch.nn.Module):
         orbpairtypes = self.idp.orbpairtype_maps.keys()
         for orbpair in orbpairtypes:
             self._initialize_CG_basis(orbpair)
-            
+        self._initialize_CG_matrix()
+
 
     def forward(self, data: AtomicDataDict.Type) -> AtomicDataDict.Type:
         """
@@ -91,92 +92,79 @@ class E3Hamiltonian(torch.nn.Module):
             assert data[self.node_field].shape[1] == self.idp.reduced_matrix_element
 
         n_edge = data[AtomicDataDict.EDGE_INDEX_KEY].shape[1]
-        n_node = data[AtomicDataDict.NODE_FEATURES_KEY].shape[0]
 
         data = AtomicDataDict.with_edge_vectors(data, with_lengths=True)
 
-        if not self.decompose:
-            # The EDGE_FEATURES_KEY and NODE_FAETURE_KEY are the reduced matrix elements
+        features = data[self.edge_field]
+        if self.decompose and self.rotation:
+            features = self._rotate_blocks(features, data[AtomicDataDict.EDGE_VECTORS_KEY])
 
-            # compute hopping blocks
-            for opairtype in self.idp.orbpairtype_maps.keys():
-                # currently, "a-b" and "b-a" orbital pair are computed seperately, it is able to combined further
-                # for better performance
-                l1, l2 = anglrMId[opairtype[0]], anglrMId[opairtype[2]]
-                n_rme = (2*l1+1) * (2*l2+1) # number of reduced matrix element
-                rme = data[self.edge_field][:, self.idp.orbpairtype_maps[opairtype]]
-                rme = rme.reshape(n_edge, -1, n_rme)
-                rme = rme.transpose(1,2) # shape (N, n_rme, n_pair)
-                
-                HR = torch.sum(self.cgbasis[opairtype][None,:,:,:,None] * \
-                    rme[:,None, None, :, :], dim=-2) # shape (N, 2l1+1, 2l2+1, n_pair)
-                
-                # rotation
-                # angle = xyz_to_angles(data[AtomicDataDict.EDGE_VECTORS_KEY][:,[1,2,0]]) # (tensor(N), tensor(N))
-                # rot_mat_L = Irrep(int(l1), 1).D_from_angles(angle[0], angle[1], torch.tensor(0., dtype=self.dtype, device=self.device)) # tensor(N, 2l1+1, 2l1+1)
-                # rot_mat_R = Irrep(int(l2), 1).D_from_angles(angle[0], angle[1], torch.tensor(0., dtype=self.dtype, device=self.device)) # tensor(N, 2l2+1, 2l2+1)
-                # HR = torch.einsum("nlm, nmoq, nko -> nqlk", rot_mat_L, H_z, rot_mat_R).reshape(n_edge, -1) # shape (N, n_pair * n_rme)
-                HR = HR.permute(0,3,1,2).reshape(n_edge, -1)
-                data[self.edge_field][:, self.idp.orbpairtype_maps[opairtype]] = HR
-
-            # compute onsite blocks
-            if not self.overlap:
-                for opairtype in self.idp.orbpairtype_maps.keys():
-                    # currently, "a-b" and "b-a" orbital pair are computed seperately, it is able to combined further
-                    # for better performance
-                    l1, l2 = anglrMId[opairtype[0]], anglrMId[opairtype[2]]
-                    
-                    n_rme = (2*l1+1) * (2*l2+1) # number of reduced matrix element
-                    rme = data[self.node_field][:, self.idp.orbpairtype_maps[opairtype]]
-                    rme = rme.reshape(n_node, -1, n_rme)
-                    rme = rme.transpose(1,2) # shape (N, n_rme, n_pair)
-                    
-                    HR = torch.sum(self.cgbasis[opairtype][None,:,:,:,None] * \
-                        rme[:,None, None, :, :], dim=-2) # shape (N, 2l1+1, 2l2+1, n_pair)
-                    HR = HR.permute(0,3,1,2).reshape(n_node, -1)
-
-                    # the onsite block does not have rotation
-                    data[self.node_field][:, self.idp.orbpairtype_maps[opairtype]] = HR
-        
-        else:
-            for opairtype in self.idp.orbpairtype_maps.keys():
-                l1, l2 = anglrMId[opairtype[0]], anglrMId[opairtype[2]]
-                nL, nR = 2*l1+1, 2*l2+1
-                HR = data[self.edge_field][:, self.idp.orbpairtype_maps[opairtype]]
-                HR = HR.reshape(n_edge, -1, nL, nR) # shape (N, n_pair, nL, nR)
-
-                # rotation
-                if self.rotation:
-                    angle = xyz_to_angles(data[AtomicDataDict.EDGE_VECTORS_KEY][:,[1,2,0]]) # (tensor(N), tensor(N))
-                    rot_mat_L = wigner_D(int(l1), angle[0], angle[1], torch.zeros_like(angle[0]))
-                    rot_mat_R = wigner_D(int(l2), angle[0], angle[1], torch.zeros_like(angle[0]))
-                    HR = torch.einsum("nml, nqmo, nok -> nlkq", rot_mat_L, HR, rot_mat_R) # shape (N, nL, nR, n_pair)
-                else:
-                    HR = HR.permute(0,2,3,1) # shape (N, nL, nR, n_pair)
-                    
-                rme = torch.sum(self.cgbasis[opairtype][None,:,:,:,None] * \
-                    HR[:,:,:,None,:], dim=(1,2)) # shape (N, n_rme, n_pair)
-                rme = rme.transpose(1,2).reshape(n_edge, -1)
-
-                data[self.edge_field][:, self.idp.orbpairtype_maps[opairtype]] = rme
-
-            if not self.overlap:
-                for opairtype in self.idp.orbpairtype_maps.keys():
-                    # currently, "a-b" and "b-a" orbital pair are computed seperately, it is able to combined further
-                    # for better performance
-                    l1, l2 = anglrMId[opairtype[0]], anglrMId[opairtype[2]]
-                    nL, nR = 2*l1+1, 2*l2+1 # number of reduced matrix element
-                    HR = data[self.node_field][:, self.idp.orbpairtype_maps[opairtype]]
-                    HR = HR.reshape(n_node, -1, nL, nR).permute(0,2,3,1)# shape (N, nL, nR, n_pair)
-                    
-                    rme = torch.sum(self.cgbasis[opairtype][None,:,:,:,None] * \
-                        HR[:,:,:,None,:], dim=(1,2)) # shape (N, n_rme, n_pair)
-                    rme = rme.transpose(1,2).reshape(n_node, -1)
-
-                    # the onsite block doesnot have rotation
-                    data[self.node_field][:, self.idp.orbpairtype_maps[opairtype]] = rme
+        # the hopping and onsite blocks share the same orbital pair layout, so they are transformed in one pass
+        if not self.overlap:
+            features = torch.cat([features, data[self.node_field]], dim=0)
+
+        features = self._transform(features)
+
+        data[self.edge_field] = features[:n_edge]
+        if not self.overlap:
+            data[self.node_field] = features[n_edge:]
 
         return data
+
+    def _initialize_CG_matrix(self):
+        """
+        Flatten the CG basis of each orbital pair type into a dense (n_rme, n_rme) matrix, where n_rme = (2l1+1)*(2l2+1).
+
+        In the e3tb layout, the features of one orbital pair type occupy a contiguous slice, ordered as (n_pair, 2l1+1, 2l2+1),
+        and the pair types are stored with l1 <= l2 only, so each (l1, l2) group is exactly one slice of the feature.
+        The composition is then rme @ C.T, and the decomposition HR @ C, with C of shape (n_hr, n_rme).
+        """
+        self.cg_slices = []
+        self.cg_matrices = []
+        for opairtype, sl in sorted(self.idp.orbpairtype_maps.items(), key=lambda x: x[1].start):
+            cg = self.cgbasis[opairtype]
+            n_rme = cg.shape[0] * cg.shape[1]
+            self.cg_slices.append((sl.start, sl.stop, n_rme))
+            self.cg_matrices.append(cg.reshape(n_rme, -1))
+
+        assert self.cg_slices[0][0] == 0 and self.cg_slices[-1][1] == self.idp.reduced_matrix_element
+        assert all(self.cg_slices[i][1] == self.cg_slices[i+1][0] for i in range(len(self.cg_slices)-1))
+
+    def _transform(self, features: torch.Tensor) -> torch.Tensor:
+        """
+        Transform the reduced matrix elements into the hamiltonian blocks (decompose=False) or the reverse (decompose=True)
+        for all the orbital pair types, with one matmul per type.
+        """
+        n = features.shape[0]
+        out = []
+        for (start, stop, n_rme), cg in zip(self.cg_slices, self.cg_matrices):
+            cg = cg.to(features.dtype)
+            block = features[:, start:stop].reshape(n, -1, n_rme) # shape (N, n_pair, n_rme)
+            if self.decompose:
+                block = block @ cg
+            else:
+                block = block @ cg.T
+            out.append(block.reshape(n, -1))
+
+        return torch.cat(out, dim=1)
+
+    def _rotate_blocks(self, features: torch.Tensor, vectors: torch.Tensor) -> torch.Tensor:
+        """
+        Rotate the hopping blocks from the bond frame to the lab frame before the decomposition, only used for test.
+        """
+        n_edge = features.shape[0]
+        angle = xyz_to_angles(vectors[:,[1,2,0]]) # (tensor(N), tensor(N))
+        out = []
+        for opairtype, sl in sorted(self.idp.orbpairtype_maps.items(), key=lambda x: x[1].start):
+            l1, l2 = anglrMId[opairtype[0]], anglrMId[opairtype[2]]
+            nL, nR = 2*l1+1, 2*l2+1
+            HR = features[:, sl].reshape(n_edge, -1, nL, nR) # shape (N, n_pair, nL, nR)
+            rot_mat_L = wigner_D(int(l1), angle[0], angle[1], torch.zeros_like(angle[0]))
+            rot_mat_R = wigner_D(int(l2), angle[0], angle[1], torch.zeros_like(angle[0]))
+            HR = torch.einsum("nml, nqmo, nok -> nqlk", rot_mat_L, HR, rot_mat_R) # shape (N, n_pair, nL, nR)
+            out.append(HR.reshape(n_edge, -1))
+
+        return torch.cat(out, dim=1)
             
     def _initialize_CG_basis(self, pairtype: str):
         """
@@ -487,6 +475,8 @@ class SKHamiltonian(torch.nn.Module):
             # self.cgbasis.setdefault(pairtype, None)
             bb = self._initialize_basis(pairtype)
             self.skbasis[pairtype] = bb
+        self.lmax = max([max(anglrMId[pairtype[0]], anglrMId[pairtype[2]]) for pairtype in pairtypes])
+        self._initialize_fused_rotation()
 
         if self.soc:
             self.soc_base_matrix = {
@@ -495,6 +485,7 @@ class SKHamiltonian(torch.nn.Module):
                 'd':get_soc_matrix_cubic_basis(orbital='d', device=self.device, dtype=self.dtype)
             }
             self.cdtype =  float2comlex(self.dtype)
+        self._initialize_onsite_index()
 
     def forward(self, data: AtomicDataDict.Type) -> AtomicDataDict.Type:
         # transform sk parameters to irreducible matrix element
@@ -503,97 +494,140 @@ class SKHamiltonian(torch.nn.Module):
         if self.onsite:
             assert data[self.node_field].shape[1] == self.idp_sk.n_onsite_Es
             n_node = data[self.node_field].shape[0]
-            
-        n_edge = data[self.edge_field].shape[0]
-        
 
-        edge_features = data[self.edge_field].clone()
-        data[self.edge_field] = torch.zeros((n_edge, self.idp.reduced_matrix_element), dtype=self.dtype, device=self.device)
+        edge_features = data[self.edge_field]
 
         # for hopping blocks
-        for opairtype in self.idp_sk.orbpairtype_maps.keys():
-            l1, l2 = anglrMId[opairtype[0]], anglrMId[opairtype[2]]
-            n_skp = min(l1, l2)+1 # number of reduced matrix element
-            skparam = edge_features[:, self.idp_sk.orbpairtype_maps[opairtype]].reshape(n_edge, -1, n_skp)
-            skparam = skparam.transpose(1,2) # shape (N, n_skp, n_pair)
-            
-            H_z = torch.sum(self.skbasis[opairtype][None,:,:,:,None] * \
-                skparam[:,None, None, :, :], dim=-2) # shape (N, 2l1+1, 2l2+1, n_pair)
-            
-            # rotation
-            # when get the angle, the xyz vector should be transformed to yzx.
-            angle = xyz_to_angles(data[AtomicDataDict.EDGE_VECTORS_KEY][:,[1,2,0]]) # (tensor(N), tensor(N))
-            # The roataion matrix is SO3 rotation, therefore Irreps(l,1), is used here.
-            rot_mat_L = wigner_D(int(l1), angle[0], angle[1], torch.zeros_like(angle[0]))
-            rot_mat_R = wigner_D(int(l2), angle[0], angle[1], torch.zeros_like(angle[0]))
-            # rot_mat_L = Irrep(int(l1), 1).D_from_angles(angle[0].cpu(), angle[1].cpu(), torch.tensor(0., dtype=self.dtype)).to(self.device) # tensor(N, 2l1+1, 2l1+1)
-            # rot_mat_R = Irrep(int(l2), 1).D_from_angles(angle[0].cpu(), angle[1].cpu(), torch.tensor(0., dtype=self.dtype)).to(self.device) # tensor(N, 2l2+1, 2l2+1)
-            
-            # Here The string to control einsum is important, the order of the index should be the same as the order of the tensor
-            # H_z = torch.einsum("nlm, nmoq, nko -> nqlk", rot_mat_L, H_z, rot_mat_R) # shape (N, n_pair, 2l1+1, 2l2+1)
-            HR = torch.einsum("nlm, nmoq, nko -> nqlk", rot_mat_L, H_z, rot_mat_R).reshape(n_edge, -1) # shape (N, n_pair * 2l2+1 * 2l2+1)
-            
-            if l1 < l2:
-                HR = HR * (-1)**(l1+l2)
-            
-            data[self.edge_field][:, self.idp.orbpairtype_maps[opairtype]] = HR
+        # all orbital pair types are rotated together, see `_initialize_fused_rotation`
+        rot_mats = self._rotation_matrices(data, AtomicDataDict.EDGE_VECTORS_KEY, AtomicDataDict.EDGE_ROTATION_KEY)
+        data[self.edge_field] = self._fused_rotation(edge_features, rot_mats) * self.fused_sign
 
-        # compute onsite blocks
+        # compute onsite blocks, the onsite block doesnot have rotation, see `_initialize_onsite_index`
         if self.onsite:
-            node_feature = data[self.node_field].clone()
-            data[self.node_field] = torch.zeros(n_node, self.idp.reduced_matrix_element, dtype=self.dtype, device=self.device)
-
-            for orbtype in self.idp_sk.skonsitetype_maps.keys():
-                # currently, "a-b" and "b-a" orbital pair are computed seperately, it is able to combined further
-                # for better performance
-                l = anglrMId[re.findall(r"[a-z]", orbtype)[0]]
-
-                skparam = node_feature[:, self.idp_sk.skonsitetype_maps[orbtype]].reshape(n_node, -1, 1)
-                HR = torch.eye(2*l+1, dtype=self.dtype, device=self.device)[None, None, :, :] * skparam[:,:, None, :] # shape (N, n_pair, 2l1+1, 2l2+1)
-                # the onsite block doesnot have rotation
-
-                data[self.node_field][:, self.idp.orbpairtype_maps[orbtype+"-"+orbtype]] = HR.reshape(n_node, -1)
+            # the overlap models give the onsite parameters as [N, n_onsite, 1], so flatten them before the padding
+            node_feature = data[self.node_field].reshape(n_node, -1)
+            node_feature = torch.cat([node_feature, node_feature.new_zeros(n_node, 1)], dim=1)
+            data[self.node_field] = node_feature[:, self.onsite_index].type(self.dtype)
 
         if self.soc:
             assert data[AtomicDataDict.NODE_SOC_SWITCH_KEY].all(), "The SOC switch is not turned on in data by soc is set to True."
-            soc_feature = data[AtomicDataDict.NODE_SOC_KEY]
-            data[AtomicDataDict.NODE_SOC_KEY] = torch.zeros(n_node, self.idp.reduced_soc_matrix_elemet, dtype= self.cdtype, device=self.device)
-            for otype in self.idp_sk.sksoc_maps.keys():
-                lsymbol = re.findall(r"[a-z]", otype)[0]
-                l = anglrMId[lsymbol]
-                socparam = soc_feature[:, self.idp_sk.sksoc_maps[otype]].reshape(n_node, -1, 1)
-                HR = self.soc_base_matrix[lsymbol][None, None, :, :] * socparam[:,:, None, :]
-                HR_upup_updn = HR[:,:,0:2*l+1,:]
-                data[AtomicDataDict.NODE_SOC_KEY][:, self.idp.orbpair_soc_maps[otype+"-"+otype]] = HR_upup_updn.reshape(n_node, -1)
+            soc_feature = data[AtomicDataDict.NODE_SOC_KEY].reshape(n_node, -1)
+            data[AtomicDataDict.NODE_SOC_KEY] = soc_feature[:, self.soc_index] * self.soc_coeff
 
         # compute if strain effect is included
         # this is a little wired operation, since it acting on somekind of a edge(strain env) feature, and summed up to return a node feature.
         if self.strain:
-            n_onsitenv = len(data[AtomicDataDict.ONSITENV_FEATURES_KEY])
-            for opairtype in self.idp.orbpairtype_maps.keys(): # save all env direction and pair direction like sp and ps, but only get sp
-                l1, l2 = anglrMId[opairtype[0]], anglrMId[opairtype[2]]
-                # opairtype = opair[1]+"-"+opair[4]
-                n_skp = min(l1, l2)+1 # number of reduced matrix element
-                skparam = data[AtomicDataDict.ONSITENV_FEATURES_KEY][:, self.idp_sk.orbpairtype_maps[opairtype]].reshape(n_onsitenv, -1, n_skp)
-                skparam = skparam.transpose(1,2) # shape (N, n_skp, n_pair)
+            rot_mats = self._rotation_matrices(data, AtomicDataDict.ONSITENV_VECTORS_KEY, AtomicDataDict.ONSITENV_ROTATION_KEY)
+            HR = self._fused_rotation(data[AtomicDataDict.ONSITENV_FEATURES_KEY], rot_mats) # shape (N_env, reduced_matrix_element)
+            # A-B o1-o2 (A-B o2-o1)= (B-A o1-o2)
+            data[self.node_field] = data[self.node_field] + scatter(
+                src=HR, index=data[AtomicDataDict.ONSITENV_INDEX_KEY][0], dim=0, dim_size=n_node, reduce="sum")
 
-                H_z = torch.sum(self.skbasis[opairtype][None,:,:,:,None] * \
-                    skparam[:,None, None, :, :], dim=-2) # shape (N, 2l1+1, 2l2+1, n_pair)
-                
-                angle = xyz_to_angles(data[AtomicDataDict.ONSITENV_VECTORS_KEY][:,[1,2,0]]) # (tensor(N), tensor(N))
-                rot_mat_L = wigner_D(int(l1), angle[0], angle[1], torch.zeros_like(angle[0]))
-                rot_mat_R = wigner_D(int(l2), angle[0], angle[1], torch.zeros_like(angle[0]))
-                # rot_mat_L = Irrep(int(l1), 1).D_from_angles(angle[0].cpu(), angle[1].cpu(), torch.tensor(0., dtype=self.dtype)).to(self.device) # tensor(N, 2l1+1, 2l1+1)
-                # rot_mat_R = Irrep(int(l2), 1).D_from_angles(angle[0].cpu(), angle[1].cpu(), torch.tensor(0., dtype=self.dtype)).to(self.device) # tensor(N, 2l2+1, 2l2+1)
+        return data
 
-                HR = torch.einsum("nlm, nmoq, nko -> nqlk", rot_mat_L, H_z, rot_mat_R) # shape (N, n_pair, 2l1+1, 2l2+1)
+    def _rotation_matrices(self, data: AtomicDataDict.Type, vectors_field: str, rotation_field: str):
+        """The flattened rotation matrices D^l (l = 0..lmax) of the vectors in ``vectors_field``, taken from the
+        precomputed ``rotation_field`` when the data carries a geometry cache."""
+        rotations = data.get(rotation_field)
+        if rotations is None or rotations.shape[1] < self.n_rot:
+            rotations = sk_rotation_matrices(data[vectors_field], self.lmax)
+        return rotations[:, :self.n_rot].type(self.dtype)
 
-                HR = scatter(src=HR, index=data[AtomicDataDict.ONSITENV_INDEX_KEY][0], dim=0, reduce="sum") # shape (n_node, n_pair, 2l1+1, 2l2+1)
-                # A-B o1-o2 (A-B o2-o1)= (B-A o1-o2)
-                
-                data[self.node_field][:, self.idp.orbpairtype_maps[opairtype]] += HR.flatten(1, len(HR.shape)-1) # the index type [node/pair] should align with the index of for loop
-            
-        return data
+    def _initialize_fused_rotation(self):
+        """
+        Build the index maps used to rotate the sk parameters of all orbital pair types in one go.
+
+        A block of the pair type l1-l2 is rotated as HR = D^l1 H_z D^l2.T, where H_z only has the elements
+        (l1+m, l2+m), |m| <= min(l1, l2), equal to the sk parameter of |m|. Each element of the e3 layout of
+        ``self.idp`` is therefore
+            HR[a, b] = sum_m sk[|m|] * D^l1[a, l1+m] * D^l2[b, l2+m],
+        a sum over at most 2lmax+1 products of gathered sk parameters and rotation matrix elements. For every m,
+        the indices of these three factors are precomputed for all the elements with |m| <= min(l1, l2).
+        """
+        L = self.lmax
+        rot_start = [sum([(2*k+1)**2 for k in range(l)]) for l in range(L+1)]
+        self.n_rot = rot_start[-1] + (2*L+1)**2
+
+        n_elem = self.idp.reduced_matrix_element
+        # elements not produced by any sk parameter point to the trailing zero slot of the padded parameters
+        sk_index = torch.full((2*L+1, n_elem), self.idp_sk.reduced_matrix_element, dtype=torch.long)
+        left_index = torch.zeros((2*L+1, n_elem), dtype=torch.long)
+        right_index = torch.zeros((2*L+1, n_elem), dtype=torch.long)
+        sign = torch.ones(n_elem, dtype=self.dtype)
+        for opairtype, sli in self.idp_sk.orbpairtype_maps.items():
+            l1, l2 = anglrMId[opairtype[0]], anglrMId[opairtype[2]]
+            n_skp = min(l1, l2)+1 # number of reduced matrix element
+            n_pair = (sli.stop - sli.start) // n_skp
+
+            # the e3 elements of this pair type are ordered as (n_pair, 2l1+1, 2l2+1)
+            q, a, b = torch.meshgrid(torch.arange(n_pair), torch.arange(2*l1+1), torch.arange(2*l2+1), indexing="ij")
+            q, a, b = q.flatten(), a.flatten(), b.flatten()
+            e3 = self.idp.orbpairtype_maps[opairtype]
+            for m in range(-n_skp+1, n_skp):
+                sk_index[L+m, e3] = sli.start + q * n_skp + abs(m)
+                left_index[L+m, e3] = rot_start[l1] + a * (2*l1+1) + l1 + m
+                right_index[L+m, e3] = rot_start[l2] + b * (2*l2+1) + l2 + m
+            if l1 < l2:
+                sign[e3] = (-1)**(l1+l2)
+
+        # m = 0 covers every element, the other m only the elements of the pair types with min(l1, l2) >= |m|
+        self.fused_index = []
+        for m in range(2*L+1):
+            elem = torch.arange(n_elem) if m == L else (sk_index[m] != self.idp_sk.reduced_matrix_element).nonzero().flatten()
+            self.fused_index.append(tuple(
+                index.to(self.device) for index in (elem, sk_index[m, elem], left_index[m, elem], right_index[m, elem])
+            ))
+        self.fused_sign = sign.to(self.device)
+
+    def _initialize_onsite_index(self):
+        """
+        Build the gather indices that put the onsite (and soc) sk parameters into the e3 layout of ``self.idp``.
+
+        The onsite block of the orbital type l is E * I, so an element (q, a, b) of the "l-l" pair type takes the
+        q-th onsite parameter of the type when a == b, and the trailing zero slot of the padded parameters otherwise.
+        The soc block of an orbital is lambda * M^l, where M^l is the soc matrix in the cubic basis of which the
+        upup and updn rows are kept, so each element gathers the soc parameter of its orbital times an element of M^l.
+        """
+        onsite_index = torch.full((self.idp.reduced_matrix_element,), self.idp_sk.n_onsite_Es, dtype=torch.long)
+        for orbtype, sli in self.idp_sk.skonsitetype_maps.items():
+            l = anglrMId[orbtype]
+            e3 = self.idp.orbpairtype_maps[orbtype+"-"+orbtype]
+            n_pair = sli.stop - sli.start
+            assert n_pair * (2*l+1)**2 == e3.stop - e3.start
+            q, a, b = torch.meshgrid(torch.arange(n_pair), torch.arange(2*l+1), torch.arange(2*l+1), indexing="ij")
+            onsite_index[e3] = torch.where(a == b, sli.start + q, self.idp_sk.n_onsite_Es).flatten()
+        self.onsite_index = onsite_index.to(self.device)
+
+        if self.soc:
+            soc_index = torch.zeros(self.idp.reduced_soc_matrix_elemet, dtype=torch.long)
+            soc_coeff = torch.zeros(self.idp.reduced_soc_matrix_elemet, dtype=self.cdtype)
+            for otype, sli in self.idp_sk.sksoc_maps.items():
+                lsymbol = re.findall(r"[a-z]", otype)[0]
+                l = anglrMId[lsymbol]
+                e3 = self.idp.orbpair_soc_maps[otype+"-"+otype]
+                n_pair = sli.stop - sli.start
+                assert n_pair * (2*l+1) * 2*(2*l+1) == e3.stop - e3.start
+                soc_index[e3] = (sli.start + torch.arange(n_pair)).repeat_interleave((2*l+1) * 2*(2*l+1))
+                soc_coeff[e3] = self.soc_base_matrix[lsymbol][:2*l+1].to("cpu").flatten().repeat(n_pair)
+            self.soc_index = soc_index.to(self.device)
+            self.soc_coeff = soc_coeff.to(self.device)
+
+    def _fused_rotation(self, skparams: torch.Tensor, rotations: torch.Tensor) -> torch.Tensor:
+        """Rotate the sk parameters [N, idp_sk.reduced_matrix_element] with the flattened rotation matrices of
+        each edge, and return the blocks in the e3 layout [N, idp.reduced_matrix_element], without the l1 < l2 sign."""
+        # feature major layout, so that every gather below copies contiguous rows
+        skparams = torch.cat([skparams, skparams.new_zeros(skparams.shape[0], 1)], dim=1).T.contiguous()
+        rotations = rotations.T.contiguous()
+
+        L = self.lmax
+        _, sk_index, left_index, right_index = self.fused_index[L]
+        HR = skparams[sk_index] * rotations[left_index] * rotations[right_index]
+        for m in range(2*L+1):
+            if m != L:
+                elem, sk_index, left_index, right_index = self.fused_index[m]
+                HR.index_add_(0, elem, skparams[sk_index] * rotations[left_index] * rotations[right_index])
+
+        return HR.T.contiguous()
 
     def _initialize_basis(self, pairtype: str):
         """
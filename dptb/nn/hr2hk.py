@@ -1,6 +1,6 @@
 import torch
 from dptb.utils.constants import h_all_types, anglrMId, atomic_num_dict, atomic_num_dict_r
-from typing import Tuple, Union, Dict
+from typing import Tuple, Union, Dict, List
 from dptb.data.transforms import OrbitalMapper
 from dptb.data import AtomicDataDict
 import re
@@ -45,17 +45,49 @@ class HR2HK(torch.nn.Module):
         self.node_field = node_field
         self.out_field = out_field
 
+        # gather index and factor mapping the reduced orbpair features (plus one trailing zero column)
+        # to the upper triangle of the full basis block, used by the batched path.
+        fb = self.idp.full_basis_norb
+        block_index = torch.full((fb, fb), self.idp.reduced_matrix_element, dtype=torch.long)
+        block_factor = torch.zeros((fb, fb), dtype=self.dtype)
+        ist = 0
+        for i, iorb in enumerate(self.idp.full_basis):
+            li = anglrMId[re.findall(r"[a-zA-Z]+", iorb)[0]]
+            jst = 0
+            for j, jorb in enumerate(self.idp.full_basis):
+                lj = anglrMId[re.findall(r"[a-zA-Z]+", jorb)[0]]
+                if i <= j:
+                    sli = self.idp.orbpair_maps[iorb + "-" + jorb]
+                    block_index[ist:ist+2*li+1, jst:jst+2*lj+1] = torch.arange(sli.start, sli.stop).reshape(2*li+1, 2*lj+1)
+                    block_factor[ist:ist+2*li+1, jst:jst+2*lj+1] = 0.5 if iorb == jorb else 1.0
+                jst += 2*lj+1
+            ist += 2*li+1
+        self.block_index = block_index.to(self.device)
+        self.block_factor = block_factor.to(self.device)
+        # full basis indices of the orbitals of each atom type, in basis order, padded at the end
+        self.basis_index = torch.argsort((~self.idp.mask_to_basis).int(), dim=1, stable=True).to(self.device)
+
+        # the soc features of an orbital hold its upup and updn blocks side by side, only the diagonal
+        # orbital blocks have soc terms.
+        soc_upup_index = torch.full((fb, fb), self.idp.reduced_soc_matrix_elemet, dtype=torch.long)
+        soc_updn_index = torch.full((fb, fb), self.idp.reduced_soc_matrix_elemet, dtype=torch.long)
+        ist = 0
+        for iorb in self.idp.full_basis:
+            li = anglrMId[re.findall(r"[a-zA-Z]+", iorb)[0]]
+            sli = self.idp.orbpair_soc_maps[iorb + "-" + iorb]
+            soc = torch.arange(sli.start, sli.stop).reshape(2*li+1, 2*(2*li+1))
+            soc_upup_index[ist:ist+2*li+1, ist:ist+2*li+1] = soc[:, :2*li+1]
+            soc_updn_index[ist:ist+2*li+1, ist:ist+2*li+1] = soc[:, 2*li+1:]
+            ist += 2*li+1
+        self.soc_upup_index = soc_upup_index.to(self.device)
+        self.soc_updn_index = soc_updn_index.to(self.device)
+
     def forward(self, data: AtomicDataDict.Type) -> AtomicDataDict.Type:
 
         # construct bond wise hamiltonian block from obital pair wise node/edge features
         # we assume the edge feature have the similar format as the node feature, which is reduced from orbitals index oj-oi with j>i
-        
-        orbpair_hopping = data[self.edge_field]
-        orbpair_onsite = data.get(self.node_field)
-        bondwise_hopping = torch.zeros((len(orbpair_hopping), self.idp.full_basis_norb, self.idp.full_basis_norb), dtype=self.dtype, device=self.device)
-        bondwise_hopping.to(self.device)
-        bondwise_hopping.type(self.dtype)
-        onsite_block = torch.zeros((len(data[AtomicDataDict.ATOM_TYPE_KEY]), self.idp.full_basis_norb, self.idp.full_basis_norb,), dtype=self.dtype, device=self.device)
+        # the blocks are gathered with the index tensors built at initialization, see `full_blocks`.
+
         kpoints = data[AtomicDataDict.KPOINT_KEY]
         if kpoints.is_nested:
             assert kpoints.size(0) == 1
@@ -64,127 +96,183 @@ class HR2HK(torch.nn.Module):
         soc = data.get(AtomicDataDict.NODE_SOC_SWITCH_KEY, False)
         if isinstance(soc, torch.Tensor):
             soc = soc.all()
-        if soc:
-            if self.overlap:
-                raise NotImplementedError("Overlap is not implemented for SOC.")
-            
-            orbpair_soc = data[AtomicDataDict.NODE_SOC_KEY]
-            soc_upup_block = torch.zeros((len(data[AtomicDataDict.ATOM_TYPE_KEY]), self.idp.full_basis_norb, self.idp.full_basis_norb), dtype=self.ctype, device=self.device)
-            soc_updn_block = torch.zeros((len(data[AtomicDataDict.ATOM_TYPE_KEY]), self.idp.full_basis_norb, self.idp.full_basis_norb), dtype=self.ctype, device=self.device)
+        if soc and self.overlap:
+            raise NotImplementedError("Overlap is not implemented for SOC.")
 
-        ist = 0
-        for i,iorb in enumerate(self.idp.full_basis):
-            jst = 0
-            li = anglrMId[re.findall(r"[a-zA-Z]+", iorb)[0]]
-            for j,jorb in enumerate(self.idp.full_basis):
-                orbpair = iorb + "-" + jorb
-                lj = anglrMId[re.findall(r"[a-zA-Z]+", jorb)[0]]
-                
-                # constructing hopping blocks
-                if iorb == jorb:
-                    factor = 0.5
-                else:
-                    factor = 1.0
+        atom_types = data[AtomicDataDict.ATOM_TYPE_KEY].flatten()
+        norb = self.idp.atom_norb[atom_types]
+        all_norb = int(norb.sum())
+        node_start = torch.cumsum(norb, dim=0) - norb
 
-                if i <= j:
-                    bondwise_hopping[:,ist:ist+2*li+1,jst:jst+2*lj+1] = factor * orbpair_hopping[:,self.idp.orbpair_maps[orbpair]].reshape(-1, 2*li+1, 2*lj+1)
-
-
-                # constructing onsite blocks
-                if self.overlap:
-                    # if iorb == jorb:
-                    #     onsite_block[:, ist:ist+2*li+1, jst:jst+2*lj+1] = factor * torch.eye(2*li+1, dtype=self.dtype, device=self.device).reshape(1, 2*li+1, 2*lj+1).repeat(onsite_block.shape[0], 1, 1)
-                    if i <= j:
-                        onsite_block[:,ist:ist+2*li+1,jst:jst+2*lj+1] = factor * orbpair_onsite[:,self.idp.orbpair_maps[orbpair]].reshape(-1, 2*li+1, 2*lj+1)
-                else:
-                    if i <= j:
-                        onsite_block[:,ist:ist+2*li+1,jst:jst+2*lj+1] = factor * orbpair_onsite[:,self.idp.orbpair_maps[orbpair]].reshape(-1, 2*li+1, 2*lj+1)
-                    
-                    if soc and i==j:
-                        soc_updn_tmp = orbpair_soc[:,self.idp.orbpair_soc_maps[orbpair]].reshape(-1, 2*li+1, 2*(2*lj+1))
-                        soc_upup_block[:,ist:ist+2*li+1,jst:jst+2*lj+1] = soc_updn_tmp[:, :2*li+1,:2*lj+1]
-                        soc_updn_block[:,ist:ist+2*li+1,jst:jst+2*lj+1] = soc_updn_tmp[:, :2*li+1,2*lj+1:]
-                
-                jst += 2*lj+1
-            ist += 2*li+1
-        self.onsite_block = onsite_block
-        self.bondwise_hopping = bondwise_hopping
-        if soc:
-            self.soc_upup_block = soc_upup_block
-            self.soc_updn_block = soc_updn_block
-
-        # R2K procedure can be done for all kpoint at once.
-        all_norb = self.idp.atom_norb[data[AtomicDataDict.ATOM_TYPE_KEY]].sum()
-        block = torch.zeros(kpoints.shape[0], all_norb, all_norb, dtype=self.ctype, device=self.device)
-        # block = torch.complex(block, torch.zeros_like(block))
-        # if data[AtomicDataDict.NODE_SOC_SWITCH_KEY].all():
-        #     block_uu = torch.zeros(data[AtomicDataDict.KPOINT_KEY].shape[0], all_norb, all_norb, dtype=self.ctype, device=self.device)
-        #     block_ud = torch.zeros(data[AtomicDataDict.KPOINT_KEY].shape[0], all_norb, all_norb, dtype=self.ctype, device=self.device)
-        atom_id_to_indices = {}
-        ist = 0
-        for i, oblock in enumerate(onsite_block):
-            mask = self.idp.mask_to_basis[data[AtomicDataDict.ATOM_TYPE_KEY].flatten()[i]]
-            masked_oblock = oblock[mask][:,mask]
-            block[:,ist:ist+masked_oblock.shape[0],ist:ist+masked_oblock.shape[1]] = masked_oblock.squeeze(0)
-            atom_id_to_indices[i] = slice(ist, ist+masked_oblock.shape[0])
-            ist += masked_oblock.shape[0]
-        
-        # if data[AtomicDataDict.NODE_SOC_SWITCH_KEY].all():
-        #     ist = 0
-        #     for i, soc_block in enumerate(soc_upup_block):
-        #         mask = self.idp.mask_to_basis[data[AtomicDataDict.ATOM_TYPE_KEY].flatten()[i]]
-        #         masked_soc_block = soc_block[mask][:,mask]
-        #         block_uu[:,ist:ist+masked_soc_block.shape[0],ist:ist+masked_soc_block.shape[1]] = masked_soc_block.squeeze(0)
-        #         ist += masked_soc_block.shape[0]
-        #     ist = 0
-        #     for i, soc_block in enumerate(soc_updn_block):
-        #         mask = self.idp.mask_to_basis[data[AtomicDataDict.ATOM_TYPE_KEY].flatten()[i]]
-        #         masked_soc_block = soc_block[mask][:,mask]
-        #         block_ud[:,ist:ist+masked_soc_block.shape[0],ist:ist+masked_soc_block.shape[1]] = masked_soc_block.squeeze(0)
-        #         ist += masked_soc_block.shape[0]
-
-        for i, hblock in enumerate(bondwise_hopping):
-            iatom = data[AtomicDataDict.EDGE_INDEX_KEY][0][i]
-            jatom = data[AtomicDataDict.EDGE_INDEX_KEY][1][i]
-            iatom_indices = atom_id_to_indices[int(iatom)]
-            jatom_indices = atom_id_to_indices[int(jatom)]
-            imask = self.idp.mask_to_basis[data[AtomicDataDict.ATOM_TYPE_KEY].flatten()[iatom]]
-            jmask = self.idp.mask_to_basis[data[AtomicDataDict.ATOM_TYPE_KEY].flatten()[jatom]]
-            masked_hblock = hblock[imask][:,jmask]
-
-            block[:,iatom_indices,jatom_indices] += masked_hblock.squeeze(0).type_as(block) * \
-                torch.exp(-1j * 2 * torch.pi * (kpoints @ data[AtomicDataDict.EDGE_CELL_SHIFT_KEY][i])).reshape(-1,1,1)
+        # the onsite blocks enter as the zero lattice vector term of H(R)
+        edge_index = data[AtomicDataDict.EDGE_INDEX_KEY]
+        node_index = torch.arange(len(atom_types), device=edge_index.device)
+        iatom = torch.cat([edge_index[0], node_index])
+        jatom = torch.cat([edge_index[1], node_index])
+        shifts = torch.cat([
+            data[AtomicDataDict.EDGE_CELL_SHIFT_KEY],
+            data[AtomicDataDict.EDGE_CELL_SHIFT_KEY].new_zeros(len(atom_types), 3),
+            ])
+        blocks = self.full_blocks(torch.cat([data[self.edge_field], data[self.node_field]], dim=0).type(self.dtype))
+        lattice, pair_lattice = torch.unique(shifts, dim=0, return_inverse=True)
+
+        # map every pair block element from the full basis to the rows and columns of the structure
+        ibasis, jbasis, select, rows, cols = self._pair_positions(atom_types, norb, node_start, iatom, jatom)
+        values = blocks[torch.arange(len(blocks), device=blocks.device).reshape(-1, 1, 1), ibasis.unsqueeze(2), jbasis.unsqueeze(1)]
+        pair_R = pair_lattice.reshape(-1, 1, 1).expand_as(select)[select]
+        rows, cols, values = rows[select], cols[select], values[select]
+        phase = torch.exp(-1j * 2 * torch.pi * (kpoints @ lattice.type(kpoints.dtype).T)).type(self.ctype)
 
+        if kpoints.shape[0] < len(lattice):
+            # with fewer k-points than lattice vectors (e.g. gamma only for a large supercell), the dense H(R) would
+            # be larger than H(k), so the elements are accumulated into H(k) one k-point at a time.
+            block = torch.zeros(kpoints.shape[0], all_norb, all_norb, dtype=self.ctype, device=self.device)
+            values = values.type(self.ctype)
+            for ik in range(kpoints.shape[0]):
+                block[ik].index_put_((rows, cols), values * phase[ik, pair_R], accumulate=True)
+        else:
+            hR = torch.zeros(len(lattice), all_norb, all_norb, dtype=self.dtype, device=self.device)
+            hR.index_put_((pair_R, rows, cols), values, accumulate=True)
+            # R2K procedure can be done for all kpoint at once.
+            block = torch.einsum("kr,rij->kij", phase, hR.type(self.ctype))
         block = block + block.transpose(1,2).conj()
         block = block.contiguous()
-        
+
         if soc:
+            orbpair_soc = data[AtomicDataDict.NODE_SOC_KEY]
+            padded = torch.cat([orbpair_soc, orbpair_soc.new_zeros(orbpair_soc.shape[0], 1)], dim=1)
+            fb = self.idp.full_basis_norb
+            soc_upup_block = padded[:, self.soc_upup_index.flatten()].reshape(-1, fb, fb)
+            soc_updn_block = padded[:, self.soc_updn_index.flatten()].reshape(-1, fb, fb)
+
+            _, _, select, rows, cols = self._pair_positions(atom_types, norb, node_start, node_index, node_index)
+            basis = self.basis_index[atom_types]
+            soc_uu = torch.zeros(all_norb, all_norb, dtype=self.ctype, device=self.device)
+            soc_ud = torch.zeros(all_norb, all_norb, dtype=self.ctype, device=self.device)
+            soc_uu[rows[select], cols[select]] = soc_upup_block[node_index.reshape(-1, 1, 1), basis.unsqueeze(2), basis.unsqueeze(1)][select].type(self.ctype)
+            soc_ud[rows[select], cols[select]] = soc_updn_block[node_index.reshape(-1, 1, 1), basis.unsqueeze(2), basis.unsqueeze(1)][select].type(self.ctype)
+
             HK_SOC = torch.zeros(kpoints.shape[0], 2*all_norb, 2*all_norb, dtype=self.ctype, device=self.device)
-            #HK_SOC[:,:all_norb,:all_norb] = block + block_uu
-            #HK_SOC[:,:all_norb,all_norb:] = block_ud
-            #HK_SOC[:,all_norb:,:all_norb] = block_ud.conj()
-            #HK_SOC[:,all_norb:,all_norb:] = block + block_uu.conj()
-            ist = 0
-            assert len(soc_upup_block) == len(soc_updn_block)
-            for i in range(len(soc_upup_block)):
-                assert soc_upup_block[i].shape == soc_updn_block[i].shape
-                mask = self.idp.mask_to_basis[data[AtomicDataDict.ATOM_TYPE_KEY].flatten()[i]]
-                masked_soc_upup_block = soc_upup_block[i][mask][:,mask]
-                masked_soc_updn_block = soc_updn_block[i][mask][:,mask]
-                HK_SOC[:,ist:ist+masked_soc_upup_block.shape[0],ist:ist+masked_soc_upup_block.shape[1]] = masked_soc_upup_block.squeeze(0)
-                HK_SOC[:,ist:ist+masked_soc_updn_block.shape[0],ist+all_norb:ist+all_norb+masked_soc_updn_block.shape[1]] = masked_soc_updn_block.squeeze(0)
-                assert masked_soc_upup_block.shape[0] == masked_soc_upup_block.shape[1]
-                assert masked_soc_upup_block.shape[0] == masked_soc_updn_block.shape[0]
-                
-                ist += masked_soc_upup_block.shape[0]
-
-            HK_SOC[:,all_norb:,:all_norb] = HK_SOC[:,:all_norb,all_norb:].conj()   
-            HK_SOC[:,all_norb:,all_norb:] = HK_SOC[:,:all_norb,:all_norb].conj()  + block
-            HK_SOC[:,:all_norb,:all_norb] = HK_SOC[:,:all_norb,:all_norb] + block  
+            HK_SOC[:,:all_norb,:all_norb] = block + soc_uu
+            HK_SOC[:,:all_norb,all_norb:] = soc_ud
+            HK_SOC[:,all_norb:,:all_norb] = soc_ud.conj()
+            HK_SOC[:,all_norb:,all_norb:] = block + soc_uu.conj()
 
             data[self.out_field] = HK_SOC
         else:
             data[self.out_field] = block
 
         return data
-    
\ No newline at end of file
+
+    def _pair_positions(self, atom_types, norb, node_start, iatom, jatom):
+        """The full basis indices of the orbitals of the atoms ``iatom`` and ``jatom`` of each pair, the mask of the
+        elements of the pair blocks that exist for their atom types, and the rows and columns of these elements in H."""
+        fb = self.idp.full_basis_norb
+        orb = torch.arange(fb, device=norb.device)
+        ibasis = self.basis_index[atom_types[iatom]]
+        jbasis = self.basis_index[atom_types[jatom]]
+        select = (orb.unsqueeze(0) < norb[iatom].unsqueeze(1)).unsqueeze(2) & (orb.unsqueeze(0) < norb[jatom].unsqueeze(1)).unsqueeze(1)
+        rows = (node_start[iatom].unsqueeze(1) + orb.unsqueeze(0)).unsqueeze(2).expand(-1, fb, fb)
+        cols = (node_start[jatom].unsqueeze(1) + orb.unsqueeze(0)).unsqueeze(1).expand(-1, fb, fb)
+        return ibasis, jbasis, select, rows, cols
+
+    def full_blocks(self, orbpair_features: torch.Tensor) -> torch.Tensor:
+        """Expand reduced orbpair features of shape [N, reduced_matrix_element] to the upper triangular
+        full basis blocks [N, full_basis_norb, full_basis_norb], as constructed in ``forward``."""
+        padded = torch.cat([orbpair_features, orbpair_features.new_zeros(orbpair_features.shape[0], 1)], dim=1)
+        blocks = padded[:, self.block_index.flatten()].reshape(-1, self.idp.full_basis_norb, self.idp.full_basis_norb)
+        return blocks * self.block_factor.to(blocks.dtype)
+
+    def batched(self, data: AtomicDataDict.Type, groups: List[torch.Tensor]) -> List[torch.Tensor]:
+        """
+        Construct H(k) for all structures of a batch without splitting it into single structures.
+
+        The structures listed in each entry of ``groups`` must share the number of orbitals and k-points. The node
+        and edge blocks of the whole batch are accumulated once into real space blocks H(R) per structure and
+        lattice vector, and each group is then transformed to k space with a single batched contraction.
+
+        Parameters
+        ----------
+        data : AtomicDataDict.Type
+            the batched data, with one entry of the nested ``kpoint`` field per structure.
+        groups : List[torch.Tensor]
+            the graph indices of each group.
+
+        Returns
+        -------
+        List[torch.Tensor]
+            H(k) of shape [len(group), nk, norb, norb] for each group.
+        """
+        soc = data.get(AtomicDataDict.NODE_SOC_SWITCH_KEY, False)
+        if isinstance(soc, torch.Tensor):
+            soc = soc.any()
+        if soc:
+            raise NotImplementedError("The batched H(k) construction does not support SOC.")
+
+        atom_types = data[AtomicDataDict.ATOM_TYPE_KEY].flatten()
+        batch = data.get(AtomicDataDict.BATCH_KEY)
+        if batch is None:
+            batch = torch.zeros_like(atom_types)
+        num_graphs = int(batch.max()) + 1 if len(batch) > 0 else 0
+
+        kpoints = data[AtomicDataDict.KPOINT_KEY]
+        if kpoints.is_nested:
+            kpoints = list(kpoints.unbind())
+        else:
+            kpoints = [kpoints] * num_graphs
+
+        # orbital offset of each atom inside its own structure
+        norb = self.idp.atom_norb[atom_types]
+        graph_norb = torch.zeros(num_graphs, dtype=torch.long, device=norb.device).index_add_(0, batch, norb)
+        node_start = torch.cumsum(norb, dim=0) - norb
+        node_start = node_start - (torch.cumsum(graph_norb, dim=0) - graph_norb)[batch]
+
+        # the onsite blocks enter as the zero lattice vector term of H(R)
+        edge_index = data[AtomicDataDict.EDGE_INDEX_KEY]
+        node_index = torch.arange(len(atom_types), device=edge_index.device)
+        iatom = torch.cat([edge_index[0], node_index])
+        jatom = torch.cat([edge_index[1], node_index])
+        shifts = torch.cat([
+            data[AtomicDataDict.EDGE_CELL_SHIFT_KEY].round().long(),
+            torch.zeros(len(atom_types), 3, dtype=torch.long, device=edge_index.device),
+            ])
+        blocks = self.full_blocks(torch.cat([data[self.edge_field], data[self.node_field]], dim=0).type(self.dtype))
+
+        # number the distinct lattice vectors of each structure from zero
+        pair_graph = batch[iatom]
+        lattice, inverse = torch.unique(torch.cat([pair_graph.unsqueeze(1), shifts], dim=1), dim=0, return_inverse=True)
+        nlattice = torch.bincount(lattice[:, 0], minlength=num_graphs)
+        lattice_start = torch.cumsum(nlattice, dim=0) - nlattice
+        pair_lattice = inverse - lattice_start[pair_graph]
+        lattice_local = torch.arange(len(lattice), device=lattice.device) - lattice_start[lattice[:, 0]]
+
+        # map every pair block element from the full basis to the rows and columns of its structure
+        fb = self.idp.full_basis_norb
+        ibasis, jbasis, valid, rows, cols = self._pair_positions(atom_types, norb, node_start, iatom, jatom)
+        values = blocks[torch.arange(len(blocks), device=blocks.device).reshape(-1, 1, 1), ibasis.unsqueeze(2), jbasis.unsqueeze(1)]
+
+        out = []
+        for group in groups:
+            position = torch.full((num_graphs,), -1, dtype=torch.long, device=batch.device)
+            position[group] = torch.arange(len(group), device=batch.device)
+            all_norb = int(graph_norb[group[0]])
+            nR = int(nlattice[group].max())
+            kpts = torch.stack([kpoints[int(g)] for g in group])
+
+            pair_mask = position[pair_graph] >= 0
+            select = valid & pair_mask.reshape(-1, 1, 1)
+            pair_pos = position[pair_graph].reshape(-1, 1, 1).expand(-1, fb, fb)
+            pair_R = pair_lattice.reshape(-1, 1, 1).expand(-1, fb, fb)
+            hR = torch.zeros(len(group), nR, all_norb, all_norb, dtype=self.dtype, device=self.device)
+            hR.index_put_((pair_pos[select], pair_R[select], rows[select], cols[select]), values[select], accumulate=True)
+
+            lattice_mask = position[lattice[:, 0]] >= 0
+            R = torch.zeros(len(group), nR, 3, dtype=kpts.dtype, device=self.device)
+            R[position[lattice[lattice_mask, 0]], lattice_local[lattice_mask]] = lattice[lattice_mask, 1:].type(kpts.dtype)
+            phase = torch.exp(-1j * 2 * torch.pi * torch.einsum("gkx,grx->gkr", kpts, R)).type(self.ctype)
+
+            block = torch.einsum("gkr,grij->gkij", phase, hR.type(self.ctype))
+            block = block + block.transpose(-1, -2).conj()
+            out.append(block.contiguous())
+
+        return out
@@ -0,0 +1,80 @@
+import types
+import logging
+import warnings
+import torch
+from e3nn import o3
+
+log = logging.getLogger(__name__)
+
+def _autocast_types():
+    """the modules dominated by matrix products: linear layers, e3nn linears and tensor products, and the scalar MLPs."""
+    from dptb.nn.tensor_product import RadialFunction
+    from dptb.nn.embedding.lem import ScalarMLPFunction as LemMLP
+    from dptb.nn.embedding.slem import ScalarMLPFunction as SlemMLP
+    from dptb.nn.embedding.e3baseline_local6 import ScalarMLPFunction as E3BaselineMLP
+
+    return (torch.nn.Linear, o3.Linear, o3.TensorProduct, RadialFunction, LemMLP, SlemMLP, E3BaselineMLP)
+
+def _cast(x, dtype):
+    if isinstance(x, torch.Tensor):
+        return x.to(dtype) if torch.is_floating_point(x) else x
+    elif isinstance(x, (list, tuple)):
+        return type(x)(_cast(v, dtype) for v in x)
+    elif isinstance(x, dict):
+        return {k: _cast(v, dtype) for k, v in x.items()}
+    return x
+
+def _first_float_dtype(args):
+    for a in args:
+        if isinstance(a, torch.Tensor) and torch.is_floating_point(a):
+            return a.dtype
+    return None
+
+def _autocast_forward(self, *args, **kwargs):
+    device_type = next((a.device.type for a in args if isinstance(a, torch.Tensor)), "cpu")
+    nested = torch.is_autocast_cpu_enabled() if device_type == "cpu" else torch.is_autocast_enabled()
+    if nested:
+        # called within an autocast module, which casts the output back.
+        return type(self).forward(self, *args, **kwargs)
+
+    dtype = _first_float_dtype(args)
+    with torch.autocast(device_type=device_type, dtype=self._autocast_dtype):
+        out = type(self).forward(self, *args, **kwargs)
+    return _cast(out, dtype) if dtype is not None else out
+
+def autocast_supported(device_type: str, dtype: torch.dtype) -> bool:
+    """whether `torch.autocast` runs in `dtype` on `device_type`, older torch versions disable it with a warning."""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        with torch.autocast(device_type=device_type, dtype=dtype):
+            return torch.is_autocast_cpu_enabled() if device_type == "cpu" else torch.is_autocast_enabled()
+
+def autocast_modules(module: torch.nn.Module, dtype: torch.dtype=torch.bfloat16) -> int:
+    """
+    Run the matrix products of `module` in the low precision `dtype` with `torch.autocast`.
+
+    Only the linear layers, e3nn linears and tensor products and the scalar MLPs are autocast, and their outputs
+    are cast back to the dtype of their inputs. The geometry (edge vectors, spherical harmonics, Wigner rotations,
+    cutoffs), the normalizations and the scatters between them keep the dtype of the model. The weights are not
+    changed, so the state dict and the optimizer work in the model dtype.
+
+    Only a float32 module is supported, since `torch.autocast` does not cast the float64 tensors.
+
+    Returns the number of autocast modules.
+    """
+    param = next(module.parameters(), None)
+    if param is not None:
+        if param.dtype != torch.float32:
+            raise ValueError(f"The autocast to {dtype} requires a float32 model, but the model is {param.dtype}.")
+        if not autocast_supported(param.device.type, dtype):
+            raise ValueError(f"torch {torch.__version__} does not support the autocast to {dtype} on {param.device.type}.")
+
+    autocast_types = _autocast_types()
+    n = 0
+    for m in module.modules():
+        if isinstance(m, autocast_types):
+            m._autocast_dtype = dtype
+            # bound to the module, so that copy.deepcopy rebinds it to the copy.
+            m.forward = types.MethodType(_autocast_forward, m)
+            n += 1
+    return n
@@ -90,10 +90,11 @@ class NNSK(torch.nn.Module):
 
         
         atomic_numbers = [atomic_num_dict[key] for key in self.basis.keys()]
-        self.atomic_radius_list =  torch.zeros(int(max(atomic_numbers))) - 100
+        atomic_radius_list =  torch.zeros(int(max(atomic_numbers)), dtype=self.dtype) - 100
         for at in self.basis.keys():
             assert  atomic_radius_dict[at] is not None, f"The atomic radius for {at} is not provided."
-            self.atomic_radius_list[atomic_num_dict[at]-1] = atomic_radius_dict[at]
+            atomic_radius_list[atomic_num_dict[at]-1] = atomic_radius_dict[at]
+        self.register_buffer("atomic_radius_list", atomic_radius_list.to(self.device), persistent=False)
 
         if self.soc_options.get("method", None) is not None:
             self.idp_sk.get_sksoc_maps()
@@ -179,6 +180,64 @@ class NNSK(torch.nn.Module):
             else:
                 raise ValueError("The rs tag is not recognized. Please check the rs tag.")
 
+        self._initialize_bond_maps()
+        # start from symmetric parameters, their gradients through `symmetrize` are symmetric, so they stay symmetric.
+        with torch.no_grad():
+            self.hopping_param.copy_(self.symmetrize(self.hopping_param))
+            if overlap:
+                self.overlap_param.copy_(self.symmetrize(self.overlap_param))
+
+    def _initialize_bond_maps(self):
+        """
+        Build the lookups of the forward that only depend on the basis, as non persistent buffers:
+            - `bond_atomic_numbers`: the atomic numbers of the two atoms of each bond type, shape [2, n_bond].
+            - `type_pair_to_bond`: the bond type of each pair of atom types, shape [n_type, n_type].
+            - `reflective_bonds`: the bond type B-A of each bond type A-B.
+            - `equal_orbpair`: the mask of the orbital pairs i-i, whose hopping of A-B and B-A is the same integral.
+            - `bond_r0`: the bond length r0 = r1 + r2 of each bond type, from the atomic radii.
+            - `bond_rs`: the rs of each bond type, when rs is given per atom or per bond.
+        """
+        n_bond = len(self.idp_sk.bond_types)
+        bond_atomic_numbers = self.idp_sk.untransform_bond(torch.arange(n_bond, device=self.device)).T
+        self.register_buffer("bond_atomic_numbers", bond_atomic_numbers, persistent=False)
+
+        type_pair_to_bond = torch.tensor([[self.idp_sk.bond_to_type[f"{it}-{jt}"] for jt in self.idp_sk.type_names] 
+                                          for it in self.idp_sk.type_names], dtype=torch.long, device=self.device)
+        self.register_buffer("type_pair_to_bond", type_pair_to_bond, persistent=False)
+
+        reflective_bonds = torch.tensor([self.idp_sk.bond_to_type["-".join(self.idp_sk.type_to_bond[i].split("-")[::-1])] 
+                                         for i in range(n_bond)], dtype=torch.long, device=self.device)
+        self.register_buffer("reflective_bonds", reflective_bonds, persistent=False)
+
+        equal_orbpair = torch.zeros(self.idp_sk.reduced_matrix_element, dtype=torch.bool, device=self.device)
+        for orbpair_key, slices in self.idp_sk.orbpair_maps.items():
+            iorb, jorb = orbpair_key.split("-")
+            if iorb == jorb:
+                equal_orbpair[slices] = True
+        self.register_buffer("equal_orbpair", equal_orbpair, persistent=False)
+
+        bond_r0 = self.atomic_radius_list[bond_atomic_numbers-1].sum(0)
+        assert (bond_r0 > 0).all(), "The bond length list is only available for atomic numbers < 84 and excluding the lanthanides."
+        self.register_buffer("bond_r0", bond_r0, persistent=False)
+
+        if isinstance(self.hopping_options['rs'], dict):
+            r_map = self.r_map.to(device=self.device, dtype=self.dtype)
+            if self.r_map_type == 1:
+                bond_rs = 0.5*r_map[bond_atomic_numbers-1].sum(0)
+            elif self.r_map_type == 2:
+                bond_rs = r_map[bond_atomic_numbers[0]-1, bond_atomic_numbers[1]-1]
+            else:
+                raise ValueError(f"r_map_type {self.r_map_type} is not recognized.")
+            self.register_buffer("bond_rs", bond_rs, persistent=False)
+
+    def symmetrize(self, params: torch.Tensor) -> torch.Tensor:
+        """
+        The sk parameters of the same orbital pair i-i of the bonds A-B and B-A describe the same integral,
+        eg. As-Bs = Bs-As, since only one of As-Bp and Bs-Ap is kept for different orbitals, and Ap-Bs = Bs-Ap is used.
+        The parameters are therefore reparameterized as the mean of the two, so that they are equal by construction.
+        """
+        return torch.where(self.equal_orbpair.reshape(1, -1, 1), 0.5 * (params + params[self.reflective_bonds]), params)
+
     def freezefunc(self, freeze: Union[bool,str,list]):
         if freeze is False:
             return 0
@@ -292,25 +351,9 @@ class NNSK(torch.nn.Module):
         if self.if_push:
             self.push_decay(**self.push)
 
-        reflective_bonds = np.array([self.idp_sk.bond_to_type["-".join(self.idp_sk.type_to_bond[i].split("-")[::-1])] for i  in range(len(self.idp_sk.bond_types))])
-        params = self.hopping_param.data
-        reflect_params = params[reflective_bonds]
-        for k in self.idp_sk.orbpair_maps.keys():
-            iorb, jorb = k.split("-")
-            if iorb == jorb:
-                # This is to keep the symmetry of the hopping parameters for the same orbital pairs
-                # As-Bs = Bs-As; we need to do this because for different orbital pairs, we only have one set of parameters, 
-                # eg. we only have As-Bp and Bs-Ap, but not Ap-Bs and Bp-As; and we will use Ap-Bs = Bs-Ap and Bp-As = As-Bp to calculate the hopping integral
-                self.hopping_param.data[:,self.idp_sk.orbpair_maps[k],:] = 0.5 * (params[:,self.idp_sk.orbpair_maps[k],:] + reflect_params[:,self.idp_sk.orbpair_maps[k],:])
-        if hasattr(self, "overlap"):
-            params = self.overlap_param.data
-            reflect_params = params[reflective_bonds]
-            for k in self.idp_sk.orbpair_maps.keys():
-                iorb, jorb = k.split("-")
-                if iorb == jorb:
-                    self.overlap_param.data[:,self.idp_sk.orbpair_maps[k],:] = 0.5 * (params[:,self.idp_sk.orbpair_maps[k],:] + reflect_params[:,self.idp_sk.orbpair_maps[k],:])
+        # the A-B / B-A symmetry of the i-i orbital pairs is imposed by reparameterization, see `symmetrize`.
+        hopping_param = self.symmetrize(self.hopping_param)
 
-        
         data = AtomicDataDict.with_edge_vectors(data, with_lengths=True)
         if data.get(AtomicDataDict.EDGE_TYPE_KEY, None) is None:
             self.idp_sk(data)
@@ -318,7 +361,7 @@ class NNSK(torch.nn.Module):
         # edge_number = data[AtomicDataDict.ATOMIC_NUMBERS_KEY][data[AtomicDataDict.EDGE_INDEX_KEY]].reshape(2, -1)
         # edge_index = self.idp_sk.transform_reduced_bond(*edge_number)
         edge_index = data[AtomicDataDict.EDGE_TYPE_KEY].flatten() # it is bond_type index, transform it to reduced bond index
-        edge_number = self.idp_sk.untransform_bond(edge_index).T
+        edge_number = self.bond_atomic_numbers[:, edge_index]
         # edge_index = self.idp_sk.transform_bond(*edge_number)
 
         # the edge number is the atomic number of the two atoms in the bond.
@@ -327,41 +370,29 @@ class NNSK(torch.nn.Module):
         # assert (edge_number <= 83).all(), "The bond length list is only available for the first 83 elements."
         # r0 = 0.5*bond_length_list.type(self.dtype).to(self.device)[edge_number-1].sum(0)
         # r0 = self.atomic_radius_list[edge_number-1].sum(0)  # bond length r0 = r1 + r2. (r1, r2 are atomic radii of the two atoms)
-        r0 = self.atomic_radius_list.type(self.dtype).to(self.device)[edge_number-1].sum(0)
-        assert (r0 > 0).all(), "The bond length list is only available for atomic numbers < 84 and excluding the lanthanides."
+        r0 = self.bond_r0[edge_index] # checked to be positive at initialization
         
         hopping_options = self.hopping_options.copy() 
         if isinstance (self.hopping_options['rs'], dict):
-            if self.r_map_type == 1:
-                rs_edgewise = 0.5*self.r_map[edge_number-1].sum(0)
-            elif self.r_map_type == 2:
-                rs_edgewise = self.r_map[edge_number[0]-1, edge_number[1]-1]
-            else:
-                raise ValueError(f"r_map_type {self.r_map_type} is not recognized.")
-                
-            hopping_options['rs'] = rs_edgewise
+            hopping_options['rs'] = self.bond_rs[edge_index]
 
 
         data[AtomicDataDict.EDGE_FEATURES_KEY] = self.hopping_fn.get_skhij(
             rij=data[AtomicDataDict.EDGE_LENGTH_KEY],
-            paraArray=self.hopping_param[edge_index], # [N_edge, n_pairs, n_paras],
+            paraArray=hopping_param[edge_index], # [N_edge, n_pairs, n_paras],
             **hopping_options,
             r0=r0
             ) # [N_edge, n_pairs]
 
         if hasattr(self, "overlap"):
-            equal_orbpair = torch.zeros(self.idp_sk.reduced_matrix_element, dtype=self.dtype, device=self.device)
-            for orbpair_key, slices in self.idp_sk.orbpair_maps.items():
-                if orbpair_key.split("-")[0] == orbpair_key.split("-")[1]:
-                    equal_orbpair[slices] = 1.0
             # this paraconst is to make sure the overlap between the same orbital pairs of the save atom is 1.0 
             # this is taken from the formula of NRL-TB. 
             # the overlap tag now is only designed to be used in the NRL-TB case. In the future, we may need to change this.
-            paraconst = edge_number[0].eq(edge_number[1]).float().view(-1, 1) * equal_orbpair.unsqueeze(0)
+            paraconst = edge_number[0].eq(edge_number[1]).float().view(-1, 1) * self.equal_orbpair.float().unsqueeze(0)
 
             data[AtomicDataDict.EDGE_OVERLAP_KEY] = self.ovp_factor * self.overlap_fn.get_sksij(
                 rij=data[AtomicDataDict.EDGE_LENGTH_KEY],
-                paraArray=self.overlap_param[edge_index],
+                paraArray=self.symmetrize(self.overlap_param)[edge_index],
                 paraconst=paraconst,
                 **hopping_options,
                 r0=r0,
@@ -393,8 +424,8 @@ class NNSK(torch.nn.Module):
         # compute strain
         if self.onsite_fn.functype == "strain":
             data = AtomicDataDict.with_onsitenv_vectors(data, with_lengths=True)
-            onsitenv_number = self.idp_sk.untransform_atom(data[AtomicDataDict.ATOM_TYPE_KEY].flatten())[data[AtomicDataDict.ONSITENV_INDEX_KEY]].reshape(2, -1)
-            onsitenv_index = self.idp_sk.transform_bond(*onsitenv_number)
+            onsitenv_type = data[AtomicDataDict.ATOM_TYPE_KEY].flatten()[data[AtomicDataDict.ONSITENV_INDEX_KEY]].reshape(2, -1)
+            onsitenv_index = self.type_pair_to_bond[onsitenv_type[0], onsitenv_type[1]]
             # reflect_index = self.idp_sk.transform_bond(*onsitenv_number.flip(0))
             # onsitenv_index[onsitenv_index<0] = reflect_index[onsitenv_index<0] + len(self.idp_sk.reduced_bond_types)
             # reflect_params = torch.zeros_like(self.strain_param)
@@ -404,8 +435,7 @@ class NNSK(torch.nn.Module):
             #     reflect_params], dim=0)
             
             # r0 = 0.5*bond_length_list.type(self.dtype).to(self.device)[onsitenv_number-1].sum(0)
-            r0 = self.atomic_radius_list.type(self.dtype).to(self.device)[onsitenv_number-1].sum(0)  # bond length r0 = r1 + r2. (r1, r2 are atomic radii of the two atoms)
-            assert (r0 > 0).all(), "The bond length list is only available for atomic numbers < 84 and excluding the lanthanides."
+            r0 = self.bond_r0[onsitenv_index]  # bond length r0 = r1 + r2. (r1, r2 are atomic radii of the two atoms)
             onsitenv_params = self.hopping_fn.get_skhij(
             rij=data[AtomicDataDict.ONSITENV_LENGTH_KEY],
             paraArray=self.strain_param[onsitenv_index], # [N_edge, n_pairs, n_paras],
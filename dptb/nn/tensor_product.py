@@ -23,6 +23,25 @@ def wigner_D(l, alpha, beta, gamma):
     return Xa @ J @ Xb @ J @ Xc
 
 
+def sk_rotation_matrices(vectors, lmax):
+    """The rotation matrices D^l (l = 0..lmax) used to rotate the SK blocks along the z axis onto ``vectors``,
+    flattened and concatenated into a tensor of shape [N, sum_l (2l+1)^2]."""
+    # when get the angle, the xyz vector should be transformed to yzx.
+    angle = xyz_to_angles(vectors[:, [1,2,0]])
+    return torch.cat([
+        wigner_D(l, angle[0], angle[1], torch.zeros_like(angle[0])).flatten(1) for l in range(lmax+1)
+        ], dim=1)
+
+
+def split_rotation_matrices(rotations, lmax):
+    """Split the output of ``sk_rotation_matrices`` back into the list of D^l of shape [N, 2l+1, 2l+1], l = 0..lmax."""
+    out, start = [], 0
+    for l in range(lmax+1):
+        out.append(rotations[:, start:start+(2*l+1)**2].reshape(-1, 2*l+1, 2*l+1))
+        start += (2*l+1)**2
+    return out
+
+
 def _z_rot_mat(angle, l):
     shape, device, dtype = angle.shape, angle.device, angle.dtype
     M = angle.new_zeros((*shape, 2 * l + 1, 2 * l + 1))
@@ -1,5 +1,6 @@
 import torch
 import heapq
+from contextlib import nullcontext
 import logging
 from dptb.utils.tools import get_lr_scheduler, j_must_have, get_optimizer
 from abc import ABCMeta, abstractmethod
@@ -36,6 +37,14 @@ class BaseTrainer(with_metaclass(ABCMeta, PluginUser)):
         self.iter = 1
         self.ep = 1
         self.update_lr_per_step_flag = False
+        # set by the Profiler plugin when it is registered.
+        self.profiler = None
+
+    def stage(self, name):
+        '''time a stage of the iteration with the registered profiler, a no-op when there is none.'''
+        if self.profiler is None:
+            return nullcontext()
+        return self.profiler.stage(name)
 
     @abstractmethod
     def restart(self, checkpoint):
@@ -0,0 +1,70 @@
+import torch
+import logging
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+class ExponentialMovingAverage(object):
+    """
+    Exponential moving average of the floating point weights (parameters and buffers) of a model.
+
+    After each optimizer step, `update` moves the shadow weights toward the model weights:
+        shadow = decay_t * shadow + (1 - decay_t) * weight,
+    with the warm-up decay_t = min(decay, (1 + n) / (1 + warmup + n)) at the n-th update, so that the early
+    shadow weights are not dominated by the initialization. The update is done in place with `torch._foreach` ops.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        the model whose weights are averaged.
+    decay : float
+        the decay of the average.
+    warmup : int
+        the number of updates over which the decay grows toward `decay`. `0` means no warm-up.
+    """
+
+    def __init__(self, model: torch.nn.Module, decay: float=0.999, warmup: int=10):
+        assert 0. <= decay < 1., "The decay of the EMA should be in [0, 1)."
+        self.model = model
+        self.decay = decay
+        self.warmup = warmup
+        self.num_updates = 0
+        self.shadow = {k: v.detach().clone() for k, v in model.state_dict().items() if torch.is_floating_point(v)}
+
+    def current_decay(self) -> float:
+        return min(self.decay, (1. + self.num_updates) / (1. + self.warmup + self.num_updates))
+
+    @torch.no_grad()
+    def update(self):
+        decay = self.current_decay()
+        state = self.model.state_dict()
+        shadow = list(self.shadow.values())
+        weights = [state[k] for k in self.shadow.keys()]
+        torch._foreach_mul_(shadow, decay)
+        torch._foreach_add_(shadow, weights, alpha=1. - decay)
+        self.num_updates += 1
+
+    def state_dict(self) -> dict:
+        """the averaged weights, in the format of the model's state dict, and the number of updates."""
+        return {"shadow": self.shadow, "num_updates": self.num_updates}
+
+    def load_state_dict(self, state_dict: dict):
+        for k, v in state_dict["shadow"].items():
+            self.shadow[k].copy_(v)
+        self.num_updates = state_dict["num_updates"]
+
+    def averaged_state_dict(self) -> dict:
+        """the model's state dict with the averaged weights."""
+        state = self.model.state_dict()
+        state.update(self.shadow)
+        return state
+
+    @contextmanager
+    def average_parameters(self):
+        """use the averaged weights in the model within the context, the model weights are restored afterward."""
+        backup = {k: v.detach().clone() for k, v in self.model.state_dict().items() if k in self.shadow}
+        self.model.load_state_dict(self.shadow, strict=False)
+        try:
+            yield
+        finally:
+            self.model.load_state_dict(backup, strict=False)
@@ -1,6 +1,6 @@
 import torch.nn as nn
 import torch
-from torch.nn.functional import mse_loss
+from torch.nn.functional import mse_loss, pad
 from dptb.utils.register import Register
 from dptb.nn.energy import Eigenvalues
 from dptb.nn.hamiltonian import E3Hamiltonian
@@ -15,6 +15,31 @@ from dptb.utils.constants import anglrMId
 from dptb.nn.dftbsk import DFTBSK
 import re
 
+def apply_onsite_shift(idp: OrbitalMapper, data: AtomicDataDict.Type, ref_data: AtomicDataDict.Type) -> AtomicDataDict.Type:
+    """
+    Shift the reference hamiltonian of each structure by mu * S, where mu is the mean difference between the predicted
+    and reference diagonal onsite elements of the structure, so that the loss does not depend on the energy reference.
+
+    The means of all the structures of a batch are computed at once with segment sums over the batch index of the
+    nodes, and the edges take the shift of the structure of their first atom.
+    """
+    atom_types = data[AtomicDataDict.ATOM_TYPE_KEY].flatten()
+    batch = data.get(AtomicDataDict.BATCH_KEY)
+    if batch is None:
+        batch = torch.zeros_like(atom_types)
+    num_graphs = int(batch.max()) + 1
+
+    mask = idp.mask_to_ndiag[atom_types]
+    diff = (data[AtomicDataDict.NODE_FEATURES_KEY] - ref_data[AtomicDataDict.NODE_FEATURES_KEY]).detach() * mask
+    total = torch.zeros(num_graphs, dtype=diff.dtype, device=diff.device).index_add_(0, batch, diff.sum(dim=1))
+    count = torch.zeros(num_graphs, dtype=diff.dtype, device=diff.device).index_add_(0, batch, mask.sum(dim=1).type_as(diff))
+    mu = total / count.clamp(min=1)
+
+    edge_batch = batch[data[AtomicDataDict.EDGE_INDEX_KEY][0]]
+    ref_data[AtomicDataDict.NODE_FEATURES_KEY] = ref_data[AtomicDataDict.NODE_FEATURES_KEY] + mu[batch, None] * ref_data[AtomicDataDict.NODE_OVERLAP_KEY]
+    ref_data[AtomicDataDict.EDGE_FEATURES_KEY] = ref_data[AtomicDataDict.EDGE_FEATURES_KEY] + mu[edge_batch, None] * ref_data[AtomicDataDict.EDGE_OVERLAP_KEY]
+    return ref_data
+
 """this is the register class for descriptors
 
 all descriptors inplemendeted should be a instance of nn.Module class, and provide a forward function that
@@ -86,6 +111,9 @@ class EigLoss(nn.Module):
             diff_weight: float=0.01,
             diff_valence: dict=None,
             spin_deg: int = 2,
+            num_kpoints: int = None,
+            kpoint_importance: float = 0.5,
+            degeneracy_broadening: float = 1e-4,
             dtype: Union[str, torch.dtype] = torch.float32, 
             device: Union[str, torch.device] = torch.device("cpu"),
             **kwargs,
@@ -98,6 +126,10 @@ class EigLoss(nn.Module):
         self.diff_weight = diff_weight
         self.diff_valence = diff_valence  
         self.spin_deg = spin_deg  
+        assert num_kpoints is None or num_kpoints >= 1, "num_kpoints should be a positive integer."
+        assert 0. <= kpoint_importance <= 1., "kpoint_importance should be in [0, 1]."
+        self.num_kpoints = num_kpoints
+        self.kpoint_importance = kpoint_importance
 
 
         if basis is not None:
@@ -118,6 +150,7 @@ class EigLoss(nn.Module):
                 s_edge_field = None,
                 s_node_field = None,
                 s_out_field = None, 
+                broadening=degeneracy_broadening,
                 dtype=dtype, 
                 device=device,
                 )
@@ -131,94 +164,191 @@ class EigLoss(nn.Module):
                 s_edge_field = AtomicDataDict.EDGE_OVERLAP_KEY,
                 s_node_field = AtomicDataDict.NODE_OVERLAP_KEY,
                 s_out_field = AtomicDataDict.OVERLAP_KEY, 
+                broadening=degeneracy_broadening,
                 dtype=dtype, 
                 device=device,
                 )
 
         self.overlap = overlap
     
+    def _eigenvalues(self, data: AtomicDataDict.Type):
+        """Eigenvalues of all structures in ``data``, as a list of (graph indices, eigenvalues [ngraph, nk, nband])."""
+        soc = data.get(AtomicDataDict.NODE_SOC_SWITCH_KEY, False)
+        if isinstance(soc, torch.Tensor):
+            soc = soc.any()
+        if not soc:
+            return self.eigenvalue.batched(data)
+
+        # the batched H(k) construction does not cover SOC, diagonalize the structures one by one
+        out = []
+        for i, item in enumerate(Batch.from_dict(data).to_data_list()):
+            item = self.eigenvalue(AtomicData.to_AtomicDataDict(item))
+            out.append((torch.tensor([i], device=self.device), item[AtomicDataDict.ENERGY_EIGENVALUE_KEY][0].unsqueeze(0)))
+        return out
+
+    def _sample_kpoints(self, data, ref_eigs, band_window, energy_window, nbands_exclude):
+        """
+        Subsample the k-points of each structure, so that only `num_kpoints` + 1 k-points are diagonalized.
+
+        The k-point holding the lowest reference eigenvalue of the band window is always kept, so that the reference
+        is aligned as with all the k-points. The other k-points are drawn with replacement, with probabilities mixing
+        the uniform distribution and, with the fraction `kpoint_importance`, the weight of each k-point in the loss,
+        given by its reference eigenvalues inside and outside the energy window.
+        Each draw k is weighted by 1 / (num_kpoints * p_k), so that for a fixed alignment, the sum over the sampled
+        k-points is an unbiased estimate of the sum over all the k-points. The prediction is however aligned by its
+        minimum over the sampled k-points only, which is its minimum over all the k-points only if that k-point is
+        drawn. Otherwise the predicted bands are shifted up, and the loss is an approximation of the full one,
+        which is close once the predicted band minimum sits near the reference one.
+
+        Returns the data with the sampled k-points, and the indices and weights of the sampled k-points of each structure.
+        """
+        kpoints = data[AtomicDataDict.KPOINT_KEY]
+        kpoints = list(kpoints.unbind()) if kpoints.is_nested else [kpoints] * len(ref_eigs)
+
+        index, weight = [], []
+        for g, label in enumerate(ref_eigs):
+            num_kp = label.shape[0]
+            if num_kp <= self.num_kpoints + 1:
+                index.append(torch.arange(num_kp, device=label.device))
+                weight.append(torch.ones(num_kp, dtype=label.dtype, device=label.device))
+                continue
+
+            exclude = int(nbands_exclude[g])
+            if band_window is not None:
+                band_min, band_max = band_window[g].tolist()
+            else:
+                band_min, band_max = 0, label.shape[-1] - exclude
+            window = label[:, exclude+band_min:exclude+band_max]
+            window = window - window.min()
+            emin, emax = energy_window[g].tolist()
+            inside = (window.gt(emin) * window.lt(emax)).sum(dim=1).type_as(window)
+            outside = window.shape[1] - inside
+            score = inside / inside.sum().clamp(min=1) + self.eout_weight * outside / outside.sum().clamp(min=1)
+            prob = (1 - self.kpoint_importance) / num_kp + self.kpoint_importance * score / score.sum().clamp(min=1e-12)
+
+            k0 = window.min(dim=1).values.argmin()
+            prob[k0] = 0.
+            prob = prob / prob.sum()
+            sample = torch.multinomial(prob, self.num_kpoints, replacement=True)
+            index.append(torch.cat([k0.reshape(1), sample]))
+            weight.append(torch.cat([torch.ones(1, dtype=label.dtype, device=label.device), 1. / (self.num_kpoints * prob[sample])]))
+
+        data = data.copy()
+        data[AtomicDataDict.KPOINT_KEY] = torch.nested.as_nested_tensor([kp[idx] for kp, idx in zip(kpoints, index)])
+        return data, index, weight
+
     def forward(
             self, 
             data: AtomicDataDict, 
             ref_data: AtomicDataDict,
             ):
-        
-        total_loss = 0.
 
-        data = Batch.from_dict(data)
-        ref_data = Batch.from_dict(ref_data)
+        # the k-points are only subsampled for the training loss, the full k-points are used in eval mode.
+        sample = self.training and self.num_kpoints is not None and ref_data.get(AtomicDataDict.ENERGY_EIGENVALUE_KEY) is not None
+        if sample:
+            ref_eigs = list(ref_data[AtomicDataDict.ENERGY_EIGENVALUE_KEY].unbind())
+            num_graphs = len(ref_eigs)
+        else:
+            groups = self._eigenvalues(data)
+            num_graphs = sum(len(group) for group, _ in groups)
 
-        datalist = data.to_data_list()
-        ref_datalist = ref_data.to_data_list()
-        for data, ref_data in zip(datalist, ref_datalist):
-            data = self.eigenvalue(AtomicData.to_AtomicDataDict(data))
-            ref_data = AtomicData.to_AtomicDataDict(ref_data)
             if ref_data.get(AtomicDataDict.ENERGY_EIGENVALUE_KEY) is None:
-                ref_data = self.eigenvalue(ref_data)
-            
-            emin, emax = ref_data.get(AtomicDataDict.ENERGY_WINDOWS_KEY, (None, None))
-            band_min, band_max = ref_data.get(AtomicDataDict.BAND_WINDOW_KEY, (0, None))
-            eig_pred = data[AtomicDataDict.ENERGY_EIGENVALUE_KEY][0] # (n_kpt, n_band)
-            eig_label = ref_data[AtomicDataDict.ENERGY_EIGENVALUE_KEY][0] # (n_kpt, n_band_dft/n_band)
-
-            if self.diff_valence is not None and isinstance(self.diff_valence, dict):
-                nbands_exclude = sum([self.diff_valence[self.idp.type_to_chemical_symbol[int(ii)]] for ii in ref_data['atom_types']])
-                assert nbands_exclude % self.spin_deg == 0
-                nbands_exclude = nbands_exclude // self.spin_deg
+                ref_eigs = [None] * num_graphs
+                for group, eig in self._eigenvalues(ref_data):
+                    for i, g in enumerate(group.tolist()):
+                        ref_eigs[g] = eig[i]
             else:
-                nbands_exclude = 0
-            
-            eig_label = eig_label[:,nbands_exclude:]
-
-            norbs = eig_pred.shape[-1]
-            nbanddft = eig_label.shape[-1]
-            num_kp = eig_label.shape[-2]
+                ref_eigs = list(ref_data[AtomicDataDict.ENERGY_EIGENVALUE_KEY].unbind())
+
+        # band and energy windows of each structure, with +-inf standing for an open energy window
+        band_window = ref_data.get(AtomicDataDict.BAND_WINDOW_KEY)
+        if band_window is not None:
+            band_window = band_window.reshape(num_graphs, 2).long()
+        energy_window = ref_data.get(AtomicDataDict.ENERGY_WINDOWS_KEY)
+        has_energy_window = energy_window is not None
+        if has_energy_window:
+            energy_window = energy_window.reshape(num_graphs, 2)
+        else:
+            energy_window = torch.tensor([[-float("inf"), float("inf")]], device=self.device).expand(num_graphs, 2)
+
+        if self.diff_valence is not None and isinstance(self.diff_valence, dict):
+            valence = torch.tensor([self.diff_valence[symbol] for symbol in self.idp.type_names], dtype=torch.long, device=self.device)
+            atom_types = ref_data[AtomicDataDict.ATOM_TYPE_KEY].flatten()
+            batch = ref_data.get(AtomicDataDict.BATCH_KEY, torch.zeros_like(atom_types))
+            nbands_exclude = torch.zeros(num_graphs, dtype=torch.long, device=self.device).index_add_(0, batch, valence[atom_types])
+            assert (nbands_exclude % self.spin_deg == 0).all()
+            nbands_exclude = nbands_exclude // self.spin_deg
+        else:
+            nbands_exclude = torch.zeros(num_graphs, dtype=torch.long, device=self.device)
 
-            assert num_kp == eig_pred.shape[-2]
-            up_nband = min(norbs, nbanddft)
+        if sample:
+            data, kpoint_index, kpoint_weight = self._sample_kpoints(data, ref_eigs, band_window, energy_window, nbands_exclude)
+            groups = self._eigenvalues(data)
 
-            if band_max == None:
-                band_max = up_nband
+        total_loss = 0.
+        for group, eig_pred in groups:
+            # eig_pred (n_graph, n_kpt, n_band), eig_label (n_graph, n_kpt, n_band_dft/n_band)
+            labels = [ref_eigs[g] for g in group.tolist()]
+            if all(label.shape == labels[0].shape for label in labels):
+                eig_label = torch.stack(labels)
             else:
-                assert band_max <= up_nband
+                # with the sampled k-points, the full labels of a group can also differ in their numbers of k-points
+                max_kp = max(label.shape[0] for label in labels)
+                max_band = max(label.shape[1] for label in labels)
+                eig_label = torch.stack([pad(label, (0, max_band-label.shape[1], 0, max_kp-label.shape[0])) for label in labels])
+            nbanddft = torch.tensor([label.shape[-1] for label in labels], device=self.device)
+            nkpdft = torch.tensor([label.shape[0] for label in labels], device=self.device)
+            exclude = nbands_exclude[group]
 
-            band_min = int(band_min)
-            band_max = int(band_max)
+            norbs = eig_pred.shape[-1]
+            num_kp = eig_label.shape[-2]
+            if not sample:
+                assert num_kp == eig_pred.shape[-2]
+            up_nband = torch.clamp(nbanddft - exclude, max=norbs)
 
-            assert band_min < band_max
-            assert len(eig_pred.shape) == 2 and len(eig_label.shape) == 2
+            if band_window is not None:
+                band_min, band_max = band_window[group].unbind(dim=1)
+                assert (band_max <= up_nband).all()
+            else:
+                band_min, band_max = torch.zeros_like(up_nband), up_nband
+            assert (band_min < band_max).all()
 
             # 对齐eig_pred和eig_label
-            eig_pred_cut = eig_pred[:,band_min:band_max]
-            eig_label_cut = eig_label[:,band_min:band_max]
-
-
-            num_kp, num_bands = eig_pred_cut.shape
-
-            eig_pred_cut = eig_pred_cut - eig_pred_cut.reshape(-1).min()
-            eig_label_cut = eig_label_cut - eig_label_cut.reshape(-1).min()
-
-            
-            if emax != None and emin != None:
-                mask_in = eig_label_cut.lt(emax) * eig_label_cut.gt(emin)
-                mask_out = eig_label_cut.gt(emax) + eig_label_cut.lt(emin)
-            elif emax != None:
-                mask_in = eig_label_cut.lt(emax)
-                mask_out = eig_label_cut.gt(emax)
-            elif emin != None:
-                mask_in = eig_label_cut.gt(emin)
-                mask_out = eig_label_cut.lt(emin)
-            else:
-                mask_in = None
-                mask_out = None
-
-            if mask_in is not None:
-                if torch.any(mask_in).item():
-                    loss = mse_loss(eig_pred_cut.masked_select(mask_in), eig_label_cut.masked_select(mask_in))
-                if torch.any(mask_out).item():
-                    loss = loss + self.eout_weight * mse_loss(eig_pred_cut.masked_select(mask_out), eig_label_cut.masked_select(mask_out))
+            num_bands = int((band_max - band_min).max())
+            bands = torch.arange(num_bands, device=self.device).unsqueeze(0)
+            valid = (bands < (band_max - band_min).unsqueeze(1)).unsqueeze(1)
+            pred_index = (band_min.unsqueeze(1) + bands).clamp(max=norbs-1).unsqueeze(1).expand(-1, eig_pred.shape[-2], -1)
+            label_index = (exclude.unsqueeze(1) + band_min.unsqueeze(1) + bands).clamp(max=eig_label.shape[-1]-1).unsqueeze(1).expand(-1, num_kp, -1)
+            eig_pred_cut = torch.gather(eig_pred, 2, pred_index)
+            eig_label_cut = torch.gather(eig_label, 2, label_index).type_as(eig_pred_cut)
+
+            # the reference is aligned on its own k-points, the padded ones are left out
+            label_valid = valid * (torch.arange(num_kp, device=self.device).unsqueeze(0) < nkpdft.unsqueeze(1)).unsqueeze(-1)
+            eig_pred_cut = eig_pred_cut - eig_pred_cut.masked_fill(~valid, float("inf")).amin(dim=(1, 2), keepdim=True)
+            eig_label_cut = eig_label_cut - eig_label_cut.masked_fill(~label_valid, float("inf")).amin(dim=(1, 2), keepdim=True)
+            eig_pred_cut = eig_pred_cut.masked_fill(~valid, 0.)
+            eig_label_cut = eig_label_cut.masked_fill(~label_valid, 0.)
+
+            emin, emax = energy_window[group].type_as(eig_label_cut).reshape(-1, 2, 1, 1).unbind(dim=1)
+            mask_in = eig_label_cut.lt(emax) * eig_label_cut.gt(emin) * label_valid
+            mask_out = (eig_label_cut.gt(emax) + eig_label_cut.lt(emin)) * label_valid
+            # the normalizations only depend on the reference, they are counted over all the k-points
+            n_in = mask_in.sum(dim=(1, 2))
+            n_out = mask_out.sum(dim=(1, 2))
+
+            if sample:
+                k_index = torch.stack([kpoint_index[g] for g in group.tolist()]).unsqueeze(-1).expand(-1, -1, num_bands)
+                k_weight = torch.stack([kpoint_weight[g] for g in group.tolist()]).unsqueeze(-1).type_as(eig_pred_cut)
+                eig_label_cut = torch.gather(eig_label_cut, 1, k_index)
+                mask_in = torch.gather(mask_in, 1, k_index)
+                mask_out = torch.gather(mask_out, 1, k_index)
+                num_kp = k_index.shape[1]
             else:
-                loss = mse_loss(eig_pred_cut, eig_label_cut)
+                k_weight = 1.
+
+            sq = (eig_pred_cut - eig_label_cut) ** 2
+            loss = (sq * mask_in * k_weight).sum(dim=(1, 2)) / n_in.clamp(min=1)
+            loss = loss + self.eout_weight * (sq * mask_out * k_weight).sum(dim=(1, 2)) / n_out.clamp(min=1)
 
             if self.diff_on:
                 assert num_kp >= 1
@@ -227,21 +357,22 @@ class EigLoss(nn.Module):
                 nk_diff = num_kp
                 k_diff_i = torch.randint(0, num_kp, (nk_diff,), device=self.device)
                 k_diff_j = torch.randint(0, num_kp, (nk_diff,), device=self.device)
-                while (k_diff_i==k_diff_j).all():
+                while num_kp > 1 and (k_diff_i==k_diff_j).all():
                     k_diff_j = torch.randint(0, num_kp, (nk_diff,), device=self.device)
-                if mask_in is not None:
-                    eig_diff_lbl = eig_label_cut.masked_fill(mask_in, 0.)[:, k_diff_i,:] - eig_label_cut.masked_fill(mask_in, 0.)[:,k_diff_j,:]
-                    eig_ddiff_pred = eig_pred_cut.masked_fill(mask_in, 0.)[:,k_diff_i,:] - eig_pred_cut.masked_fill(mask_in, 0.)[:,k_diff_j,:]
+                if has_energy_window:
+                    eig_label_diff = eig_label_cut.masked_fill(mask_in, 0.)
+                    eig_pred_diff = eig_pred_cut.masked_fill(mask_in, 0.)
                 else:
-                    eig_diff_lbl = eig_label_cut[:,k_diff_i,:] - eig_label_cut[:,k_diff_j,:]
-                    eig_ddiff_pred = eig_pred_cut[:,k_diff_i,:]  - eig_pred_cut[:,k_diff_j,:]
-                loss_diff =  mse_loss(eig_diff_lbl, eig_ddiff_pred) 
-                
+                    eig_label_diff, eig_pred_diff = eig_label_cut, eig_pred_cut
+                eig_diff_lbl = eig_label_diff[:, k_diff_i, :] - eig_label_diff[:, k_diff_j, :]
+                eig_ddiff_pred = eig_pred_diff[:, k_diff_i, :] - eig_pred_diff[:, k_diff_j, :]
+                loss_diff = ((eig_diff_lbl - eig_ddiff_pred) ** 2).sum(dim=(1, 2)) / (nk_diff * (band_max - band_min))
+
                 loss = loss + self.diff_weight * loss_diff
 
-            total_loss += loss
+            total_loss += loss.sum()
 
-        return total_loss / len(datalist)
+        return total_loss / num_graphs
 
 # @Loss.register("hamil")
 # class HamilLoss(nn.Module):
@@ -333,26 +464,7 @@ class HamilLossAbs(nn.Module):
         # data[AtomicDataDict.EDGE_FEATURES_KEY].masked_fill(~self.idp.mask_to_erme[data[AtomicDataDict.EDGE_TYPE_KEY]], 0.)
 
         if self.onsite_shift:
-            batch = data.get("batch", torch.zeros(data[AtomicDataDict.POSITIONS_KEY].shape[0]))
-            # assert batch.max() == 0, "The onsite shift is only supported for batchsize=1."
-            mu = data[AtomicDataDict.NODE_FEATURES_KEY][self.idp.mask_to_ndiag[data[AtomicDataDict.ATOM_TYPE_KEY].flatten()]] - \
-                  ref_data[AtomicDataDict.NODE_FEATURES_KEY][self.idp.mask_to_ndiag[ref_data[AtomicDataDict.ATOM_TYPE_KEY].flatten()]]
-            if batch.max() == 0: # when batchsize is zero
-                mu = mu.mean().detach()
-                ref_data[AtomicDataDict.NODE_FEATURES_KEY] = ref_data[AtomicDataDict.NODE_FEATURES_KEY] + mu * ref_data[AtomicDataDict.NODE_OVERLAP_KEY]
-                ref_data[AtomicDataDict.EDGE_FEATURES_KEY] = ref_data[AtomicDataDict.EDGE_FEATURES_KEY] + mu * ref_data[AtomicDataDict.EDGE_OVERLAP_KEY]
-            elif batch.max() >= 1:
-                slices = [data["__slices__"]["pos"][i]-data["__slices__"]["pos"][i-1] for i in range(1,len(data["__slices__"]["pos"]))]
-                slices = [0] + slices
-                ndiag_batch = torch.stack([i.sum() for i in self.idp.mask_to_ndiag[data[AtomicDataDict.ATOM_TYPE_KEY].flatten()].split(slices)])
-                ndiag_batch = torch.cumsum(ndiag_batch, dim=0)
-                mu = torch.stack([mu[ndiag_batch[i]:ndiag_batch[i+1]].mean() for i in range(len(ndiag_batch)-1)])
-                mu = mu.detach()
-                ref_data[AtomicDataDict.NODE_FEATURES_KEY] = ref_data[AtomicDataDict.NODE_FEATURES_KEY] + mu[batch, None] * ref_data[AtomicDataDict.NODE_OVERLAP_KEY]
-                edge_mu_index = torch.zeros(data[AtomicDataDict.EDGE_INDEX_KEY].shape[1], dtype=torch.long, device=self.device)
-                for i in range(1, batch.max().item()+1):
-                    edge_mu_index[data["__slices__"]["edge_index"][i]:data["__slices__"]["edge_index"][i+1]] += i
-                ref_data[AtomicDataDict.EDGE_FEATURES_KEY] = ref_data[AtomicDataDict.EDGE_FEATURES_KEY] + mu[edge_mu_index, None] * ref_data[AtomicDataDict.EDGE_OVERLAP_KEY]
+            ref_data = apply_onsite_shift(self.idp, data, ref_data)
                 
         pre = data[AtomicDataDict.NODE_FEATURES_KEY][self.idp.mask_to_nrme[data[AtomicDataDict.ATOM_TYPE_KEY].flatten()]]
         tgt = ref_data[AtomicDataDict.NODE_FEATURES_KEY][self.idp.mask_to_nrme[ref_data[AtomicDataDict.ATOM_TYPE_KEY].flatten()]]
@@ -407,26 +519,7 @@ class HamilLossBlas(nn.Module):
         # data[AtomicDataDict.EDGE_FEATURES_KEY].masked_fill(~self.idp.mask_to_erme[data[AtomicDataDict.EDGE_TYPE_KEY]], 0.)
 
         if self.onsite_shift:
-            batch = data.get("batch", torch.zeros(data[AtomicDataDict.POSITIONS_KEY].shape[0]))
-            # assert batch.max() == 0, "The onsite shift is only supported for batchsize=1."
-            mu = data[AtomicDataDict.NODE_FEATURES_KEY][self.idp.mask_to_ndiag[data[AtomicDataDict.ATOM_TYPE_KEY].flatten()]] - \
-                  ref_data[AtomicDataDict.NODE_FEATURES_KEY][self.idp.mask_to_ndiag[ref_data[AtomicDataDict.ATOM_TYPE_KEY].flatten()]]
-            if batch.max() == 0: # when batchsize is zero
-                mu = mu.mean().detach()
-                ref_data[AtomicDataDict.NODE_FEATURES_KEY] = ref_data[AtomicDataDict.NODE_FEATURES_KEY] + mu * ref_data[AtomicDataDict.NODE_OVERLAP_KEY]
-                ref_data[AtomicDataDict.EDGE_FEATURES_KEY] = ref_data[AtomicDataDict.EDGE_FEATURES_KEY] + mu * ref_data[AtomicDataDict.EDGE_OVERLAP_KEY]
-            elif batch.max() >= 1:
-                slices = [data["__slices__"]["pos"][i]-data["__slices__"]["pos"][i-1] for i in range(1,len(data["__slices__"]["pos"]))]
-                slices = [0] + slices
-                ndiag_batch = torch.stack([i.sum() for i in self.idp.mask_to_ndiag[data[AtomicDataDict.ATOM_TYPE_KEY].flatten()].split(slices)])
-                ndiag_batch = torch.cumsum(ndiag_batch, dim=0)
-                mu = torch.stack([mu[ndiag_batch[i]:ndiag_batch[i+1]].mean() for i in range(len(ndiag_batch)-1)])
-                mu = mu.detach()
-                ref_data[AtomicDataDict.NODE_FEATURES_KEY] = ref_data[AtomicDataDict.NODE_FEATURES_KEY] + mu[batch, None] * ref_data[AtomicDataDict.NODE_OVERLAP_KEY]
-                edge_mu_index = torch.zeros(data[AtomicDataDict.EDGE_INDEX_KEY].shape[1], dtype=torch.long, device=self.device)
-                for i in range(1, batch.max().item()+1):
-                    edge_mu_index[data["__slices__"]["edge_index"][i]:data["__slices__"]["edge_index"][i+1]] += i
-                ref_data[AtomicDataDict.EDGE_FEATURES_KEY] = ref_data[AtomicDataDict.EDGE_FEATURES_KEY] + mu[edge_mu_index, None] * ref_data[AtomicDataDict.EDGE_OVERLAP_KEY]
+            ref_data = apply_onsite_shift(self.idp, data, ref_data)
                 
         onsite_loss = data[AtomicDataDict.NODE_FEATURES_KEY]-ref_data[AtomicDataDict.NODE_FEATURES_KEY]
         onsite_index = data[AtomicDataDict.ATOM_TYPE_KEY].flatten().unique()
@@ -547,26 +640,7 @@ class HamilLossWT(nn.Module):
         # data[AtomicDataDict.EDGE_FEATURES_KEY].masked_fill(~self.idp.mask_to_erme[data[AtomicDataDict.EDGE_TYPE_KEY]], 0.)
 
         if self.onsite_shift:
-            batch = data.get("batch", torch.zeros(data[AtomicDataDict.POSITIONS_KEY].shape[0]))
-            # assert batch.max() == 0, "The onsite shift is only supported for batchsize=1."
-            mu = data[AtomicDataDict.NODE_FEATURES_KEY][self.idp.mask_to_ndiag[data[AtomicDataDict.ATOM_TYPE_KEY].flatten()]] - \
-                  ref_data[AtomicDataDict.NODE_FEATURES_KEY][self.idp.mask_to_ndiag[ref_data[AtomicDataDict.ATOM_TYPE_KEY].flatten()]]
-            if batch.max() == 0: # when batchsize is zero
-                mu = mu.mean().detach()
-                ref_data[AtomicDataDict.NODE_FEATURES_KEY] = ref_data[AtomicDataDict.NODE_FEATURES_KEY] + mu * ref_data[AtomicDataDict.NODE_OVERLAP_KEY]
-                ref_data[AtomicDataDict.EDGE_FEATURES_KEY] = ref_data[AtomicDataDict.EDGE_FEATURES_KEY] + mu * ref_data[AtomicDataDict.EDGE_OVERLAP_KEY]
-            elif batch.max() >= 1:
-                slices = [data["__slices__"]["pos"][i]-data["__slices__"]["pos"][i-1] for i in range(1,len(data["__slices__"]["pos"]))]
-                slices = [0] + slices
-                ndiag_batch = torch.stack([i.sum() for i in self.idp.mask_to_ndiag[data[AtomicDataDict.ATOM_TYPE_KEY].flatten()].split(slices)])
-                ndiag_batch = torch.cumsum(ndiag_batch, dim=0)
-                mu = torch.stack([mu[ndiag_batch[i]:ndiag_batch[i+1]].mean() for i in range(len(ndiag_batch)-1)])
-                mu = mu.detach()
-                ref_data[AtomicDataDict.NODE_FEATURES_KEY] = ref_data[AtomicDataDict.NODE_FEATURES_KEY] + mu[batch, None] * ref_data[AtomicDataDict.NODE_OVERLAP_KEY]
-                edge_mu_index = torch.zeros(data[AtomicDataDict.EDGE_INDEX_KEY].shape[1], dtype=torch.long, device=self.device)
-                for i in range(1, batch.max().item()+1):
-                    edge_mu_index[data["__slices__"]["edge_index"][i]:data["__slices__"]["edge_index"][i+1]] += i
-                ref_data[AtomicDataDict.EDGE_FEATURES_KEY] = ref_data[AtomicDataDict.EDGE_FEATURES_KEY] + mu[edge_mu_index, None] * ref_data[AtomicDataDict.EDGE_OVERLAP_KEY]
+            ref_data = apply_onsite_shift(self.idp, data, ref_data)
                 
         onsite_loss = data[AtomicDataDict.NODE_FEATURES_KEY]-ref_data[AtomicDataDict.NODE_FEATURES_KEY]
         onsite_index = data[AtomicDataDict.ATOM_TYPE_KEY].flatten().unique()
@@ -670,26 +744,7 @@ class HamilLossAnalysis(object):
     def __call__(self, data: AtomicDataDict, ref_data: AtomicDataDict, running_avg: bool=False):
 
         if self.onsite_shift:
-            batch = data.get("batch", torch.zeros(data[AtomicDataDict.POSITIONS_KEY].shape[0]))
-            # assert batch.max() == 0, "The onsite shift is only supported for batchsize=1."
-            mu = data[AtomicDataDict.NODE_FEATURES_KEY][self.idp.mask_to_ndiag[data[AtomicDataDict.ATOM_TYPE_KEY].flatten()]] - \
-                  ref_data[AtomicDataDict.NODE_FEATURES_KEY][self.idp.mask_to_ndiag[ref_data[AtomicDataDict.ATOM_TYPE_KEY].flatten()]]
-            if batch.max() == 0: # when batchsize is zero
-                mu = mu.mean().detach()
-                ref_data[AtomicDataDict.NODE_FEATURES_KEY] = ref_data[AtomicDataDict.NODE_FEATURES_KEY] + mu * ref_data[AtomicDataDict.NODE_OVERLAP_KEY]
-                ref_data[AtomicDataDict.EDGE_FEATURES_KEY] = ref_data[AtomicDataDict.EDGE_FEATURES_KEY] + mu * ref_data[AtomicDataDict.EDGE_OVERLAP_KEY]
-            elif batch.max() >= 1:
-                slices = [data["__slices__"]["pos"][i]-data["__slices__"]["pos"][i-1] for i in range(1,len(data["__slices__"]["pos"]))]
-                slices = [0] + slices
-                ndiag_batch = torch.stack([i.sum() for i in self.idp.mask_to_ndiag[data[AtomicDataDict.ATOM_TYPE_KEY].flatten()].split(slices)])
-                ndiag_batch = torch.cumsum(ndiag_batch, dim=0)
-                mu = torch.stack([mu[ndiag_batch[i]:ndiag_batch[i+1]].mean() for i in range(len(ndiag_batch)-1)])
-                mu = mu.detach()
-                ref_data[AtomicDataDict.NODE_FEATURES_KEY] = ref_data[AtomicDataDict.NODE_FEATURES_KEY] + mu[batch, None] * ref_data[AtomicDataDict.NODE_OVERLAP_KEY]
-                edge_mu_index = torch.zeros(data[AtomicDataDict.EDGE_INDEX_KEY].shape[1], dtype=torch.long, device=self.device)
-                for i in range(1, batch.max().item()+1):
-                    edge_mu_index[data["__slices__"]["edge_index"][i]:data["__slices__"]["edge_index"][i+1]] += i
-                ref_data[AtomicDataDict.EDGE_FEATURES_KEY] = ref_data[AtomicDataDict.EDGE_FEATURES_KEY] + mu[edge_mu_index, None] * ref_data[AtomicDataDict.EDGE_OVERLAP_KEY]
+            ref_data = apply_onsite_shift(self.idp, data, ref_data)
                 
         if self.decompose:
             data = self.e3h(data)
@@ -745,7 +800,6 @@ class HamilLossAnalysis(object):
                 
         
         with torch.no_grad():
-            n_total = 0
             err = data[AtomicDataDict.NODE_FEATURES_KEY] - ref_data[AtomicDataDict.NODE_FEATURES_KEY]
             mask = self.idp.mask_to_nrme
             onsite = self.stats.get("onsite")
@@ -767,7 +821,6 @@ class HamilLossAnalysis(object):
                 maerr_per_irreps = self.__cal_norm__(self.idp.orbpair_irreps, maerr_per_irreps)
                 
                 n_element_old = onsite[at]["n_element"]
-                n_total += n_element_old + onsite_err.numel()
                 ratio = n_element_old / (n_element_old + onsite_err.numel())
                 onsite[at] = {
                     "rmse": ((onsite[at]["rmse"]**2) * ratio + (rmserr**2).mean() * (1-ratio)).sqrt(),
@@ -779,8 +832,6 @@ class HamilLossAnalysis(object):
                     "n_element":n_element_old + onsite_err.numel(), 
                     }
                 
-                self.stats["mae"] += onsite[at]["mae"] * onsite[at]["n_element"]
-                self.stats["rmse"] += onsite[at]["rmse"]**2 * onsite[at]["n_element"]
 
             err = data[AtomicDataDict.EDGE_FEATURES_KEY] - ref_data[AtomicDataDict.EDGE_FEATURES_KEY]
             amp = ref_data[AtomicDataDict.EDGE_FEATURES_KEY].abs()
@@ -805,7 +856,6 @@ class HamilLossAnalysis(object):
                 maerr_per_irreps = self.__cal_norm__(self.idp.orbpair_irreps, maerr_per_irreps)
                 
                 n_element_old = hopping[bt]["n_element"]
-                n_total += n_element_old + hopping_err.numel()
                 ratio = n_element_old / (n_element_old + hopping_err.numel())
 
                 hopping[bt] = {
@@ -818,8 +868,6 @@ class HamilLossAnalysis(object):
                     "n_element":n_element_old + hopping_err.numel(), 
                     }
                 
-                self.stats["mae"] += hopping[bt]["mae"] * hopping[bt]["n_element"]
-                self.stats["rmse"] += hopping[bt]["rmse"]**2 * hopping[bt]["n_element"]
             
             if self.overlap:
                 err = data[AtomicDataDict.EDGE_OVERLAP_KEY] - ref_data[AtomicDataDict.EDGE_OVERLAP_KEY]
@@ -846,7 +894,6 @@ class HamilLossAnalysis(object):
                     
 
                     n_element_old = hopping[bt]["n_element"]
-                    n_total += n_element_old + hopping_err.numel()
                     ratio = n_element_old / (n_element_old + hopping_err.numel())
 
                     hopping[bt] = {
@@ -859,10 +906,17 @@ class HamilLossAnalysis(object):
                         "n_element":n_element_old + hopping_err.numel(), 
                         }
                     
-                    self.stats["mae"] += hopping[bt]["mae"] * hopping[bt]["n_element"]
-                    self.stats["rmse"] += hopping[bt]["rmse"]**2 * hopping[bt]["n_element"]
 
-            # compute overall mae, rmse
+            # compute overall mae, rmse over all the elements seen so far
+            n_total = 0
+            self.stats["mae"] = 0.
+            self.stats["rmse"] = 0.
+            for key in ["onsite", "hopping", "overlap"]:
+                for v in self.stats.get(key, {}).values():
+                    if v["n_element"] > 0:
+                        n_total += v["n_element"]
+                        self.stats["mae"] += v["mae"] * v["n_element"]
+                        self.stats["rmse"] += v["rmse"]**2 * v["n_element"]
                     
             self.stats["mae"] = self.stats["mae"] / (n_total + 1e-6)
             self.stats["rmse"] = self.stats["rmse"] / (n_total + 1e-6)
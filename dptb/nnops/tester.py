@@ -1,12 +1,14 @@
 import torch
+import json
 import logging
 from dptb.utils.tools import get_lr_scheduler, \
 get_optimizer, j_must_have
 from dptb.nnops.base_tester import BaseTester
 from typing import Union, Optional
-from dptb.data import AtomicDataset, DataLoader, AtomicData
+from dptb.data import AtomicDataset, DataLoader, AtomicData, AtomicDataDict
 from dptb.nn import build_model
-from dptb.nnops.loss import Loss
+from dptb.nnops.loss import Loss, HamilLossAnalysis
+from torch_scatter import scatter
 
 log = logging.getLogger(__name__)
 #TODO: complete the log output for initilizing the trainer
@@ -19,59 +21,140 @@ class Tester(BaseTester):
             common_options: dict,
             model: torch.nn.Module,
             test_datasets: AtomicDataset,
+            results_path: Optional[str]=None,
             ) -> None:
         super(Tester, self).__init__(dtype=common_options["dtype"], device=common_options["device"])
-        
+
         # init the object
         self.model = model.to(self.device)
         self.common_options = common_options
         self.test_options = test_options
-        
+
         self.test_datasets = test_datasets
+        self.task = None
+        if self.test_datasets.get_Hamiltonian:
+            self.task = "hamiltonians"
+        elif self.test_datasets.get_DM:
+            self.task = "DM"
+        else:
+            self.task = "eigenvalues"
+
+        self.test_loader = DataLoader(
+            dataset=self.test_datasets,
+            batch_size=test_options["batch_size"],
+            shuffle=False,
+            **test_options.get("dataloader_options", {})
+            )
+
+        # loss function, the test loss options fall back to the train ones.
+        loss_options = test_options["loss_options"].get("test", test_options["loss_options"]["train"])
+        self.test_lossfunc = Loss(**loss_options, **common_options, idp=self.model.hamiltonian.idp)
+        self.test_lossfunc.eval()
 
-        self.test_loader = DataLoader(dataset=self.train_datasets, batch_size=test_options["batch_size"], shuffle=False)
+        # the metrics are accumulated batch by batch, so that nothing is kept until the end of the test.
+        self.idp = self.model.hamiltonian.idp
+        self.analysis = None
+        if self.task == "hamiltonians":
+            self.analysis = HamilLossAnalysis(
+                idp=self.idp,
+                overlap=common_options.get("overlap", False),
+                onsite_shift=loss_options.get("onsite_shift", False),
+                dtype=self.dtype,
+                device=self.device,
+                )
+        self.loss_sum = 0.
+        self.n_batch = 0
+        self.n_structure = 0
+
+        # the per structure results are streamed to a json lines file.
+        self.results_file = None
+        if results_path is not None:
+            self.results_file = open(results_path, "w")
 
-        # loss function
-        self.test_lossfunc = Loss(**test_options["loss_options"]["test"], **common_options, idp=self.model.hamiltonian.idp)
-    
     def iteration(self, batch):
         '''
         conduct one step forward computation, used in train, test and validation.
         '''
         self.model.eval()
-        batch = batch.to(self.device)
-        
-        # record the batch_info to help reconstructing sub-graph from the batch
-        batch_info = {
-            "__slices__": batch.__slices__,
-            "__cumsum__": batch.__cumsum__,
-            "__cat_dims__": batch.__cat_dims__,
-            "__num_nodes_list__": batch.__num_nodes_list__,
-            "__data_class__": batch.__data_class__,
-        }
+        with torch.inference_mode():
+            batch = batch.to(self.device)
+
+            # record the batch_info to help reconstructing sub-graph from the batch
+            batch_info = {
+                "__slices__": batch.__slices__,
+                "__cumsum__": batch.__cumsum__,
+                "__cat_dims__": batch.__cat_dims__,
+                "__num_nodes_list__": batch.__num_nodes_list__,
+                "__data_class__": batch.__data_class__,
+            }
+            num_graphs = batch.num_graphs
+
+            batch = AtomicData.to_AtomicDataDict(batch)
+
+            batch_for_loss = batch.copy() # make a shallow copy in case the model change the batch data
+            #TODO: the rescale/normalization can be added here
+            batch = self.model(batch)
 
-        batch = AtomicData.to_AtomicDataDict(batch)
+            #TODO: this could make the loss function unjitable since t he batchinfo in batch and batch_for_loss does not necessarily
+            #       match the torch.Tensor requiresment, should be improved further
 
-        batch_for_loss = batch.copy() # make a shallow copy in case the model change the batch data
-        #TODO: the rescale/normalization can be added here
-        batch = self.model(batch)
+            batch.update(batch_info)
+            batch_for_loss.update(batch_info)
 
-        #TODO: this could make the loss function unjitable since t he batchinfo in batch and batch_for_loss does not necessarily 
-        #       match the torch.Tensor requiresment, should be improved further
+            loss = self.test_lossfunc(batch, batch_for_loss)
 
-        batch.update(batch_info)
-        batch_for_loss.update(batch_info)
+            if self.results_file is not None:
+                self._write_results(batch, batch_for_loss, loss, num_graphs)
 
-        loss = self.train_lossfunc(batch, batch_for_loss)
+            if self.analysis is not None:
+                self.analysis(batch, batch_for_loss, running_avg=True)
+
+        self.loss_sum += loss.item()
+        self.n_batch += 1
+        self.n_structure += num_graphs
 
         state = {'field':'iteration', "test_loss": loss.detach()}
         self.call_plugins(queue_name='iteration', time=self.iter, **state)
         self.iter += 1
 
         return loss.detach()
-    
+
+    def _write_results(self, batch, ref_batch, loss, num_graphs):
+        """write one line per structure: its index in the test set, the batch loss, and for the hamiltonians task the error of its matrix elements."""
+        records = [{"index": self.n_structure + i, "batch": self.iter, "batch_loss": loss.item()} for i in range(num_graphs)]
+
+        if self.task == "hamiltonians":
+            node_batch = batch[AtomicDataDict.BATCH_KEY] if AtomicDataDict.BATCH_KEY in batch else \
+                torch.zeros(batch[AtomicDataDict.ATOM_TYPE_KEY].shape[0], dtype=torch.long, device=self.device)
+            edge_batch = node_batch[batch[AtomicDataDict.EDGE_INDEX_KEY][0]]
+            fields = [
+                (AtomicDataDict.NODE_FEATURES_KEY, self.idp.mask_to_nrme[batch[AtomicDataDict.ATOM_TYPE_KEY].flatten()], node_batch),
+                (AtomicDataDict.EDGE_FEATURES_KEY, self.idp.mask_to_erme[batch[AtomicDataDict.EDGE_TYPE_KEY].flatten()], edge_batch),
+            ]
+            abs_sum, sq_sum, count = 0., 0., 0.
+            for field, mask, index in fields:
+                err = (batch[field] - ref_batch[field]) * mask
+                abs_sum = abs_sum + scatter(err.abs().sum(dim=1), index, dim=0, dim_size=num_graphs)
+                sq_sum = sq_sum + scatter(err.square().sum(dim=1), index, dim=0, dim_size=num_graphs)
+                count = count + scatter(mask.sum(dim=1).to(err.dtype), index, dim=0, dim_size=num_graphs)
+            count = count.clamp(min=1)
+            mae = (abs_sum / count).tolist()
+            rmse = (sq_sum / count).sqrt().tolist()
+            for i, record in enumerate(records):
+                record.update({"mae": mae[i], "rmse": rmse[i]})
+
+        for record in records:
+            self.results_file.write(json.dumps(record) + "\n")
+
     def epoch(self) -> None:
 
         for ibatch in self.test_loader:
             # iter with different structure
-            self.iteration(ibatch)
\ No newline at end of file
+            self.iteration(ibatch)
+
+        if self.results_file is not None:
+            self.results_file.close()
+            self.results_file = None
+
+        if self.n_batch > 0:
+            log.info(f"test loss averaged over {self.n_structure} structures in {self.n_batch} batches: {self.loss_sum / self.n_batch:.6f}")
@@ -1,12 +1,17 @@
 import torch
+import math
+from contextlib import nullcontext
 import logging
 from dptb.utils.tools import get_lr_scheduler, \
 get_optimizer, j_must_have
 from dptb.nnops.base_trainer import BaseTrainer
 from typing import Union, Optional
-from dptb.data import AtomicDataset, DataLoader, AtomicData
+from dptb.data import AtomicDataset, DataLoader, AtomicData, AtomicDataDict, BucketBatchSampler
 from dptb.nn import build_model
 from dptb.nnops.loss import Loss
+from dptb.nnops.ema import ExponentialMovingAverage
+from dptb.utils.distributed import get_rank, get_world_size, broadcast_parameters, all_reduce_gradients, all_reduce_mean
+from torch.utils.data.distributed import DistributedSampler
 
 log = logging.getLogger(__name__)
 #TODO: complete the log output for initilizing the trainer
@@ -28,6 +33,10 @@ class Trainer(BaseTrainer):
         
         # init the object
         self.model = model.to(self.device)
+        # in the distributed training, every process starts from the weights of rank 0.
+        self.rank = get_rank()
+        self.world_size = get_world_size()
+        broadcast_parameters(self.model)
         self.optimizer = get_optimizer(model_param=self.model.parameters(), **train_options["optimizer"])
         self.lr_scheduler = get_lr_scheduler(optimizer=self.optimizer, **train_options["lr_scheduler"])  # add optmizer
         self.update_lr_per_step_flag = train_options["update_lr_per_step_flag"]
@@ -55,34 +64,98 @@ class Trainer(BaseTrainer):
         else:
             self.use_validation = False
 
-        self.train_loader = DataLoader(dataset=self.train_datasets, batch_size=train_options["batch_size"], shuffle=True)
+        self.train_loader = self._build_loader(self.train_datasets, batch_size=train_options["batch_size"])
 
         if self.use_reference:
-            self.reference_loader = DataLoader(dataset=self.reference_datesets, batch_size=train_options["ref_batch_size"], shuffle=True)
+            self.reference_loader = self._build_loader(self.reference_datesets, batch_size=train_options["ref_batch_size"])
+            # the reference batches are drawn from one iterator that restarts when exhausted, 
+            # so that the whole reference set is covered and reshuffled once per pass.
+            self.reference_iter = None
+            self.reference_ratio = train_options.get("reference_ratio", 1.0)
+            assert 0. < self.reference_ratio <= 1., "The reference_ratio should be in (0, 1]."
+            self.reference_credit = 0.
 
         if self.use_validation:
-            self.validation_loader = DataLoader(dataset=self.validation_datasets, batch_size=train_options["val_batch_size"], shuffle=True)
+            # the validation set is not sharded, it is evaluated by the processes that validate.
+            self.validation_loader = self._build_loader(self.validation_datasets, batch_size=train_options["val_batch_size"], distributed=False)
 
         # loss function
         self.train_lossfunc = Loss(**train_options["loss_options"]["train"], **common_options, idp=self.model.hamiltonian.idp)
         if self.use_validation:
             self.validation_lossfunc = Loss(**train_options["loss_options"]["validation"], **common_options, idp=self.model.hamiltonian.idp)
+            # in eval mode, the validation loss uses all the k-points even if the options subsample them.
+            self.validation_lossfunc.eval()
         if self.use_reference:
             self.reference_lossfunc = Loss(**train_options["loss_options"]["reference"], **common_options, idp=self.model.hamiltonian.idp)
 
+        # the gradients of `accumulate_steps` batches are summed, weighted by `normalization`, before each optimizer step.
+        gradient_options = train_options.get("gradient", {})
+        self.accumulate_steps = gradient_options.get("accumulate_steps", 1)
+        self.normalization = gradient_options.get("normalization", "batch")
+        assert self.accumulate_steps >= 1, "The accumulate_steps should be a positive integer."
+        assert self.normalization in ["batch", "atoms", "edges"], "The gradient normalization should be one of batch, atoms and edges."
+        self.clip_norm = gradient_options.get("clip_norm", None)
+        self.spike_factor = gradient_options.get("spike_factor", None)
+        self.spike_warmup = gradient_options.get("spike_warmup", 10)
+        self.accumulated = 0
+        self.accumulated_weight = 0.
+        self.grad_norm_avg = None
+        self.n_steps = 0
+        self.n_skipped = 0
+
+        mixed_precision = train_options.get("mixed_precision", {})
+        if mixed_precision.get("enable", False):
+            assert hasattr(self.model, "enable_autocast"), "The mixed precision training is only supported by the nnenv models."
+            self.model.enable_autocast(dtype=mixed_precision.get("dtype", "bfloat16"))
+
+        # the moving average of the weights is used for the validation and saved with the checkpoints.
+        ema_options = train_options.get("ema", {})
+        self.ema = None
+        if ema_options.get("enable", False):
+            self.ema = ExponentialMovingAverage(self.model, decay=ema_options.get("decay", 0.999), warmup=ema_options.get("warmup", 10))
+
         if  train_options["loss_options"]["train"]["method"] == "skints":
             assert self.model.name == 'nnsk', "The model should be nnsk for the skints loss function."
             assert self.model.onsite_fn.functype in ['none', 'uniform'], "The onsite function should be none or uniform for the skints loss function."
             log.info("The skints loss function is used for training, the model.transform is then set to False.")
             self.model.transform = False
 
+    def _build_loader(self, dataset: AtomicDataset, batch_size: int, distributed: bool=True) -> DataLoader:
+        """
+        build a shuffled loader, packing batches by size if a batch budget is set in train_options.
+
+        In the distributed training, each process loads its own shard of the batches unless `distributed` is False.
+        """
+        budget = self.train_options.get("batch_budget", {})
+        loader_options = self.train_options.get("dataloader_options", {})
+        num_replicas, rank = (self.world_size, self.rank) if distributed else (1, 0)
+        if any(v is not None for v in budget.values()):
+            sampler = BucketBatchSampler(
+                dataset, 
+                max_batch_size=batch_size, 
+                shuffle=True, 
+                seed=self.common_options.get("seed", 0), 
+                num_replicas=num_replicas,
+                rank=rank,
+                **budget
+                )
+            return DataLoader(dataset=dataset, batch_sampler=sampler, **loader_options)
+
+        if num_replicas > 1:
+            sampler = DistributedSampler(dataset, num_replicas=num_replicas, rank=rank, shuffle=True, seed=self.common_options.get("seed", 0))
+            return DataLoader(dataset=dataset, batch_size=batch_size, sampler=sampler, **loader_options)
+        
+        return DataLoader(dataset=dataset, batch_size=batch_size, shuffle=True, **loader_options)
+
     def iteration(self, batch, ref_batch=None):
         '''
         conduct one step forward computation, used in train, test and validation.
         '''
         self.model.train()
-        self.optimizer.zero_grad(set_to_none=True)
-        batch = batch.to(self.device)
+        if self.accumulated == 0:
+            self.optimizer.zero_grad(set_to_none=True)
+        with self.stage("to_device"):
+            batch = batch.to(self.device)
         
         # record the batch_info to help reconstructing sub-graph from the batch
         batch_info = {
@@ -93,11 +166,20 @@ class Trainer(BaseTrainer):
             "__data_class__": batch.__data_class__,
         }
 
-        batch = AtomicData.to_AtomicDataDict(batch)
+        with self.stage("to_dict"):
+            batch = AtomicData.to_AtomicDataDict(batch)
+
+        if self.normalization == "atoms":
+            weight = batch[AtomicDataDict.POSITIONS_KEY].shape[0]
+        elif self.normalization == "edges":
+            weight = batch[AtomicDataDict.EDGE_INDEX_KEY].shape[1]
+        else:
+            weight = 1.
 
         batch_for_loss = batch.copy() # make a shallow copy in case the model change the batch data
         
-        batch = self.model(batch)
+        with self.stage("forward"):
+            batch = self.model(batch)
 
         #TODO: this could make the loss function unjitable since t he batchinfo in batch and batch_for_loss does not necessarily 
         #       match the torch.Tensor requiresment, should be improved further
@@ -105,10 +187,12 @@ class Trainer(BaseTrainer):
         batch.update(batch_info)
         batch_for_loss.update(batch_info)
 
-        loss = self.train_lossfunc(batch, batch_for_loss)
+        with self.stage("loss"):
+            loss = self.train_lossfunc(batch, batch_for_loss)
 
         if ref_batch is not None:
-            ref_batch = ref_batch.to(self.device) # AtomicData Type
+            with self.stage("to_device"):
+                ref_batch = ref_batch.to(self.device) # AtomicData Type
             batch_info = {
                 "__slices__": ref_batch.__slices__,
                 "__cumsum__": ref_batch.__cumsum__,
@@ -117,31 +201,34 @@ class Trainer(BaseTrainer):
                 "__data_class__": ref_batch.__data_class__,
             }
 
-            ref_batch = AtomicData.to_AtomicDataDict(ref_batch) # AtomicDataDict Type
+            with self.stage("to_dict"):
+                ref_batch = AtomicData.to_AtomicDataDict(ref_batch) # AtomicDataDict Type
             ref_batch_for_loss = ref_batch.copy()
-            ref_batch = self.model(ref_batch)
+            with self.stage("forward"):
+                ref_batch = self.model(ref_batch)
 
             ref_batch.update(batch_info)
             ref_batch_for_loss.update(batch_info)
             
-            loss += self.train_lossfunc(ref_batch, ref_batch_for_loss)
-
-        self.optimizer.zero_grad(set_to_none=True)
-        loss.backward()
-        #TODO: add clip large gradient
-        self.optimizer.step()
-        if self.update_lr_per_step_flag:
-            if isinstance(self.lr_scheduler, torch.optim.lr_scheduler.ReduceLROnPlateau):
-                self.lr_scheduler.step(self.stats["train_loss"]["epoch_mean"])
-            else:
-                self.lr_scheduler.step()
-
-        state = {'field':'iteration', "train_loss": loss.detach(), "lr": self.optimizer.state_dict()["param_groups"][0]['lr']}
-        self.call_plugins(queue_name='iteration', time=self.iter, **state)
+            with self.stage("loss"):
+                loss += self.train_lossfunc(ref_batch, ref_batch_for_loss)
+
+        with self.stage("backward"):
+            (loss * weight).backward()
+        self.accumulated += 1
+        self.accumulated_weight += weight
+
+        if self.accumulated >= self.accumulate_steps:
+            with self.stage("optimizer"):
+                self.step()
+
+        # the loss recorded by the plugins is the mean over the processes, the same on all of them.
+        loss = all_reduce_mean(loss.detach())
+        state = {'field':'iteration', "train_loss": loss, "lr": self.optimizer.state_dict()["param_groups"][0]['lr']}
+        with self.stage("plugins"):
+            self.call_plugins(queue_name='iteration', time=self.iter, **state)
         self.iter += 1
 
-        #TODO: add EMA
-
         return loss.detach()
     
     @classmethod
@@ -176,6 +263,9 @@ class Trainer(BaseTrainer):
         trainer.ep = ckpt["epoch"] + 1
         trainer.iter = ckpt["iteration"] + 1
         trainer.stats = ckpt["stats"]
+        if isinstance(trainer.train_loader.batch_sampler, BucketBatchSampler):
+            # continue the sampling order of the epochs after the checkpoint
+            trainer.train_loader.batch_sampler.set_epoch(ckpt["epoch"])
 
         queues_name = list(trainer.plugin_queues.keys())
         for unit in queues_name:
@@ -187,23 +277,102 @@ class Trainer(BaseTrainer):
             if item is not None:
                 item.load_state_dict(ckpt[key+"_state_dict"])
 
+        if trainer.ema is not None:
+            if "ema_state_dict" in ckpt:
+                trainer.ema.load_state_dict(ckpt["ema_state_dict"])
+            else:
+                log.info("The checkpoint has no EMA weights, the EMA starts from the restarted weights.")
+
         return trainer
 # 
 
+    def step(self):
+        """
+        Update the weights with the accumulated gradients.
+
+        The summed gradients are divided by the summed weights of the batches, averaged over the processes in
+        the distributed training, and clipped to `clip_norm`. The step is skipped if the gradient norm is not
+        finite or exceeds `spike_factor` times its running average.
+        """
+        parameters = [p for p in self.model.parameters() if p.requires_grad]
+        all_reduce_gradients(parameters)
+        weight = all_reduce_mean(torch.tensor(self.accumulated_weight, dtype=torch.float64)).item()
+        for p in parameters:
+            if p.grad is not None:
+                p.grad.div_(weight)
+        self.accumulated = 0
+        self.accumulated_weight = 0.
+
+        max_norm = self.clip_norm if self.clip_norm is not None else float("inf")
+        grad_norm = torch.nn.utils.clip_grad_norm_(parameters, max_norm).item()
+
+        skip = not math.isfinite(grad_norm)
+        if not skip and self.spike_factor is not None and self.grad_norm_avg is not None and self.n_steps >= self.spike_warmup:
+            skip = grad_norm > self.spike_factor * self.grad_norm_avg
+        if skip:
+            self.n_skipped += 1
+            log.warning(f"Skip the optimizer step at iteration {self.iter}, the gradient norm {grad_norm:.4e} is not finite or spikes over its average {self.grad_norm_avg}.")
+            self.optimizer.zero_grad(set_to_none=True)
+            return
+
+        self.grad_norm_avg = grad_norm if self.grad_norm_avg is None else 0.9 * self.grad_norm_avg + 0.1 * grad_norm
+        self.n_steps += 1
+        self.optimizer.step()
+        self.optimizer.zero_grad(set_to_none=True)
+        if self.ema is not None:
+            self.ema.update()
+        if self.update_lr_per_step_flag:
+            if isinstance(self.lr_scheduler, torch.optim.lr_scheduler.ReduceLROnPlateau):
+                self.lr_scheduler.step(self.stats["train_loss"]["epoch_mean"])
+            else:
+                self.lr_scheduler.step()
+
     def epoch(self) -> None:
+        if isinstance(self.train_loader.sampler, DistributedSampler):
+            self.train_loader.sampler.set_epoch(self.ep)
 
-        for ibatch in self.train_loader:
+        train_loader = self.train_loader if self.profiler is None else self.profiler.wrap_loader(self.train_loader)
+        for ibatch in train_loader:
             # iter with different structure
-            if self.use_reference:
-                self.iteration(ibatch, next(iter(self.reference_loader)))
-            else:
-                self.iteration(ibatch)
+            self.iteration(ibatch, self.next_reference_batch())
+
+        # the batches left at the end of the epoch make a smaller step.
+        if self.accumulated > 0:
+            self.step()
+
+    def next_reference_batch(self):
+        """
+        The reference batch to train together with the next training batch, or None.
+
+        A reference batch joins a fraction `reference_ratio` of the training steps, evenly spread.
+        """
+        if not self.use_reference:
+            return None
+        self.reference_credit += self.reference_ratio
+        if self.reference_credit < 1.:
+            return None
+        self.reference_credit -= 1.
+
+        with self.stage("data"):
+            if self.reference_iter is None:
+                self.reference_iter = iter(self.reference_loader)
+            try:
+                return next(self.reference_iter)
+            except StopIteration:
+                self.reference_iter = iter(self.reference_loader)
+                return next(self.reference_iter)
 
     def update(self, **kwargs):
         pass
 
+    def evaluation_state_dict(self):
+        """the weights used for the evaluation: the moving average if enabled, otherwise the model weights."""
+        if self.ema is not None:
+            return self.ema.averaged_state_dict()
+        return self.model.state_dict()
+
     def validation(self, fast=True):
-        with torch.no_grad():
+        with torch.no_grad(), self.ema.average_parameters() if self.ema is not None else nullcontext():
             loss = torch.scalar_tensor(0., dtype=self.dtype, device=self.device)
             self.model.eval()
 
@@ -0,0 +1,176 @@
+from dptb.plugins.monitor import Monitor
+import logging
+import queue
+import traceback
+import torch
+import torch.multiprocessing as mp
+
+log = logging.getLogger(__name__)
+
+class AsyncValidationer(Monitor):
+    """
+    Evaluate the whole validation set in a background CPU process, on snapshots of the model weights.
+
+    A snapshot of the weights, the moving average if the trainer has one, is copied to shared memory at the end
+    of every epoch, and every `interval` iterations if the validation process is idle. The training goes on
+    while the snapshot is evaluated.
+    When a result comes back, it is recorded in `trainer.stats["validation_loss"]`, and the plugins
+    registered on the `validation` queue are called with the loss and the weights that were evaluated,
+    so that the `Saver` can keep the checkpoint with the true best validation loss.
+
+    At most `max_pending` snapshots wait for the validation process, the epoch snapshot waits for a
+    result when the limit is reached. Call `finish` to collect the pending results and stop the process.
+    """
+    stat_name = 'validation_loss'
+
+    def __init__(self, interval=None, max_pending=2, num_threads=1):
+        super(AsyncValidationer, self).__init__(precision=6)
+        if interval is not None:
+            self.trigger_interval = interval
+        self.max_pending = max_pending
+        self.num_threads = num_threads
+        self.process = None
+        self.snapshots = {}
+        self.n_results = 0
+
+    def register(self, trainer):
+        super(AsyncValidationer, self).register(trainer)
+        stats = self.trainer.stats[self.stat_name]
+        # no result before the first snapshot has been evaluated.
+        stats['last'] = float('nan')
+        stats['running_avg'] = float('nan')
+        stats['epoch_mean'] = float('nan')
+
+        common_options = dict(trainer.common_options)
+        common_options["device"] = "cpu"
+        ctx = mp.get_context("spawn")
+        self.requests = ctx.Queue()
+        self.results = ctx.Queue()
+        self.process = ctx.Process(
+            target=_validation_worker,
+            kwargs={
+                "model_options": trainer.model.model_options,
+                "common_options": common_options,
+                "loss_options": trainer.train_options["loss_options"]["validation"],
+                "dataset": trainer.validation_datasets,
+                "batch_size": trainer.train_options["val_batch_size"],
+                "transform": getattr(trainer.model, "transform", None),
+                "num_threads": self.num_threads,
+                "requests": self.requests,
+                "results": self.results,
+                },
+            daemon=True,
+            )
+        self.process.start()
+
+    def iteration(self, **kwargs):
+        self._collect(block=False)
+        if len(self.snapshots) == 0:
+            self._submit()
+
+    def epoch(self, **kwargs):
+        self._collect(block=False)
+        while len(self.snapshots) >= self.max_pending:
+            self._collect(block=True)
+        self._submit()
+
+    def _submit(self):
+        # the tensors put in a torch.multiprocessing queue are moved to shared memory, the process reads them without a copy.
+        state = {k: v.detach().to("cpu", copy=True) for k, v in self.trainer.evaluation_state_dict().items()}
+        tag = (self.trainer.ep, self.trainer.iter)
+        self.snapshots[tag] = state
+        self.requests.put((tag, state))
+
+    def _collect(self, block):
+        """record the results that came back, waiting for one if `block`."""
+        while len(self.snapshots) > 0:
+            try:
+                tag, loss = self.results.get(block=block, timeout=1. if block else None)
+            except queue.Empty:
+                if block and self.process.is_alive():
+                    continue
+                if not self.process.is_alive():
+                    raise RuntimeError("The validation process exited unexpectedly.")
+                return
+            if isinstance(loss, str):
+                raise RuntimeError("The validation failed with:\n" + loss)
+            self._record(tag, loss)
+            block = False
+
+    def _record(self, tag, loss):
+        state = self.snapshots.pop(tag)
+        stats = self.trainer.stats[self.stat_name]
+        stats['last'] = loss
+        stats['epoch_mean'] = loss
+        if self.n_results == 0:
+            stats['running_avg'] = loss
+        else:
+            stats['running_avg'] = stats['running_avg'] * self.smoothing + loss * (1 - self.smoothing)
+        self.n_results += 1
+
+        self.trainer.call_plugins(
+            queue_name='validation',
+            time=self.n_results,
+            validation_loss=loss,
+            model_state_dict=state,
+            epoch=tag[0],
+            iteration=tag[1],
+            )
+
+    def finish(self):
+        """wait for the pending results and stop the validation process."""
+        if self.process is None:
+            return
+        while len(self.snapshots) > 0:
+            self._collect(block=True)
+        self.requests.put(None)
+        self.process.join()
+        self.process = None
+
+
+def _validation_worker(model_options, common_options, loss_options, dataset, batch_size, transform, num_threads, requests, results):
+    from dptb.nn import build_model
+    from dptb.nnops.loss import Loss
+    from dptb.data import DataLoader, AtomicData
+
+    torch.set_num_threads(num_threads)
+    try:
+        model = build_model(checkpoint=None, model_options=model_options, common_options=common_options)
+        if transform is not None:
+            model.transform = transform
+        model.eval()
+        lossfunc = Loss(**loss_options, **common_options, idp=model.hamiltonian.idp)
+        lossfunc.eval()
+        loader = DataLoader(dataset=dataset, batch_size=batch_size, shuffle=False)
+    except Exception:
+        results.put((None, traceback.format_exc()))
+        return
+
+    while True:
+        item = requests.get()
+        if item is None:
+            return
+        tag, state = item
+        try:
+            model.load_state_dict(state)
+            loss, n_batch = 0., 0
+            with torch.inference_mode():
+                for batch in loader:
+                    batch_info = {
+                        "__slices__": batch.__slices__,
+                        "__cumsum__": batch.__cumsum__,
+                        "__cat_dims__": batch.__cat_dims__,
+                        "__num_nodes_list__": batch.__num_nodes_list__,
+                        "__data_class__": batch.__data_class__,
+                    }
+                    batch = AtomicData.to_AtomicDataDict(batch)
+                    batch_for_loss = batch.copy()
+                    batch = model(batch)
+                    batch.update(batch_info)
+                    batch_for_loss.update(batch_info)
+
+                    loss += lossfunc(batch, batch_for_loss).item()
+                    n_batch += 1
+            results.put((tag, loss / max(n_batch, 1)))
+        except Exception:
+            results.put((tag, traceback.format_exc()))
@@ -26,7 +26,8 @@ class PluginUser(object):
                     The difference b/w iteration and update the parameters, iteration takes in the batch output, loss etc., while  update takes in model itself.
                 '''
         self.stats = {}  # the status of Trainer.
-        self.plugin_queues = {'disposable': [], 'iteration': [], 'epoch': [], 'batch': [], 'update': []}
+        # validation: events when a result of the asynchronous validation comes back.
+        self.plugin_queues = {'disposable': [], 'iteration': [], 'epoch': [], 'batch': [], 'update': [], 'validation': []}
 
     def register_plugin(self, plugin, **kwargs):
         plugin.register(self, **kwargs)
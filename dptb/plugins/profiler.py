@@ -0,0 +1,144 @@
+from dptb.plugins.base_plugin import Plugin
+from collections import defaultdict
+import logging
+import os
+import time
+import json
+import torch
+
+log = logging.getLogger(__name__)
+
+class Profiler(Plugin):
+    """
+    Record the wall time of each stage of the training iterations.
+
+    The trainer opens the stages with `trainer.stage(name)`, which is a no-op when no profiler is registered.
+    The stages of one iteration are: data (waiting for the DataLoader), to_device, to_dict, forward, loss,
+    backward, optimizer and plugins (logging, checkpointing, ...). The row of an iteration is closed when the
+    next batch is requested from the loader wrapped by `wrap_loader`, or at the end of the epoch.
+    """
+    stages = ["data", "to_device", "to_dict", "forward", "loss", "backward", "optimizer", "plugins"]
+
+    def __init__(self, log_freq=100, trace_freq=0, interval=None):
+        if interval is None:
+            interval = [(1, 'epoch')]
+        super(Profiler, self).__init__(interval)
+        self.log_freq = log_freq
+        self.trace_freq = trace_freq
+        self.current = None
+        self.window = defaultdict(float)
+        self.window_count = 0
+        self.totals = defaultdict(float)
+        self.count = 0
+        self.trace = None
+
+    def register(self, trainer, output=None):
+        self.trainer = trainer
+        self.output = output
+        self.sync = torch.device(trainer.device).type == "cuda"
+        trainer.profiler = self
+
+        self.csv_path = None
+        if output is not None:
+            self.csv_path = os.path.join(output, "profile.csv")
+            with open(self.csv_path, "w") as f:
+                f.write(",".join(["iteration"] + self.stages + ["total"]) + "\n")
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def wrap_loader(self, loader):
+        """yield the batches of the loader, timing the wait for each batch as the data stage of a new row."""
+        iterator = iter(loader)
+        while True:
+            self._flush()
+            stage = self.stage("data")
+            stage.__enter__()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            stage.__exit__()
+            yield batch
+
+    def _add(self, name, dt):
+        if self.current is None:
+            self.current = defaultdict(float)
+            self.current_iter = self.trainer.iter
+        self.current[name] += dt
+
+    def _flush(self):
+        if self.current is None:
+            return
+        row, self.current = self.current, None
+        total = sum(row.values())
+        for k, v in row.items():
+            self.window[k] += v
+            self.totals[k] += v
+        self.window_count += 1
+        self.count += 1
+
+        if self.csv_path is not None:
+            with open(self.csv_path, "a") as f:
+                f.write(",".join([str(self.current_iter)] + ["{:.6f}".format(row.get(k, 0.)) for k in self.stages] + ["{:.6f}".format(total)]) + "\n")
+
+        if self.window_count >= self.log_freq:
+            self._log_window()
+
+        if self.trace_freq > 0:
+            if self.trace is not None:
+                self._stop_trace(self.current_iter)
+            elif self.count % self.trace_freq == 0:
+                # trace the next iteration.
+                self.trace = torch.profiler.profile(record_shapes=True)
+                self.trace.start()
+
+    def _stop_trace(self, iteration):
+        self.trace.stop()
+        if self.output is not None:
+            self.trace.export_chrome_trace(os.path.join(self.output, "trace.iter{}.json".format(iteration)))
+        self.trace = None
+
+    def _summary(self, stats, count):
+        total = sum(stats.values())
+        summary = {}
+        for k in self.stages:
+            if k in stats:
+                summary[k] = {"mean_ms": 1000 * stats[k] / count, "fraction": stats[k] / total if total > 0 else 0.}
+        summary["total"] = {"mean_ms": 1000 * total / count, "fraction": 1.}
+        return summary
+
+    def _log_window(self):
+        summary = self._summary(self.window, self.window_count)
+        msg = " | ".join(["{} {:.2f}ms ({:.0%})".format(k, v["mean_ms"], v["fraction"]) for k, v in summary.items() if k != "total"])
+        log.info("profile of the last {} iterations, {:.2f}ms per iteration: {}".format(self.window_count, summary["total"]["mean_ms"], msg))
+        self.window = defaultdict(float)
+        self.window_count = 0
+
+    def epoch(self, **kwargs):
+        self._flush()
+        if self.output is not None and self.count > 0:
+            with open(os.path.join(self.output, "profile_summary.json"), "w") as f:
+                json.dump({"iterations": self.count, "stages": self._summary(self.totals, self.count)}, f, indent=4)
+
+    def finish(self):
+        """stop and export the trace still running at the end of the training, if the last row started one."""
+        self._flush()
+        if self.trace is not None:
+            self._stop_trace(self.trainer.iter)
+
+
+class _Stage(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        if self.profiler.sync:
+            torch.cuda.synchronize()
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        if self.profiler.sync:
+            torch.cuda.synchronize()
+        self.profiler._add(self.name, time.perf_counter() - self.start)
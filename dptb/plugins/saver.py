@@ -1,21 +1,48 @@
 from dptb.plugins.base_plugin import Plugin
+from dptb.utils.savenload import atomic_write
 from collections import defaultdict
 import logging
 import os
 import time
+import copy
+import queue
+import threading
 import torch
 import json
 
 log = logging.getLogger(__name__)
 
 class Saver(Plugin):
-    def __init__(self, interval=None):
+    def __init__(self, interval=None, async_save=False, min_interval=0., max_pending=2, best_from_validation=False):
+        """
+        Save the latest checkpoints every iteration interval and the best checkpoint every epoch.
+
+        With `best_from_validation`, the best checkpoint is instead chosen from the results of the asynchronous
+        validation, which are received through the `validation` plugin queue together with the evaluated weights.
+
+        With `async_save`, the checkpoint is snapshot to CPU on the training thread and written by a background
+        thread. At most `max_pending` checkpoints wait for the writer; a latest checkpoint arriving when the queue
+        is full is skipped instead of blocking the training. The latest checkpoints are also skipped if the
+        previous one was saved less than `min_interval` seconds ago. Call `finish` to wait for the pending writes.
+        """
         if interval is None:
             interval = [(1, 'iteration'), (1, 'epoch')]
+        if best_from_validation:
+            interval = interval + [(1, 'validation')]
         super(Saver, self).__init__(interval)
+        self.best_from_validation = best_from_validation
         self.best_loss = 1e7
         self.best_quene = []
         self.latest_quene = []
+        self.min_interval = min_interval
+        self.last_save_time = None
+        self.writer_error = None
+        if async_save:
+            self.pending = queue.Queue(maxsize=max_pending)
+            self.writer = threading.Thread(target=self._write_loop, daemon=True)
+            self.writer.start()
+        else:
+            self.pending = None
 
     def register(self, trainer, checkpoint_path):
         self.checkpoint_path = checkpoint_path
@@ -60,14 +87,16 @@ class Saver(Plugin):
             suffix = ".iter{}".format(self.trainer.iter)
             max_ckpt = self.trainer.train_options["max_ckpt"]
 
+        if self.min_interval > 0 and self.last_save_time is not None and time.time() - self.last_save_time < self.min_interval:
+            return
+
         name = self.trainer.model.name+suffix
+        if self._submit(self._save_latest, name, max_ckpt, block=False):
+            self.last_save_time = time.time()
+
+    def _save_latest(self, name, obj, max_ckpt):
         self.latest_quene.append(name)
         
-        if len(self.latest_quene) > max_ckpt:
-            delete_name = self.latest_quene.pop(0)
-            delete_path = os.path.join(self.checkpoint_path, delete_name+".pth")
-            os.remove(delete_path)
-
         if len(self.latest_quene) > max_ckpt:
             delete_name = self.latest_quene.pop(0)
             delete_path = os.path.join(self.checkpoint_path, delete_name+".pth")
@@ -76,13 +105,7 @@ class Saver(Plugin):
             except:
                 log.info(f"Failed to delete the checkpoint file {delete_path}.")
                 
-        self._save(
-            name=name,
-            model=self.trainer.model,
-            model_options=self.trainer.model.model_options,
-            common_options=self.trainer.common_options,
-            train_options=self.trainer.train_options,
-            )
+        self._save(name=name, obj=obj)
         
         if not self.push:
         # 构建一个符号链接，指向最新的模型
@@ -97,6 +120,8 @@ class Saver(Plugin):
             os.symlink(latest_ckpt_abs_path, latest_symlink)
 
     def epoch(self, **kwargs):
+        if self.best_from_validation:
+            return
 
         updated_loss = self.trainer.stats.get('validation_loss')
         if updated_loss is not None:
@@ -111,39 +136,52 @@ class Saver(Plugin):
             #     "%.3f"%self.trainer.model_options["skfunction"]["sk_decay_w"]
             suffix = ".ep{}".format(self.trainer.ep)
             name = self.trainer.model.name+suffix
-            self.best_quene.append(name)
-            if len(self.best_quene) > max_ckpt:
-                delete_name = self.best_quene.pop(0)
-                delete_path = os.path.join(self.checkpoint_path, delete_name+".pth")
-                os.remove(delete_path)
-
-            self._save(
-                name=name,
-                model=self.trainer.model,
-                model_options=self.trainer.model.model_options,
-                common_options=self.trainer.common_options,
-                train_options=self.trainer.train_options,
-                )
-            
+            # the best checkpoints are never skipped.
+            self._submit(self._save_best, name, max_ckpt, block=True)
             self.best_loss = updated_loss
 
-            # 构建一个符号链接，指向best模型
-            best_symlink = os.path.join(self.checkpoint_path, self.trainer.model.name + ".best.pth")
-            if os.path.lexists(best_symlink):
-                os.unlink(best_symlink)
-            best_ckpt = os.path.join(self.checkpoint_path, name+".pth")
-            best_ckpt_abs_path = os.path.abspath(best_ckpt)
-            # 确保源文件存在
-            if not os.path.exists(best_ckpt_abs_path):
-                raise FileNotFoundError(f"Source file {best_ckpt_abs_path} does not exist.")
-            os.symlink(best_ckpt_abs_path, best_symlink)
+    def validation(self, validation_loss, model_state_dict, epoch, iteration, **kwargs):
+        """save the weights evaluated by the asynchronous validation if they are the best so far."""
+        if validation_loss >= self.best_loss:
+            return
+        name = self.trainer.model.name+".ep{}.iter{}".format(epoch, iteration)
+        # the other states are the current ones, only the weights are the evaluated snapshot.
+        ema = getattr(self.trainer, "ema", None)
+        if ema is not None:
+            # the evaluated weights are the moving average.
+            ema_state = {"shadow": {k: model_state_dict[k] for k in ema.shadow.keys()}, "num_updates": ema.num_updates}
+            overrides = {"ema_state_dict": ema_state, "epoch": epoch, "iteration": iteration}
+        else:
+            overrides = {"model_state_dict": model_state_dict, "epoch": epoch, "iteration": iteration}
+        self._submit(self._save_best, name, self.trainer.train_options["max_ckpt"], block=True, overrides=overrides)
+        self.best_loss = validation_loss
+
+    def _save_best(self, name, obj, max_ckpt):
+        self.best_quene.append(name)
+        if len(self.best_quene) > max_ckpt:
+            delete_name = self.best_quene.pop(0)
+            delete_path = os.path.join(self.checkpoint_path, delete_name+".pth")
+            os.remove(delete_path)
 
-    def _save(self, name, model, model_options, common_options, train_options):
+        self._save(name=name, obj=obj)
+
+        # 构建一个符号链接，指向best模型
+        best_symlink = os.path.join(self.checkpoint_path, self.trainer.model.name + ".best.pth")
+        if os.path.lexists(best_symlink):
+            os.unlink(best_symlink)
+        best_ckpt = os.path.join(self.checkpoint_path, name+".pth")
+        best_ckpt_abs_path = os.path.abspath(best_ckpt)
+        # 确保源文件存在
+        if not os.path.exists(best_ckpt_abs_path):
+            raise FileNotFoundError(f"Source file {best_ckpt_abs_path} does not exist.")
+        os.symlink(best_ckpt_abs_path, best_symlink)
+
+    def _snapshot(self, overrides=None):
         obj = {}
-        obj.update({"config": {"model_options": model_options, "common_options": common_options, "train_options": train_options}})
+        obj.update({"config": {"model_options": self.trainer.model.model_options, "common_options": self.trainer.common_options, "train_options": self.trainer.train_options}})
         obj.update(
             {
-                "model_state_dict": model.state_dict(),
+                "model_state_dict": self.trainer.model.state_dict(),
                 "task": self.trainer.task,
                 "optimizer_state_dict": self.trainer.optimizer.state_dict(), 
                 "lr_scheduler_state_dict": self.trainer.lr_scheduler.state_dict(),
@@ -151,8 +189,53 @@ class Saver(Plugin):
                 "iteration":self.trainer.iter, 
                 "stats": self.trainer.stats}
                 )
+        if getattr(self.trainer, "ema", None) is not None:
+            obj["ema_state_dict"] = self.trainer.ema.state_dict()
+        if overrides is not None:
+            obj.update(overrides)
+        if self.pending is not None:
+            # the training goes on while the writer serializes the checkpoint, so it gets its own copy.
+            obj = _copy_to_cpu(obj)
+        return obj
+
+    def _submit(self, fn, name, max_ckpt, block, overrides=None):
+        if self.pending is None:
+            fn(name, self._snapshot(overrides), max_ckpt)
+            return True
+
+        self._check_writer()
+        try:
+            self.pending.put((fn, name, self._snapshot(overrides), max_ckpt), block=block)
+        except queue.Full:
+            log.info(f"The previous checkpoints are still being written, skip the checkpoint {name}.")
+            return False
+        return True
+
+    def _write_loop(self):
+        while True:
+            fn, name, obj, max_ckpt = self.pending.get()
+            try:
+                fn(name, obj, max_ckpt)
+            except Exception as e:
+                self.writer_error = e
+            finally:
+                self.pending.task_done()
+
+    def _check_writer(self):
+        if self.writer_error is not None:
+            error, self.writer_error = self.writer_error, None
+            raise RuntimeError("Failed to write the checkpoint.") from error
+
+    def finish(self):
+        """wait for the pending checkpoints to be written."""
+        if self.pending is not None:
+            self.pending.join()
+            self._check_writer()
+
+    def _save(self, name, obj):
         f_path = os.path.join(self.checkpoint_path, name+".pth")
-        torch.save(obj, f=f_path)
+        with atomic_write(f_path, binary=True) as f:
+            torch.save(obj, f)
 
         # # json_model_types = ["onsite", "hopping","soc"]
         # if  self.trainer.name == "nnsk":
@@ -194,3 +277,20 @@ class Saver(Plugin):
         #         json.dump(json_data, f, indent=4)
             
         log.info(msg="checkpoint saved as {}".format(name))
+
+
+def _copy_to_cpu(obj):
+    """copy the tensors to CPU and the containers recursively, so that the copy is not changed by the training."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    elif isinstance(obj, dict):
+        copied = copy.copy(obj)
+        for k, v in obj.items():
+            copied[k] = _copy_to_cpu(v)
+        return copied
+    elif isinstance(obj, list):
+        return [_copy_to_cpu(v) for v in obj]
+    elif isinstance(obj, tuple):
+        return tuple(_copy_to_cpu(v) for v in obj)
+    else:
+        return obj
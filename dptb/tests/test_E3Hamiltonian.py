@@ -0,0 +1,39 @@
+import pytest
+import torch
+from dptb.nn.hamiltonian import E3Hamiltonian
+from dptb.data import AtomicDataDict
+from dptb.utils.constants import anglrMId
+
+basis = {"Si": ["3s", "4s", "3p", "d*"], "C": ["2s", "2p"]}
+
+def build_data(idp, n_edge=7, n_node=3):
+    torch.manual_seed(0)
+    return {
+        AtomicDataDict.EDGE_INDEX_KEY: torch.zeros(2, n_edge, dtype=torch.long),
+        AtomicDataDict.EDGE_VECTORS_KEY: torch.randn(n_edge, 3, dtype=torch.float64),
+        AtomicDataDict.EDGE_FEATURES_KEY: torch.randn(n_edge, idp.reduced_matrix_element, dtype=torch.float64),
+        AtomicDataDict.NODE_FEATURES_KEY: torch.randn(n_node, idp.reduced_matrix_element, dtype=torch.float64),
+    }
+
+def test_compose_matches_cg_contraction():
+    e3h = E3Hamiltonian(basis=basis, decompose=False, dtype=torch.float64)
+    data = build_data(e3h.idp)
+    ref = {k: data[k].clone() for k in [AtomicDataDict.EDGE_FEATURES_KEY, AtomicDataDict.NODE_FEATURES_KEY]}
+    out = e3h(data)
+
+    for key, rme in ref.items():
+        for opairtype, sl in e3h.idp.orbpairtype_maps.items():
+            l1, l2 = anglrMId[opairtype[0]], anglrMId[opairtype[2]]
+            block = rme[:, sl].reshape(rme.shape[0], -1, (2*l1+1) * (2*l2+1))
+            HR = torch.einsum("abk, nqk -> nqab", e3h.cgbasis[opairtype], block).reshape(rme.shape[0], -1)
+            assert torch.allclose(out[key][:, sl], HR)
+
+@pytest.mark.parametrize("overlap", [False, True])
+def test_decompose_inverts_compose(overlap):
+    compose = E3Hamiltonian(basis=basis, decompose=False, overlap=overlap, dtype=torch.float64)
+    decompose = E3Hamiltonian(basis=basis, decompose=True, overlap=overlap, dtype=torch.float64)
+    data = build_data(compose.idp)
+    ref = {k: data[k].clone() for k in [AtomicDataDict.EDGE_FEATURES_KEY, AtomicDataDict.NODE_FEATURES_KEY]}
+    out = decompose(compose(data))
+    for key, value in ref.items():
+        assert torch.allclose(out[key], value)
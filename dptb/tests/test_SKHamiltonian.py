@@ -8,6 +8,7 @@ from pathlib import Path
 from dptb.data import AtomicDataset, DataLoader, AtomicDataDict, AtomicData
 import numpy as np
 from dptb.nn.hamiltonian import  SKHamiltonian
+from dptb.nn.tensor_product import wigner_D
 from dptb.utils.constants import anglrMId, orbitalId
 from e3nn.o3 import wigner_3j, Irrep, xyz_to_angles, Irrep
 
@@ -225,3 +226,34 @@ class TestSKHamiltonian:
         assert torch.allclose(data[AtomicDataDict.NODE_FEATURES_KEY], expected_strainonsite, atol=1e-6, rtol=1e-4)
 
 
+
+
+def test_fused_rotation():
+    # compare the fused rotation against the per orbital pair type reference
+    torch.manual_seed(0)
+    idp_sk = OrbitalMapper(basis={"Si": ["3s", "3p", "d*"], "C": ["2s", "2p"]}, method="sktb")
+    hamiltonian = SKHamiltonian(idp_sk=idp_sk, onsite=True, dtype=torch.float64)
+    idp = hamiltonian.idp
+
+    n_edge = 17
+    vectors = torch.randn(n_edge, 3, dtype=torch.float64)
+    skparams = torch.randn(n_edge, idp_sk.reduced_matrix_element, dtype=torch.float64)
+    rotations = hamiltonian._rotation_matrices({AtomicDataDict.EDGE_VECTORS_KEY: vectors},
+                                               AtomicDataDict.EDGE_VECTORS_KEY, AtomicDataDict.EDGE_ROTATION_KEY)
+    out = hamiltonian._fused_rotation(skparams, rotations) * hamiltonian.fused_sign
+
+    angle = xyz_to_angles(vectors[:, [1, 2, 0]])
+    for opair in idp_sk.orbpairtype_maps.keys():
+        l1, l2 = anglrMId[opair[0]], anglrMId[opair[2]]
+        n_skp = min(l1, l2) + 1
+        skp = skparams[:, idp_sk.orbpairtype_maps[opair]].reshape(n_edge, -1, n_skp)
+        HR = torch.zeros(n_edge, skp.shape[1], 2*l1+1, 2*l2+1, dtype=torch.float64)
+        for im in range(n_skp):
+            HR[:, :, l1+im, l2+im] = skp[..., im]
+            HR[:, :, l1-im, l2-im] = skp[..., im]
+        D1 = wigner_D(l1, angle[0], angle[1], torch.zeros_like(angle[0]))
+        D2 = wigner_D(l2, angle[0], angle[1], torch.zeros_like(angle[0]))
+        ref = torch.einsum("nlm, nkmo, nqo -> nklq", D1, HR, D2).reshape(n_edge, -1)
+        if l1 < l2:
+            ref = ref * (-1) ** (l1 + l2)
+        assert torch.allclose(out[:, idp.orbpairtype_maps[opair]], ref, atol=1e-10)
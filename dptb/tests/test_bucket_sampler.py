@@ -0,0 +1,69 @@
+import os
+from pathlib import Path
+from dptb.data import DataLoader, AtomicDataDict, BucketBatchSampler
+from dptb.data.build import build_dataset
+
+rootdir = os.path.join(Path(os.path.abspath(__file__)).parent, "data")
+
+
+class TestBucketBatchSampler:
+    data_options = {
+        "r_max": 5.0,
+        "er_max": 5.0,
+        "oer_max": 2.5,
+        "root": f"{rootdir}/test_sktb/dataset",
+        "prefix": "kpath",
+        "separator": "",
+        "get_eigenvalues": True
+    }
+    common_options = {
+        "basis": {"Si": ["3s","3p"]},
+        "device": "cpu",
+        "dtype": "float32",
+        "overlap": False,
+        "seed": 3982377700
+    }
+    dataset = build_dataset(**data_options, **common_options)
+
+    def test_sizes(self):
+        sizes = BucketBatchSampler.structure_sizes(self.dataset)
+        assert sizes.shape == (len(self.dataset), 3)
+        for i in range(len(self.dataset)):
+            data = self.dataset[i]
+            assert sizes[i, 0] == 4 * data.num_nodes # Si: 3s + 3p
+            assert sizes[i, 1] == data[AtomicDataDict.EDGE_INDEX_KEY].shape[1]
+            assert sizes[i, 2] == data.num_nodes
+
+    def test_budget(self):
+        sampler = BucketBatchSampler(self.dataset, max_edges=2000, seed=1)
+        batches = list(sampler)
+        assert sorted(sum(batches, [])) == list(range(len(self.dataset)))
+        for b in batches:
+            assert len(b) == 1 or sampler.sizes[b, 1].sum() <= 2000
+
+    def test_deterministic(self):
+        a = BucketBatchSampler(self.dataset, max_atoms=30, seed=7)
+        b = BucketBatchSampler(self.dataset, max_atoms=30, seed=7)
+        assert list(a) == list(b)
+        assert list(a) == list(b)
+        b.set_epoch(0)
+        a_epoch0 = list(BucketBatchSampler(self.dataset, max_atoms=30, seed=7))
+        assert list(b) == a_epoch0
+
+    def test_loader(self):
+        sampler = BucketBatchSampler(self.dataset, max_orbitals=100, max_batch_size=4, seed=1)
+        loader = DataLoader(dataset=self.dataset, batch_sampler=sampler)
+        nstruct = 0
+        for batch in loader:
+            assert batch.num_graphs <= 4
+            nstruct += batch.num_graphs
+        assert nstruct == len(self.dataset)
+
+    def test_replicas(self):
+        full = BucketBatchSampler(self.dataset, max_atoms=30, seed=3)
+        shards = [list(BucketBatchSampler(self.dataset, max_atoms=30, seed=3, num_replicas=3, rank=r)) for r in range(3)]
+        # every rank has the same number of batches, and together they cover all the batches of one process.
+        assert len(set(len(s) for s in shards)) == 1
+        covered = [b for s in shards for b in s]
+        for b in list(full):
+            assert b in covered
@@ -253,4 +253,30 @@ class TestDataLoaderBatch:
         [ 0.0000000000,  2.2167882919, -0.7837529182],
         [-1.9197947979, -1.1083940268, -0.7837529182],
         [ 0.0000000000,  0.0000000000,  2.3512587547]])
-        assert torch.all(torch.abs(batch[AtomicDataDict.ONSITENV_VECTORS_KEY] - expected_onsiteenv_vectors) < 1e-8)
\ No newline at end of file
+        assert torch.all(torch.abs(batch[AtomicDataDict.ONSITENV_VECTORS_KEY] - expected_onsiteenv_vectors) < 1e-8)
+
+def test_fast_collate_matches_from_data_list():
+    from ase.build import molecule
+
+    data_list = [AtomicData.from_ase(molecule(name), r_max=3.0) for name in ["H2O", "CH4", "NH3", "C2H6", "CH3OH"] * 3]
+    data_list += [TestDataLoaderBatch.train_datasets[0]] # with nested kpoints and eigenvalues
+    collater = Collater()
+
+    for sub_list in [data_list[:-1], data_list[-1:], data_list[-1:] * 2]:
+        batch = collater(sub_list)
+        expected = Batch.from_data_list(sub_list)
+
+        assert batch.num_graphs == expected.num_graphs
+        assert batch.__slices__ == expected.__slices__
+        assert batch.__cumsum__ == expected.__cumsum__
+        assert batch.__cat_dims__ == expected.__cat_dims__
+        assert batch.__num_nodes_list__ == expected.__num_nodes_list__
+        assert batch.__data_class__ == expected.__data_class__
+        assert sorted(batch.keys) == sorted(expected.keys)
+        for key in expected.keys:
+            if expected[key].is_nested:
+                for a, b in zip(batch[key].unbind(), expected[key].unbind()):
+                    assert torch.equal(a, b)
+            else:
+                assert batch[key].dtype == expected[key].dtype
+                assert torch.equal(batch[key], expected[key])
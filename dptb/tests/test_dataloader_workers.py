@@ -0,0 +1,70 @@
+import os
+import pickle
+import torch
+import h5py
+import numpy as np
+from pathlib import Path
+from dptb.data import DataLoader, AtomicDataDict
+from dptb.data.build import build_dataset
+from dptb.data.dataset._default_dataset import _TrajData, _H5File
+
+rootdir = os.path.join(Path(os.path.abspath(__file__)).parent, "data")
+
+
+class TestDataLoaderWorkers:
+    data_options = {
+        "r_max": 5.0,
+        "er_max": 5.0,
+        "oer_max": 2.5,
+        "root": f"{rootdir}/test_sktb/dataset",
+        "prefix": "kpathmd25",
+        "get_eigenvalues": True
+    }
+    common_options = {
+        "basis": {"Si": ["3s","3p"]},
+        "device": "cpu",
+        "dtype": "float32",
+        "overlap": False,
+        "seed": 3982377700
+    }
+    dataset = build_dataset(**data_options, **common_options)
+
+    def test_worker_options_ignored_without_workers(self):
+        loader = DataLoader(dataset=self.dataset, batch_size=2, num_workers=0, prefetch_factor=2, persistent_workers=True)
+        assert loader.num_workers == 0
+        assert loader.persistent_workers == False
+
+    def test_workers(self):
+        serial = DataLoader(dataset=self.dataset, batch_size=3, shuffle=False)
+        parallel = DataLoader(dataset=self.dataset, batch_size=3, shuffle=False, num_workers=2, prefetch_factor=2, persistent_workers=True)
+        for _ in range(2):
+            for a, b in zip(serial, parallel):
+                assert a.__slices__ == b.__slices__
+                assert torch.equal(a[AtomicDataDict.EDGE_INDEX_KEY], b[AtomicDataDict.EDGE_INDEX_KEY])
+                assert torch.equal(a[AtomicDataDict.POSITIONS_KEY], b[AtomicDataDict.POSITIONS_KEY])
+                for ka, kb in zip(a[AtomicDataDict.KPOINT_KEY].unbind(), b[AtomicDataDict.KPOINT_KEY].unbind()):
+                    assert torch.equal(ka, kb)
+
+def test_trajdata_pickle_reopens_h5(tmp_path):
+    with h5py.File(tmp_path / "hamiltonians.h5", "w") as f:
+        f.create_dataset("0/0_0_0_0_0", data=np.eye(4))
+
+    traj = _TrajData(root=str(tmp_path), data={}, get_Hamiltonian=True, info={})
+    assert "0" in traj.data["hamiltonian_blocks"]
+    copied = pickle.loads(pickle.dumps(traj))
+    blocks = copied.data["hamiltonian_blocks"]
+    assert isinstance(blocks, _H5File)
+    assert blocks._file is None
+    assert np.allclose(blocks["0"]["0_0_0_0_0"][:], np.eye(4))
+
+def test_h5file_reopens_in_other_process(tmp_path):
+    with h5py.File(tmp_path / "hamiltonians.h5", "w") as f:
+        f.create_dataset("0/0_0_0_0_0", data=np.eye(4))
+
+    blocks = _H5File(str(tmp_path / "hamiltonians.h5"))
+    handle = blocks.file
+    assert blocks.file is handle
+    # a forked worker inherits the handle of the parent, it opens its own one on the first access.
+    blocks._pid = -1
+    assert blocks.file is not handle
+    assert np.allclose(blocks["0"]["0_0_0_0_0"][:], np.eye(4))
@@ -0,0 +1,68 @@
+import pytest
+import os
+import shutil
+import torch as th
+from pathlib import Path
+from dptb.data.dataset._default_dataset import DefaultDataset
+from dptb.data.dataset._cache import read_manifest
+from dptb.data.transforms import OrbitalMapper
+from dptb.data import AtomicDataDict
+
+rootdir = os.path.join(Path(os.path.abspath(__file__)).parent, "data/test_sktb/dataset")
+
+info_files = {'kpath_spk.0': {'nframes': 1,
+    'natoms': 2,
+    'pos_type': 'ase',
+    'pbc': True,
+    'r_max': 5.0,
+    'er_max': 5.0,
+    'oer_max': 2.5,
+    'bandinfo': {'nkpoints': 61,
+    'nbands': 14,
+    'band_min': 0,
+    'band_max': 6,
+    'emin': -1.0,
+    'emax': 10.0}}}
+
+def build(root):
+    return DefaultDataset(
+        root=root,
+        type_mapper=OrbitalMapper({"Si": ["3s", "3p"]}),
+        get_eigenvalues=True,
+        info_files=info_files)
+
+@pytest.fixture
+def root(tmp_path):
+    shutil.copytree(os.path.join(rootdir, "kpath_spk.0"), tmp_path / "kpath_spk.0")
+    return str(tmp_path)
+
+def test_cache_roundtrip(root):
+    processed = build(root)
+    manifest = read_manifest(processed.processed_dir)
+    assert manifest is not None
+    assert manifest["content_hash"] == processed.content_hash()
+    assert AtomicDataDict.ENERGY_EIGENVALUE_KEY in manifest["fields"]
+
+    loaded = build(root)
+    assert len(loaded) == len(processed)
+    for key, item in processed.data:
+        if item.is_nested:
+            for a, b in zip(item.unbind(), loaded.data[key].unbind()):
+                assert th.equal(a, b)
+        else:
+            assert th.equal(item, loaded.data[key])
+
+    data, ref = loaded.get(0), processed.get(0)
+    assert th.equal(data[AtomicDataDict.EDGE_INDEX_KEY], ref[AtomicDataDict.EDGE_INDEX_KEY])
+    assert th.equal(data[AtomicDataDict.KPOINT_KEY][0], ref[AtomicDataDict.KPOINT_KEY][0])
+
+def test_cache_invalidated_by_raw_content(root):
+    dataset = build(root)
+    old_hash = dataset.content_hash()
+
+    with open(os.path.join(root, "kpath_spk.0", "README"), "w") as f:
+        f.write("regenerated")
+    assert dataset.content_hash() != old_hash
+
+    rebuilt = build(root)
+    assert read_manifest(rebuilt.processed_dir)["content_hash"] == rebuilt.content_hash()
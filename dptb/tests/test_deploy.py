@@ -0,0 +1,47 @@
+import os
+import pytest
+import torch
+from pathlib import Path
+from ase.io import read
+from dptb.nn.build import build_model
+from dptb.data import AtomicData, AtomicDataDict
+from dptb.entrypoints.deploy import deploy, load_deployed
+from dptb.utils.argcheck import get_cutoffs_from_model_options
+
+rootdir = os.path.join(Path(os.path.abspath(__file__)).parent, "data")
+
+
+def test_deploy(tmp_path):
+    ckpt = f"{rootdir}/silicon_1nn/nnsk.ep500.pth"
+    structure = f"{rootdir}/silicon_1nn/silicon.vasp"
+    output = str(tmp_path / "deployed.pth")
+    deploy(init_model=ckpt, output=output, structure=structure)
+
+    model = load_deployed(output)
+    assert not model.training
+    assert all(not p.requires_grad for p in model.parameters())
+
+    ref_model = build_model(ckpt)
+    r_max, er_max, oer_max = get_cutoffs_from_model_options(ref_model.model_options)
+    data = AtomicData.from_ase(read(structure), r_max=r_max, er_max=er_max, oer_max=oer_max)
+    ref = ref_model(ref_model.idp(AtomicData.to_AtomicDataDict(data)))
+    with torch.no_grad():
+        out = model(model.idp(AtomicData.to_AtomicDataDict(data)))
+
+    for field in [AtomicDataDict.EDGE_FEATURES_KEY, AtomicDataDict.NODE_FEATURES_KEY]:
+        assert torch.allclose(out[field], ref[field].detach(), atol=1e-6)
+
+@pytest.mark.skipif(not hasattr(torch, "compile"), reason="torch.compile requires torch>=2.0")
+def test_deploy_compile(tmp_path):
+    ckpt = f"{rootdir}/silicon_1nn/nnsk.ep500.pth"
+    structure = f"{rootdir}/silicon_1nn/silicon.vasp"
+    output = str(tmp_path / "deployed.pth")
+    # check_deployed raises if the compiled model does not reproduce the eager one.
+    deploy(init_model=ckpt, output=output, structure=structure, compile=True)
+    assert os.path.exists(output)
+
+@pytest.mark.skipif(hasattr(torch, "compile"), reason="torch.compile is available")
+def test_deploy_compile_unavailable(tmp_path):
+    with pytest.raises(RuntimeError, match="torch>=2.0"):
+        deploy(init_model=f"{rootdir}/silicon_1nn/nnsk.ep500.pth", output=str(tmp_path / "deployed.pth"),
+               structure=f"{rootdir}/silicon_1nn/silicon.vasp", compile=True)
@@ -1,4 +1,5 @@
 import pytest
+import torch
 import os
 from pathlib import Path
 from dptb.nn.dftb2nnsk import DFTB2NNSK
@@ -53,4 +54,48 @@ def test_skf2nnsk_run():
         init_model = None,
         output = os.path.join(rootdir, "..","test_temp"),
         log_level = 2
-    )
\ No newline at end of file
+    )
+def test_dftb_skints_vs_intp():
+    ref = DFTB2NNSK(
+            basis={"B":["2s"], "N": ["2s"]}, 
+            skdata=os.path.join(rootdir, "slakos"),
+            train_options=TestDFTB2NNSK.train_ops,
+            rs=6.0,
+            w=1.0,
+            method="powerlaw"
+            ).dftb
+    bond_indices = torch.arange(len(ref.bond_types))
+    r = torch.rand(len(bond_indices), 50) * 6 + 0.5
+    hopping, overlap = ref.skints(r, bond_indices=bond_indices)
+    for i in bond_indices:
+        assert torch.allclose(hopping[i], ref.hopping.get_skhij(rij=r[i], xx=ref.param["Distance"], yy=ref.param["Hopping"][i]), atol=1e-5)
+        assert torch.allclose(overlap[i], ref.overlap.get_skhij(rij=r[i], xx=ref.param["Distance"], yy=ref.param["Overlap"][i]), atol=1e-5)
+
+def test_optimize_lbfgs_warm_start():
+    train_ops = {
+        'nstep':3,
+        'dis_freq':1,
+        'nsample':64,
+        'save_freq':1,
+        'max_elmt_batch':4,
+        'warm_start': True,
+        "optimizer": {
+            "lr": 0.1,
+            "type": "LBFGS"
+        },
+        "lr_scheduler": {
+            "type": "exp",
+            "gamma": 0.999
+        }
+    }
+    dftb2nnsk = DFTB2NNSK(
+            basis={"B":["2s"], "N": ["2s"]}, 
+            skdata=os.path.join(rootdir, "slakos"),
+            train_options=train_ops,
+            rs=6.0,
+            w=1.0,
+            method="poly2pow"
+            )
+    dftb2nnsk.optimize(r_min=1,r_max=6)
+    assert torch.isfinite(dftb2nnsk.hopping_params).all()
+    assert torch.isfinite(dftb2nnsk.overlap_params).all()
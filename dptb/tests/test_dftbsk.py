@@ -3,6 +3,8 @@ import os
 import torch
 from dptb.nn.dftbsk import DFTBSK
 from dptb.nn.dftb.sk_param import SKParam
+from dptb.nn.dftb.sk_table import SKTable
+from dptb.nn.dftb.hopping_dftb import HoppingIntp
 from dptb.data.transforms import OrbitalMapper
 from dptb.data.build import build_dataset
 from pathlib import Path
@@ -115,3 +117,38 @@ class TestDFTBSK:
 
 
 
+
+    def test_forward_dftbsk_transform(self):
+        # the onsite overlap parameters are [N, n_onsite, 1], they should give the identity onsite overlap blocks.
+        model = DFTBSK(**self.common_options, **self.model_options['dftbsk'], transform=True)
+        data = model(self.batch.copy())
+        idp = model.idp
+        n_node = data[AtomicDataDict.ATOM_TYPE_KEY].shape[0]
+        assert data[AtomicDataDict.NODE_OVERLAP_KEY].shape == (n_node, idp.reduced_matrix_element)
+        assert data[AtomicDataDict.NODE_FEATURES_KEY].shape == (n_node, idp.reduced_matrix_element)
+
+        onsite_E = model.onsite_fn.get_skEs(
+            atomic_numbers=model.idp_sk.untransform_atom(data[AtomicDataDict.ATOM_TYPE_KEY].flatten()),
+            nn_onsite_paras=model.onsite_param).reshape(n_node, -1)
+        for orbtype, sli in model.idp_sk.skonsitetype_maps.items():
+            l = {"s": 0, "p": 1}[orbtype]
+            eye = torch.eye(2*l+1).flatten()
+            block = idp.orbpairtype_maps[orbtype+"-"+orbtype]
+            assert torch.allclose(data[AtomicDataDict.NODE_OVERLAP_KEY][:, block], eye[None, :].expand(n_node, -1))
+            assert torch.allclose(data[AtomicDataDict.NODE_FEATURES_KEY][:, block], onsite_E[:, sli] * eye[None, :])
+        assert torch.all(data[AtomicDataDict.NODE_OVERLAP_KEY][:, idp.orbpairtype_maps["s-p"]] == 0)
+
+    def test_sktable_vs_intp(self):
+        model = DFTBSK(**self.common_options, **self.model_options['dftbsk'], transform=False)
+        bond_type = torch.randint(0, len(model.idp_sk.bond_types), (500,))
+        rij = torch.rand(500) * (model.distance_param[-1] + 1.0)
+        for method in ['linear', 'cspline']:
+            sktable = SKTable(x=model.distance_param, y=[model.hopping_param, model.overlap_param], method=method)
+            hopping, overlap = sktable(rij, bond_type)
+            intp = HoppingIntp(num_ingrls=model.idp_sk.reduced_matrix_element, method=method)
+            for ibtype in range(len(model.idp_sk.bond_types)):
+                mask = bond_type == ibtype
+                ref_hopping = intp.get_skhij(rij[mask], xx=model.distance_param, yy=model.hopping_param[ibtype])
+                ref_overlap = intp.get_skhij(rij[mask], xx=model.distance_param, yy=model.overlap_param[ibtype])
+                assert torch.allclose(hopping[mask], ref_hopping, atol=1e-5)
+                assert torch.allclose(overlap[mask], ref_overlap, atol=1e-5)
@@ -0,0 +1,54 @@
+import torch
+from dptb.utils.distributed import launch, init_distributed, cleanup_distributed, get_rank, get_world_size, \
+    broadcast_parameters, all_reduce_gradients, all_reduce_mean
+
+
+def _average_gradients(result_path):
+    init_distributed(backend="gloo")
+    rank, world_size = get_rank(), get_world_size()
+
+    # the ranks start from different weights, the broadcast makes them equal to the ones of rank 0.
+    torch.manual_seed(rank)
+    model = torch.nn.Sequential(torch.nn.Linear(3, 4), torch.nn.Tanh(), torch.nn.Linear(4, 1))
+    unused = torch.nn.Parameter(torch.ones(2))
+    broadcast_parameters(model)
+
+    # every rank computes the gradient of its own shard, the averaged one is the gradient of the mean loss.
+    x = torch.arange(12, dtype=torch.float32).reshape(4, 3) / 10
+    loss = (model(x[rank::world_size]) ** 2).mean()
+    loss.backward()
+    all_reduce_gradients(list(model.parameters()) + [unused])
+    grads = [p.grad.clone() for p in model.parameters()]
+    mean_loss = all_reduce_mean(loss.detach())
+
+    if rank == 0:
+        model.zero_grad()
+        ref = sum((model(x[r::world_size]) ** 2).mean() for r in range(world_size)) / world_size
+        ref.backward()
+        torch.save({
+            "grads": grads,
+            "ref_grads": [p.grad for p in model.parameters()],
+            "loss": mean_loss,
+            "ref_loss": ref.detach(),
+            "unused": unused.grad,
+            }, result_path)
+    cleanup_distributed()
+
+
+def test_all_reduce_gradients(tmp_path):
+    result_path = str(tmp_path / "result.pth")
+    launch(_average_gradients, nproc=2, result_path=result_path)
+
+    result = torch.load(result_path)
+    for g, ref in zip(result["grads"], result["ref_grads"]):
+        assert torch.allclose(g, ref, atol=1e-6)
+    assert torch.allclose(result["loss"], result["ref_loss"], atol=1e-6)
+    assert torch.allclose(result["unused"], torch.zeros(2))
+
+
+def test_not_distributed():
+    assert not init_distributed()
+    assert get_rank() == 0
+    assert get_world_size() == 1
+    loss = torch.tensor(1.5)
+    assert all_reduce_mean(loss) is loss
@@ -0,0 +1,59 @@
+import os
+import copy
+import torch
+from pathlib import Path
+from ase.io import read
+from dptb.nn.embedding import Lem, Slem
+from dptb.nn.edge_chunk import edge_chunks
+from dptb.data import AtomicData, AtomicDataDict
+
+rootdir = os.path.join(Path(os.path.abspath(__file__)).parent, "data")
+
+
+def test_edge_chunks():
+    assert edge_chunks(10) == [slice(0, 10)]
+    assert edge_chunks(10, 20) == [slice(0, 10)]
+    assert edge_chunks(10, 4) == [slice(0, 4), slice(4, 8), slice(8, 10)]
+
+def _check_chunked(model_class):
+    torch.manual_seed(0)
+    model = model_class(
+        basis={"B": "1s1p", "N": "1s1p"},
+        n_layers=2,
+        r_max=4.0,
+        irreps_hidden="8x0e+4x1o+4x2e",
+        avg_num_neighbors=10,
+        env_embed_multiplicity=4,
+        latent_channels=[16],
+        latent_dim=16,
+        tp_radial_channels=[16],
+    )
+    data = AtomicData.to_AtomicDataDict(AtomicData.from_ase(read(f"{rootdir}/hBN/hBN.vasp"), r_max=4.0))
+    data = model.idp(data)
+
+    # the gradients of all the parameters, including the ones of the chunked layers
+    names, params = zip(*[(name, p) for name, p in model.named_parameters() if p.requires_grad])
+    def grads(out):
+        loss = out[AtomicDataDict.EDGE_FEATURES_KEY].square().sum() + out[AtomicDataDict.NODE_FEATURES_KEY].square().sum()
+        return torch.autograd.grad(loss, params, allow_unused=True)
+
+    ref = model(copy.copy(data))
+    ref_grads = grads(ref)
+    assert any(g is not None and g.abs().sum() > 0 for g, name in zip(ref_grads, names) if name.startswith("layers.0."))
+
+    model.max_edge_chunk = 5
+    for checkpoint in [False, True]:
+        model.edge_chunk_checkpoint = checkpoint
+        out = model(copy.copy(data))
+        for field in [AtomicDataDict.EDGE_FEATURES_KEY, AtomicDataDict.NODE_FEATURES_KEY, AtomicDataDict.EDGE_OVERLAP_KEY]:
+            assert torch.allclose(out[field], ref[field], atol=1e-5)
+        for grad, ref_grad in zip(grads(out), ref_grads):
+            assert (grad is None) == (ref_grad is None)
+            if grad is not None:
+                assert torch.allclose(grad, ref_grad, atol=1e-4, rtol=1e-4)
+
+def test_lem_edge_chunk():
+    _check_chunked(Lem)
+
+def test_slem_edge_chunk():
+    _check_chunked(Slem)
@@ -0,0 +1,152 @@
+import pytest
+import torch
+import ase.build
+from dptb.nnops.loss import EigLoss
+from dptb.nn.energy import Eigenvalues
+from dptb.data import AtomicData, AtomicDataDict
+from dptb.data.transforms import OrbitalMapper
+from dptb.utils.torch_geometric import Batch
+
+basis = {"Si": ["3s", "3p"], "C": ["2s", "2p"]}
+
+def build_data_list(idp, nks, windows=False):
+    torch.manual_seed(0)
+    structures = [
+        ase.build.bulk("Si", "diamond", 5.43),
+        ase.build.bulk("SiC", "zincblende", 4.36),
+        ase.build.bulk("Si", "diamond", 5.43).repeat((2, 1, 1)),
+        ]
+    data_list = []
+    for i, nk in enumerate(nks):
+        atoms = structures[i % len(structures)]
+        data = AtomicData.from_ase(atoms, r_max=4.0)
+        norb = int(idp.atom_norb[idp.transform(data[AtomicDataDict.ATOMIC_NUMBERS_KEY])].sum())
+        data[AtomicDataDict.KPOINT_KEY] = torch.nested.as_nested_tensor([torch.rand(nk, 3)])
+        data[AtomicDataDict.ENERGY_EIGENVALUE_KEY] = torch.nested.as_nested_tensor([torch.sort(torch.randn(nk, norb+2) * 3, dim=-1)[0]])
+        if windows:
+            data[AtomicDataDict.ENERGY_WINDOWS_KEY] = torch.tensor([[-1.0, 6.0]])
+            data[AtomicDataDict.BAND_WINDOW_KEY] = torch.tensor([[1, 6]])
+        data = AtomicData.from_AtomicDataDict(idp(AtomicData.to_AtomicDataDict(data)))
+        data[AtomicDataDict.EDGE_FEATURES_KEY] = torch.randn(data[AtomicDataDict.EDGE_INDEX_KEY].shape[1], idp.reduced_matrix_element) * 0.3
+        data[AtomicDataDict.NODE_FEATURES_KEY] = torch.randn(data.num_nodes, idp.reduced_matrix_element)
+        data_list.append(data)
+    return data_list
+
+def to_dict(data_list):
+    batch = Batch.from_data_list(data_list)
+    batch_info = {
+        "__slices__": batch.__slices__,
+        "__cumsum__": batch.__cumsum__,
+        "__cat_dims__": batch.__cat_dims__,
+        "__num_nodes_list__": batch.__num_nodes_list__,
+        "__data_class__": batch.__data_class__,
+    }
+    batch = AtomicData.to_AtomicDataDict(batch)
+    batch.update(batch_info)
+    return batch
+
+def test_batched_eigenvalues():
+    idp = OrbitalMapper(basis, method="e3tb")
+    data_list = build_data_list(idp, nks=[5, 5, 5, 4])
+    eigenvalue = Eigenvalues(idp=idp)
+
+    groups = eigenvalue.batched(to_dict(data_list))
+    assert sorted(len(group) for group, _ in groups) == [1, 1, 2]
+    for group, eigs in groups:
+        for eig, g in zip(eigs, group.tolist()):
+            ref = eigenvalue(AtomicData.to_AtomicDataDict(data_list[g]))[AtomicDataDict.ENERGY_EIGENVALUE_KEY][0]
+            assert torch.allclose(eig, ref, atol=1e-5)
+
+@pytest.mark.parametrize("windows", [False, True])
+def test_eigloss_is_mean_of_structure_losses(windows):
+    idp = OrbitalMapper(basis, method="e3tb")
+    data_list = build_data_list(idp, nks=[6, 6, 6, 6, 6, 6], windows=windows)
+    loss = EigLoss(basis=basis, diff_valence={"Si": 2, "C": 2})
+
+    batched = loss(to_dict(data_list), to_dict(data_list))
+    single = torch.stack([loss(to_dict([data]), to_dict([data])) for data in data_list]).mean()
+    assert torch.allclose(batched, single, atol=1e-5)
+
+def test_eigloss_kpoint_sampling():
+    idp = OrbitalMapper(basis, method="e3tb")
+    data_list = build_data_list(idp, nks=[12, 12, 12], windows=True)
+    eigenvalue = Eigenvalues(idp=idp)
+    # reference eigenvalues close to the predicted ones, so that both have their lowest eigenvalue at the same k-point
+    for data in data_list:
+        eig = eigenvalue(AtomicData.to_AtomicDataDict(data))[AtomicDataDict.ENERGY_EIGENVALUE_KEY][0].detach()
+        eig = torch.cat([eig + 0.01 * torch.randn_like(eig), eig[:, -2:] + 10.], dim=-1)
+        data[AtomicDataDict.ENERGY_EIGENVALUE_KEY] = torch.nested.as_nested_tensor([eig])
+
+    ref = EigLoss(basis=basis)(to_dict(data_list), to_dict(data_list))
+    loss = EigLoss(basis=basis, num_kpoints=3)
+
+    # all the k-points are used in eval mode
+    loss.eval()
+    assert torch.allclose(loss(to_dict(data_list), to_dict(data_list)), ref)
+
+    loss.train()
+    torch.manual_seed(1)
+    estimate = torch.stack([loss(to_dict(data_list), to_dict(data_list)) for _ in range(400)]).mean()
+    assert torch.allclose(estimate, ref, rtol=0.1)
+
+def test_eigloss_kpoint_sampling_misaligned_minimum():
+    idp = OrbitalMapper(basis, method="e3tb")
+    data_list = build_data_list(idp, nks=[12])
+    eigenvalue = Eigenvalues(idp=idp)
+    pred = eigenvalue(AtomicData.to_AtomicDataDict(data_list[0]))[AtomicDataDict.ENERGY_EIGENVALUE_KEY][0].detach()
+    nk, nb = pred.shape
+
+    # the reference has its lowest eigenvalue at another k-point than the prediction
+    k_pred = int(pred[:, 0].argmin())
+    k_ref = (k_pred + 1) % nk
+    label = pred.clone()
+    label[k_ref] -= pred[k_ref, 0] - pred[k_pred, 0] + 1.
+    data_list[0][AtomicDataDict.ENERGY_EIGENVALUE_KEY] = torch.nested.as_nested_tensor([torch.cat([label, label[:, -2:] + 10.], dim=-1)])
+
+    loss = EigLoss(basis=basis, num_kpoints=3)
+    loss.train()
+    torch.manual_seed(0)
+    sampled = loss(to_dict(data_list), to_dict(data_list))
+
+    # the same draw, the prediction is aligned by its minimum over the sampled k-points only
+    torch.manual_seed(0)
+    ref_data = to_dict(data_list)
+    _, (index,), (weight,) = loss._sample_kpoints(
+        to_dict(data_list), list(ref_data[AtomicDataDict.ENERGY_EIGENVALUE_KEY].unbind()),
+        None, torch.tensor([[-float("inf"), float("inf")]]), torch.zeros(1, dtype=torch.long))
+    assert index[0] == k_ref
+    pred_s = pred[index] - pred[index].min()
+    label_s = (label - label.min())[index]
+    expected = (weight.unsqueeze(-1) * (pred_s - label_s) ** 2).sum() / (nk * nb)
+    assert torch.allclose(sampled, expected, atol=1e-5)
+
+    # with the k-point of the predicted minimum in the sample, the alignment is the one of the full k-points.
+    if k_pred in index.tolist():
+        full = (weight.unsqueeze(-1) * ((pred - pred.min())[index] - label_s) ** 2).sum() / (nk * nb)
+        assert torch.allclose(sampled, full, atol=1e-5)
+
+def test_eigloss_kpoint_sampling_mixed_nk():
+    idp = OrbitalMapper(basis, method="e3tb")
+    data_list = build_data_list(idp, nks=[12, 8, 8, 20])
+    # two diamond Si structures with 12 and 20 k-points, grouped together once 4 k-points are sampled from each
+    data_list = [data_list[0], data_list[3]]
+    loss = EigLoss(basis=basis, num_kpoints=3)
+
+    draws = {12: torch.tensor([0, 2, 5, 11]), 20: torch.tensor([3, 7, 19, 19])}
+    def sample_kpoints(data, ref_eigs, *args):
+        index = [draws[label.shape[0]] for label in ref_eigs]
+        weight = [torch.full((4,), 0.5) for _ in ref_eigs]
+        data = data.copy()
+        data[AtomicDataDict.KPOINT_KEY] = torch.nested.as_nested_tensor(
+            [kp[idx] for kp, idx in zip(data[AtomicDataDict.KPOINT_KEY].unbind(), index)])
+        return data, index, weight
+    loss._sample_kpoints = sample_kpoints
+
+    loss.train()
+    batched = loss(to_dict(data_list), to_dict(data_list))
+    single = torch.stack([loss(to_dict([data]), to_dict([data])) for data in data_list]).mean()
+    assert torch.allclose(batched, single, atol=1e-5)
+
+    # the random draws of the sampler on the same batch
+    del loss._sample_kpoints
+    assert torch.isfinite(loss(to_dict(data_list), to_dict(data_list)))
@@ -0,0 +1,40 @@
+import torch
+from dptb.nn.energy import eigvalsh, cholesky_reduce
+
+
+def random_hermitian(n, batch=3, seed=0):
+    torch.manual_seed(seed)
+    A = torch.randn(batch, n, n, dtype=torch.complex128)
+    return A + A.transpose(-1, -2).conj()
+
+def test_eigvalsh_nondegenerate():
+    A = random_hermitian(6).requires_grad_()
+    weight = torch.randn(6, dtype=torch.float64)
+
+    eigvals = eigvalsh(A)
+    assert torch.allclose(eigvals, torch.linalg.eigvalsh(A))
+    grad, = torch.autograd.grad((eigvals * weight).sum(), A)
+
+    ref, = torch.autograd.grad((torch.linalg.eigvalsh(A) * weight).sum(), A)
+    assert torch.allclose(grad, ref, atol=1e-6)
+
+def test_eigvalsh_degenerate():
+    # a doubly degenerate lowest eigenvalue
+    torch.manual_seed(0)
+    U, _ = torch.linalg.qr(torch.randn(4, 4, dtype=torch.complex128))
+    A = (U @ torch.diag(torch.tensor([1., 1., 2., 3.], dtype=torch.complex128)) @ U.transpose(-1, -2).conj()).requires_grad_()
+
+    grad, = torch.autograd.grad(eigvalsh(A)[0], A)
+
+    # the gradient of the lowest eigenvalue is spread over the projector of the degenerate subspace
+    projector = U[:, :2] @ U[:, :2].transpose(-1, -2).conj()
+    assert torch.allclose(grad, 0.5 * projector, atol=1e-6)
+
+def test_cholesky_reduce():
+    H = random_hermitian(5)
+    B = torch.randn(3, 5, 5, dtype=torch.complex128)
+    S = B @ B.transpose(-1, -2).conj() + 5 * torch.eye(5, dtype=torch.complex128)
+
+    L_inv = torch.linalg.inv(torch.linalg.cholesky(S))
+    ref = L_inv @ H @ L_inv.transpose(-1, -2).conj()
+    assert torch.allclose(cholesky_reduce(H, S), ref, atol=1e-10)
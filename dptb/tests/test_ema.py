@@ -0,0 +1,50 @@
+import pytest
+import torch
+from dptb.nnops.ema import ExponentialMovingAverage
+
+
+class TestExponentialMovingAverage:
+
+    def test_update(self):
+        model = torch.nn.Linear(3, 2)
+        ema = ExponentialMovingAverage(model, decay=0.9, warmup=0)
+        init = {k: v.clone() for k, v in model.state_dict().items()}
+        with torch.no_grad():
+            for p in model.parameters():
+                p.add_(1.)
+        ema.update()
+        for k, v in ema.shadow.items():
+            assert torch.allclose(v, 0.9 * init[k] + 0.1 * (init[k] + 1.))
+        assert ema.num_updates == 1
+
+    def test_warmup(self):
+        model = torch.nn.Linear(3, 2)
+        ema = ExponentialMovingAverage(model, decay=0.999, warmup=9)
+        assert ema.current_decay() == pytest.approx(0.1)
+        ema.num_updates = 10**6
+        assert ema.current_decay() == pytest.approx(0.999)
+
+    def test_average_parameters(self):
+        model = torch.nn.Linear(3, 2)
+        ema = ExponentialMovingAverage(model, decay=0.5, warmup=0)
+        with torch.no_grad():
+            model.weight.fill_(1.)
+        ema.update()
+        weight = model.weight.detach().clone()
+        with ema.average_parameters():
+            assert torch.allclose(model.weight, ema.shadow["weight"])
+        assert torch.equal(model.weight, weight)
+
+    def test_state_dict(self):
+        model = torch.nn.Linear(3, 2)
+        ema = ExponentialMovingAverage(model, decay=0.5, warmup=0)
+        with torch.no_grad():
+            model.weight.fill_(1.)
+        ema.update()
+        other = ExponentialMovingAverage(torch.nn.Linear(3, 2), decay=0.5, warmup=0)
+        other.load_state_dict(ema.state_dict())
+        assert other.num_updates == 1
+        for k, v in ema.shadow.items():
+            assert torch.equal(other.shadow[k], v)
+        # the averaged state dict can be loaded into the model.
+        model.load_state_dict(ema.averaged_state_dict())
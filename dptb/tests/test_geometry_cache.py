@@ -0,0 +1,57 @@
+import os
+import torch
+from pathlib import Path
+from dptb.data import DataLoader, AtomicData, AtomicDataDict
+from dptb.data.build import build_dataset
+from dptb.nn.nnsk import NNSK
+
+rootdir = os.path.join(Path(os.path.abspath(__file__)).parent, "data")
+
+
+class TestGeometryCache:
+    data_options = {
+        "r_max": 5.0,
+        "er_max": 5.0,
+        "oer_max": 2.5,
+        "root": f"{rootdir}/test_sktb/dataset",
+        "prefix": "kpath",
+        "separator": "",
+        "get_eigenvalues": True
+    }
+    common_options = {
+        "basis": {"Si": ["3s", "3p", "d*"]},
+        "device": "cpu",
+        "dtype": "float32",
+        "overlap": False,
+    }
+    dataset = build_dataset(**data_options, **common_options)
+    cached_dataset = build_dataset(**data_options, **common_options, cache_geometry=True)
+
+    def test_cached_fields(self):
+        data = self.cached_dataset[0]
+        ref = self.dataset[0]
+        n_edge = data[AtomicDataDict.EDGE_INDEX_KEY].shape[1]
+        n_onsitenv = data[AtomicDataDict.ONSITENV_INDEX_KEY].shape[1]
+        assert data[AtomicDataDict.EDGE_ROTATION_KEY].shape == (n_edge, 1 + 9 + 25)
+        assert data[AtomicDataDict.ONSITENV_ROTATION_KEY].shape == (n_onsitenv, 1 + 9 + 25)
+
+        ref = AtomicDataDict.with_edge_vectors(AtomicData.to_AtomicDataDict(ref), with_lengths=True)
+        assert torch.allclose(data[AtomicDataDict.EDGE_VECTORS_KEY], ref[AtomicDataDict.EDGE_VECTORS_KEY])
+        assert torch.allclose(data[AtomicDataDict.EDGE_LENGTH_KEY], ref[AtomicDataDict.EDGE_LENGTH_KEY])
+
+    def test_nnsk_with_cache(self):
+        torch.manual_seed(1)
+        model = NNSK(
+            basis=self.common_options["basis"],
+            onsite={"method": "strain", "rs": 2.6, "w": 0.35},
+            hopping={"method": "powerlaw", "rs": 2.6, "w": 0.35},
+            )
+
+        batch = next(iter(DataLoader(self.dataset, batch_size=2)))
+        cached_batch = next(iter(DataLoader(self.cached_dataset, batch_size=2)))
+        assert AtomicDataDict.EDGE_ROTATION_KEY in cached_batch
+
+        out = model(AtomicData.to_AtomicDataDict(batch))
+        cached_out = model(AtomicData.to_AtomicDataDict(cached_batch))
+        for key in [AtomicDataDict.EDGE_FEATURES_KEY, AtomicDataDict.NODE_FEATURES_KEY]:
+            assert torch.allclose(out[key], cached_out[key], atol=1e-6)
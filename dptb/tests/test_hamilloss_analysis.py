@@ -1,5 +1,5 @@
 import pytest
-from dptb.nnops.loss import HamilLossAnalysis
+from dptb.nnops.loss import HamilLossAnalysis, apply_onsite_shift
 from dptb.data import AtomicData
 from ase.io import read
 import torch
@@ -56,4 +56,58 @@ def test_hamilloss_analysis_w_decompose(root_directory):
     assert result["onsite"]["N"]["n_element"] == 13
     assert result["hopping"]["B-N"]["n_element"] == 156
     assert result["hopping"]["B-B"]["n_element"] == 78
-    assert result["hopping"]["N-N"]["n_element"] == 78
\ No newline at end of file
+    assert result["hopping"]["N-N"]["n_element"] == 78
+@pytest.mark.order(3)
+def test_hamilloss_analysis_running_avg(root_directory):
+    la = HamilLossAnalysis(basis={"B":"1s1p", "N": "1s1p"}, decompose=False)
+    data = AtomicData.from_ase(
+        atoms=read(root_directory+"/dptb/tests/data/hBN/hBN.vasp"),
+        r_max=4.0
+        ).to_dict()
+    data = la.idp(data)
+
+    data["edge_features"] = torch.zeros(data["edge_index"].shape[1], 13)
+    data["node_features"] = torch.zeros(data["atom_types"].shape[0], 13)
+
+    ref_data = data.copy()
+    ref_data["edge_features"] = torch.ones(data["edge_index"].shape[1], 13)
+    ref_data["node_features"] = torch.ones(data["atom_types"].shape[0], 13)
+
+    la(data, ref_data, running_avg=True)
+    ref_data["edge_features"] = 3 * torch.ones(data["edge_index"].shape[1], 13)
+    ref_data["node_features"] = 3 * torch.ones(data["atom_types"].shape[0], 13)
+    result = la(data, ref_data, running_avg=True)
+
+    # the two batches have the same number of elements, the running average sits in between.
+    assert torch.abs(result["mae"] - 2.0) < 1e-4
+    assert torch.abs(result["rmse"] - 5.0**0.5) < 1e-4
+    assert result["onsite"]["B"]["n_element"] == 26
+    assert result["hopping"]["B-N"]["n_element"] == 312
+
+def test_apply_onsite_shift(root_directory):
+    la = HamilLossAnalysis(basis={"B":"1s1p", "N": "1s1p"}, decompose=False)
+    data = AtomicData.from_ase(
+        atoms=read(root_directory+"/dptb/tests/data/hBN/hBN.vasp"),
+        r_max=4.0
+        ).to_dict()
+    data = la.idp(data)
+    n_node, n_edge = data["atom_types"].shape[0], data["edge_index"].shape[1]
+
+    # two copies of the structure in one batch, the second one shifted by a different energy.
+    batch = {k: v for k, v in data.items()}
+    batch["atom_types"] = torch.cat([data["atom_types"], data["atom_types"]])
+    batch["edge_index"] = torch.cat([data["edge_index"], data["edge_index"] + n_node], dim=1)
+    batch["batch"] = torch.cat([torch.zeros(n_node, dtype=torch.long), torch.ones(n_node, dtype=torch.long)])
+    batch["node_features"] = torch.zeros(2 * n_node, 13)
+    batch["edge_features"] = torch.zeros(2 * n_edge, 13)
+
+    ref_batch = batch.copy()
+    ref_batch["node_overlap"] = torch.ones(2 * n_node, 13)
+    ref_batch["edge_overlap"] = torch.ones(2 * n_edge, 13)
+    ref_batch["node_features"] = torch.cat([-torch.ones(n_node, 13), -3 * torch.ones(n_node, 13)])
+    ref_batch["edge_features"] = torch.zeros(2 * n_edge, 13)
+
+    ref_batch = apply_onsite_shift(la.idp, batch, ref_batch)
+    assert torch.allclose(ref_batch["node_features"], torch.zeros(2 * n_node, 13))
+    assert torch.allclose(ref_batch["edge_features"][:n_edge], torch.ones(n_edge, 13))
+    assert torch.allclose(ref_batch["edge_features"][n_edge:], 3 * torch.ones(n_edge, 13))
@@ -0,0 +1,28 @@
+import os
+import torch
+from pathlib import Path
+from ase.io import read
+from dptb.nn.hr2hk import HR2HK
+from dptb.data import AtomicData, AtomicDataDict
+
+rootdir = os.path.join(Path(os.path.abspath(__file__)).parent, "data")
+
+
+def test_hr2hk_few_kpoints():
+    hr2hk = HR2HK(basis={"B": "1s1p", "N": "1s1p"}, dtype=torch.float64)
+    data = AtomicData.to_AtomicDataDict(AtomicData.from_ase(read(f"{rootdir}/hBN/hBN.vasp"), r_max=4.0))
+    data = hr2hk.idp(data)
+    torch.manual_seed(0)
+    data[AtomicDataDict.EDGE_FEATURES_KEY] = torch.randn(data[AtomicDataDict.EDGE_INDEX_KEY].shape[1], hr2hk.idp.reduced_matrix_element, dtype=torch.float64)
+    data[AtomicDataDict.NODE_FEATURES_KEY] = torch.randn(data[AtomicDataDict.ATOM_TYPE_KEY].shape[0], hr2hk.idp.reduced_matrix_element, dtype=torch.float64)
+
+    n_lattice = torch.unique(data[AtomicDataDict.EDGE_CELL_SHIFT_KEY], dim=0).shape[0] + 1
+    kpoints = torch.rand(n_lattice, 3, dtype=torch.float64)
+
+    # more k-points than lattice vectors goes through H(R), a single k-point is accumulated into H(k) directly.
+    data[AtomicDataDict.KPOINT_KEY] = kpoints
+    ref = hr2hk(dict(data))[AtomicDataDict.HAMILTONIAN_KEY]
+    for ik in [0, n_lattice - 1]:
+        data[AtomicDataDict.KPOINT_KEY] = kpoints[ik:ik+1]
+        out = hr2hk(dict(data))[AtomicDataDict.HAMILTONIAN_KEY]
+        assert torch.allclose(out[0], ref[ik], atol=1e-10)
@@ -0,0 +1,53 @@
+import copy
+import pytest
+import torch
+from e3nn import o3
+from dptb.nn.mixed_precision import autocast_modules, autocast_supported
+
+
+class Block(torch.nn.Module):
+    def __init__(self):
+        super(Block, self).__init__()
+        self.lin = o3.Linear("8x0e+4x1o", "8x0e+4x1o")
+        self.mlp = torch.nn.Sequential(torch.nn.Linear(20, 32), torch.nn.SiLU(), torch.nn.Linear(32, 20))
+
+    def forward(self, x):
+        # the norm between the autocast modules stays in the input dtype.
+        return self.mlp(self.lin(x) / x.norm(dim=-1, keepdim=True))
+
+
+def test_autocast_modules():
+    torch.manual_seed(0)
+    model = Block()
+    x = torch.randn(16, 20)
+    ref = model(x)
+
+    amp = copy.deepcopy(model)
+    assert autocast_modules(amp, dtype=torch.bfloat16) == 3
+    out = amp(x)
+    assert out.dtype == torch.float32
+    assert torch.allclose(out, ref, atol=5e-2, rtol=5e-2)
+
+    # the weights and their gradients keep the model dtype.
+    out.sum().backward()
+    for p in amp.parameters():
+        assert p.dtype == torch.float32
+        assert p.grad is not None and p.grad.dtype == torch.float32
+
+    # the copies run their own weights.
+    other = copy.deepcopy(amp)
+    with torch.no_grad():
+        for p in other.parameters():
+            p.zero_()
+    assert torch.allclose(amp(x), out)
+
+
+def test_autocast_requires_float32():
+    model = Block().double()
+    with pytest.raises(ValueError, match="float32"):
+        autocast_modules(model, dtype=torch.bfloat16)
+
+@pytest.mark.skipif(autocast_supported("cpu", torch.float16), reason="the cpu autocast supports float16")
+def test_autocast_unsupported_dtype():
+    with pytest.raises(ValueError, match="does not support"):
+        autocast_modules(Block(), dtype=torch.float16)
@@ -414,4 +414,28 @@ class TestNNSK_rmax_dict:
                     fij_old = 1/(1+torch.exp((rij-rs_old+5*w)/w))
                     fij_new = 1/(1+torch.exp((rij-rs+5*w)/w))
                 
-                assert torch.allclose(hopping_new[i] / fij_new, hopping_old[i] / fij_old, atol=1e-5)   
\ No newline at end of file
+                assert torch.allclose(hopping_new[i] / fij_new, hopping_old[i] / fij_old, atol=1e-5)   
+    def test_nnsk_symmetrize(self):
+        model_options = self.model_options
+        model_options["nnsk"]["onsite"]["method"] = "uniform"
+        model_options["nnsk"]["hopping"]["method"] = "powerlaw"
+        model_options["nnsk"]["hopping"]["rs"] = 2.6
+        model = NNSK(**model_options['nnsk'], **self.common_options,transform=False)
+
+        # the lookups are not saved in the checkpoint
+        assert set(model.state_dict().keys()) == set(dict(model.named_parameters()).keys())
+
+        params = torch.randn_like(model.hopping_param)
+        ref = params.clone()
+        reflect_params = params[model.reflective_bonds]
+        for k in model.idp_sk.orbpair_maps.keys():
+            iorb, jorb = k.split("-")
+            if iorb == jorb:
+                ref[:,model.idp_sk.orbpair_maps[k],:] = 0.5 * (params[:,model.idp_sk.orbpair_maps[k],:] + reflect_params[:,model.idp_sk.orbpair_maps[k],:])
+        assert torch.allclose(model.symmetrize(params), ref)
+
+        # the gradients of A-B and B-A are the same for the i-i orbital pairs, so the parameters stay symmetric
+        data = model(self.batch)
+        data[AtomicDataDict.EDGE_FEATURES_KEY].sum().backward()
+        grad = model.hopping_param.grad
+        assert torch.allclose(grad, model.symmetrize(grad))
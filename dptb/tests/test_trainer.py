@@ -6,6 +6,11 @@ from dptb.utils.argcheck import normalize,collect_cutoffs
 from dptb.utils.tools import j_loader
 from dptb.nn.build import build_model
 from dptb.data.build import build_dataset
+from dptb.plugins.profiler import Profiler
+from dptb.plugins.saver import Saver
+from dptb.plugins.async_validation import AsyncValidationer
+import torch
+import json
 
 rootdir = os.path.join(Path(os.path.abspath(__file__)).parent, "data")
 
@@ -169,3 +174,176 @@ class TestTrainer:
         batch = next(iter(trainer.train_loader))
         self.for_iteration(trainer, batch, ref_batch=None)
         self.for_epoch(trainer, expect_ref=False)
+
+    def test_profiler(self, tmp_path):
+        jdata = self.jdata
+        model = build_model(None, model_options=jdata["model_options"], 
+                        common_options=jdata["common_options"])
+        trainer = Trainer(
+            train_options=jdata["train_options"],
+            common_options=jdata["common_options"],
+            model = model,
+            train_datasets=self.train_datasets,
+            validation_datasets=None,
+            reference_datasets=None)
+        trainer.register_plugin(Profiler(log_freq=1), output=str(tmp_path))
+        trainer.run(1)
+
+        with open(tmp_path / "profile.csv") as f:
+            lines = f.readlines()
+        assert lines[0].strip().split(",") == ["iteration"] + Profiler.stages + ["total"]
+        assert len(lines) - 1 == len(trainer.train_loader)
+
+        with open(tmp_path / "profile_summary.json") as f:
+            summary = json.load(f)
+        assert summary["iterations"] == len(trainer.train_loader)
+        for stage in ["data", "forward", "loss", "backward", "optimizer"]:
+            assert summary["stages"][stage]["mean_ms"] >= 0.
+
+    def test_profiler_trace_at_end(self, tmp_path):
+        jdata = self.jdata
+        model = build_model(None, model_options=jdata["model_options"], 
+                        common_options=jdata["common_options"])
+        trainer = Trainer(
+            train_options=jdata["train_options"],
+            common_options=jdata["common_options"],
+            model = model,
+            train_datasets=self.train_datasets,
+            validation_datasets=None,
+            reference_datasets=None)
+        # the last row of the epoch starts a trace, which no later iteration stops.
+        profiler = Profiler(log_freq=1, trace_freq=len(trainer.train_loader))
+        trainer.register_plugin(profiler, output=str(tmp_path))
+        trainer.run(1)
+        assert profiler.trace is not None
+
+        profiler.finish()
+        assert profiler.trace is None
+        assert len(list(tmp_path.glob("trace.iter*.json"))) == 1
+
+    def test_async_saver(self, tmp_path):
+        jdata = self.jdata
+        model = build_model(None, model_options=jdata["model_options"], 
+                        common_options=jdata["common_options"])
+        trainer = Trainer(
+            train_options=jdata["train_options"],
+            common_options=jdata["common_options"],
+            model = model,
+            train_datasets=self.train_datasets,
+            validation_datasets=None,
+            reference_datasets=None)
+        saver = Saver(async_save=True, max_pending=1)
+        trainer.register_plugin(saver, checkpoint_path=str(tmp_path))
+        trainer.stats["train_loss"] = {"epoch_mean": 1.0}
+        trainer.run(1)
+        saver.finish()
+
+        assert len(saver.latest_quene) > 0
+        latest = torch.load(tmp_path / f"{model.name}.latest.pth")
+        for k, v in latest["model_state_dict"].items():
+            assert v.device == torch.device("cpu")
+        best = torch.load(tmp_path / f"{model.name}.best.pth")
+        assert best["epoch"] == 1
+        for k, v in model.state_dict().items():
+            assert torch.allclose(best["model_state_dict"][k], v.cpu())
+
+    def test_async_validation(self, tmp_path):
+        jdata = self.jdata
+        train_options = dict(jdata["train_options"])
+        train_options["loss_options"] = dict(train_options["loss_options"], validation=train_options["loss_options"]["train"])
+        model = build_model(None, model_options=jdata["model_options"], 
+                        common_options=jdata["common_options"])
+        trainer = Trainer(
+            train_options=train_options,
+            common_options=jdata["common_options"],
+            model = model,
+            train_datasets=self.train_datasets,
+            validation_datasets=self.train_datasets,
+            reference_datasets=None)
+        validationer = AsyncValidationer(interval=[(2, 'iteration'), (1, 'epoch')])
+        trainer.register_plugin(validationer)
+        saver = Saver(best_from_validation=True)
+        trainer.register_plugin(saver, checkpoint_path=str(tmp_path))
+        trainer.run(1)
+        validationer.finish()
+
+        # the epoch snapshot is always evaluated, and the best one is saved with the evaluated weights.
+        assert validationer.n_results >= 1
+        assert len(validationer.snapshots) == 0
+        assert saver.best_loss <= trainer.stats["validation_loss"]["last"]
+        best = torch.load(tmp_path / f"{model.name}.best.pth")
+        assert best["epoch"] == 1
+
+    def test_gradient_accumulation(self):
+        jdata = self.jdata
+        model = build_model(None, model_options=jdata["model_options"], 
+                        common_options=jdata["common_options"])
+        train_options = dict(jdata["train_options"], gradient={"accumulate_steps": 2, "normalization": "atoms", "clip_norm": 1e-3})
+        trainer = Trainer(
+            train_options=train_options,
+            common_options=jdata["common_options"],
+            model = model,
+            train_datasets=self.train_datasets,
+            validation_datasets=None,
+            reference_datasets=None)
+        trainer.stats["train_loss"] = {"epoch_mean": 1.0}
+
+        n_batch = len(trainer.train_loader)
+        trainer.epoch()
+        assert trainer.n_steps + trainer.n_skipped == (n_batch + 1) // 2
+        assert trainer.accumulated == 0
+        assert trainer.grad_norm_avg is not None
+
+        # with a tiny spike factor, every step after the warm-up is skipped.
+        trainer.spike_factor = 1e-8
+        trainer.spike_warmup = 0
+        n_steps = trainer.n_steps
+        weights = {k: v.clone() for k, v in model.state_dict().items()}
+        trainer.epoch()
+        assert trainer.n_steps == n_steps
+        for k, v in model.state_dict().items():
+            assert torch.equal(weights[k], v)
+
+    def test_spike_without_warmup(self):
+        jdata = self.jdata
+        model = build_model(None, model_options=jdata["model_options"], 
+                        common_options=jdata["common_options"])
+        train_options = dict(jdata["train_options"], gradient={"spike_factor": 1e-8, "spike_warmup": 0})
+        trainer = Trainer(
+            train_options=train_options,
+            common_options=jdata["common_options"],
+            model = model,
+            train_datasets=self.train_datasets,
+            validation_datasets=None,
+            reference_datasets=None)
+        trainer.stats["train_loss"] = {"epoch_mean": 1.0}
+
+        # the first step has no running average to compare with, it is taken and starts the average.
+        trainer.epoch()
+        assert trainer.n_steps == 1
+        assert trainer.n_skipped == len(trainer.train_loader) - 1
+
+    def test_reference_iterator(self):
+        jdata = self.jdata
+        jdata["data_options"]["reference"] = jdata["data_options"]["train"]
+        jdata["train_options"]["ref_batch_size"] = jdata["train_options"]["batch_size"]
+        jdata["train_options"]["loss_options"]["reference"] = jdata["train_options"]["loss_options"]["train"]
+        reference_datasets = build_dataset(**self.cutoffops,**jdata["data_options"]["reference"], **jdata["common_options"])
+        model = build_model(None, model_options=jdata["model_options"], 
+                        common_options=jdata["common_options"])
+        train_options = dict(jdata["train_options"], reference_ratio=0.5)
+        trainer = Trainer(
+            train_options=train_options,
+            common_options=jdata["common_options"],
+            model = model,
+            train_datasets=self.train_datasets,
+            validation_datasets=None,
+            reference_datasets=reference_datasets)
+
+        n_ref = len(trainer.reference_loader)
+        batches = [trainer.next_reference_batch() for _ in range(4 * n_ref)]
+        assert [b is None for b in batches] == [True, False] * (2 * n_ref)
+        # the iterator is kept between the steps and restarted once exhausted.
+        assert trainer.reference_iter is not None
+        n_frames = sum(b.num_graphs for b in batches if b is not None)
+        assert n_frames == 2 * len(reference_datasets)
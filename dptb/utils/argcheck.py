@@ -114,13 +114,21 @@ def train_options():
     doc_lr_scheduler = "The learning rate scheduler tools settings, the lr scheduler is used to scales down the learning rate during the training process. Proper setting can make the training more stable and efficient. The supported lr schedular includes: `Exponential Decaying (exp)`, `Linear multiplication (linear)`, `Reduce on pleatau (rop)`, `Cyclic learning rate (cyclic)`. See more documentation on Pytorch. "
     doc_batch_size = "The batch size used in training, Default: 1"
     doc_ref_batch_size = "The batch size used in reference data, Default: 1"
+    doc_reference_ratio = "The fraction of the training steps that also train on a batch of the reference data, in (0, 1]. The reference batches are drawn in turn from the whole reference set, which is reshuffled at every pass. Default: 1"
     doc_val_batch_size = "The batch size used in validation data, Default: 1"
     doc_max_ckpt = "The maximum number of saved checkpoints, Default: 4"
+    doc_async_save = "Write the checkpoints in a background thread. The model and optimizer states are copied to CPU on the training thread, and the training goes on while they are written to disk. Default: `False`"
+    doc_save_min_interval = "The minimum time in seconds between two iteration checkpoints, the checkpoints in between are skipped. The best checkpoints of the epochs are always saved. Default: `0`"
+    doc_max_pending_saves = "The maximum number of checkpoints waiting to be written when `async_save` is true. An iteration checkpoint arriving when the queue is full is skipped instead of blocking the training. Default: `2`"
+    doc_batch_budget = "Pack the structures of similar size into batches bounded by the number of atoms, edges and orbitals, instead of a fixed number of structures per batch. " \
+                       "When any budget is set, it is applied to the training, validation and reference data, and `batch_size`, `val_batch_size` and `ref_batch_size` become the maximum number of structures in a batch. " \
+                       "A structure that alone exceeds the budget forms a batch of its own. Default: `{}`, i.e. not used."
     
     args = [
         Argument("num_epoch", int, optional=False, doc=doc_num_epoch),
         Argument("batch_size", int, optional=True, default=1, doc=doc_batch_size),
         Argument("ref_batch_size", int, optional=True, default=1, doc=doc_ref_batch_size),
+        Argument("reference_ratio", [float, int], optional=True, default=1.0, doc=doc_reference_ratio),
         Argument("val_batch_size", int, optional=True, default=1, doc=doc_val_batch_size),
         Argument("optimizer", dict, sub_fields=[], optional=True, default={}, sub_variants=[optimizer()], doc = doc_optimizer),
         Argument("lr_scheduler", dict, sub_fields=[], optional=True, default={}, sub_variants=[lr_scheduler()], doc = doc_lr_scheduler),
@@ -130,6 +138,16 @@ def train_options():
         Argument("use_tensorboard", bool, optional=True, default=False, doc=doc_use_tensorboard),
         Argument("update_lr_per_step_flag", bool, optional=True, default=False, doc=update_lr_per_step_flag),
         Argument("max_ckpt", int, optional=True, default=4, doc=doc_max_ckpt),
+        Argument("async_save", bool, optional=True, default=False, doc=doc_async_save),
+        Argument("save_min_interval", [float, int], optional=True, default=0., doc=doc_save_min_interval),
+        Argument("max_pending_saves", int, optional=True, default=2, doc=doc_max_pending_saves),
+        Argument("batch_budget", dict, sub_fields=batch_budget(), optional=True, default={}, doc=doc_batch_budget),
+        gradient(),
+        ema(),
+        mixed_precision(),
+        dataloader_options(),
+        profiler(),
+        async_validation(),
         loss_options()
     ]
 
@@ -137,13 +155,121 @@ def train_options():
 
     return Argument("train_options", dict, sub_fields=args, sub_variants=[], optional=True, doc=doc_train_options)
 
+def batch_budget():
+    doc_max_atoms = "The maximum number of atoms in a batch. Default: `None`, not limited."
+    doc_max_edges = "The maximum number of edges in a batch. Default: `None`, not limited."
+    doc_max_orbitals = "The maximum number of orbitals in a batch. Default: `None`, not limited."
+
+    return [
+        Argument("max_atoms", [int, None], optional=True, default=None, doc=doc_max_atoms),
+        Argument("max_edges", [int, None], optional=True, default=None, doc=doc_max_edges),
+        Argument("max_orbitals", [int, None], optional=True, default=None, doc=doc_max_orbitals),
+    ]
+
+def gradient():
+    doc_accumulate_steps = "The number of batches whose gradients are accumulated before each optimizer step, the effective batch size is `batch_size * accumulate_steps`. Default: `1`"
+    doc_normalization = "How the losses of the accumulated batches are averaged: `batch` gives each batch the same weight, `atoms` and `edges` weight each batch by its number of atoms or edges. Default: `batch`"
+    doc_clip_norm = "Clip the total norm of the gradients to this value before the optimizer step. Default: `None`, not clipped."
+    doc_spike_factor = "Skip the optimizer step when the gradient norm exceeds `spike_factor` times its running average, or is not finite. Default: `None`, only the non-finite gradients are skipped."
+    doc_spike_warmup = "The number of optimizer steps before the spikes are detected, to build the running average of the gradient norm. Default: `10`"
+
+    args = [
+        Argument("accumulate_steps", int, optional=True, default=1, doc=doc_accumulate_steps),
+        Argument("normalization", str, optional=True, default="batch", doc=doc_normalization),
+        Argument("clip_norm", [float, int, None], optional=True, default=None, doc=doc_clip_norm),
+        Argument("spike_factor", [float, int, None], optional=True, default=None, doc=doc_spike_factor),
+        Argument("spike_warmup", int, optional=True, default=10, doc=doc_spike_warmup),
+    ]
+
+    doc_gradient = "The options of the gradient accumulation, clipping and spike skipping of the optimizer steps."
+
+    return Argument("gradient", dict, sub_fields=args, sub_variants=[], optional=True, default={}, doc=doc_gradient)
+
+def ema():
+    doc_enable = "Keep an exponential moving average of the model weights, updated after each optimizer step. The average is used for the validation and the choice of the best checkpoint, is saved in the checkpoints and used by `dptb test`. Default: `False`"
+    doc_decay = "The decay of the moving average. Default: `0.999`"
+    doc_warmup = "The decay at the n-th update is `min(decay, (1 + n) / (1 + warmup + n))`, so that the average follows the weights closely at the start of the training. Default: `10`"
+
+    args = [
+        Argument("enable", bool, optional=True, default=False, doc=doc_enable),
+        Argument("decay", float, optional=True, default=0.999, doc=doc_decay),
+        Argument("warmup", int, optional=True, default=10, doc=doc_warmup),
+    ]
+
+    doc_ema = "The options of the exponential moving average (EMA) of the model weights."
+
+    return Argument("ema", dict, sub_fields=args, sub_variants=[], optional=True, default={}, doc=doc_ema)
+
+def mixed_precision():
+    doc_enable = "Run the tensor products, linear layers and MLPs of the embedding in a low precision with `torch.autocast`, which is faster on CPUs with bfloat16 support. The geometry, spherical harmonics, the scale/shift of the predictions and the loss stay in the `dtype` of `common_options`, which must be `float32`. Only for the `nnenv` models. Default: `False`"
+    doc_dtype = "The low precision dtype, `bfloat16` or `float16`. The `float16` autocast on CPU requires a recent torch version, an error is raised if it is not supported. Default: `bfloat16`"
+
+    args = [
+        Argument("enable", bool, optional=True, default=False, doc=doc_enable),
+        Argument("dtype", str, optional=True, default="bfloat16", doc=doc_dtype),
+    ]
+
+    doc_mixed_precision = "The options of the mixed precision training."
+
+    return Argument("mixed_precision", dict, sub_fields=args, sub_variants=[], optional=True, default={}, doc=doc_mixed_precision)
+
+def profiler():
+    doc_enable = "Record the wall time of each stage of the training iterations: data loading, moving to device, forward, loss, backward, optimizer step and plugins such as checkpointing. Default: `False`"
+    doc_log_freq = "Every how many iterations to log the average time of the stages. Default: `100`"
+    doc_trace_freq = "Every how many iterations to record a `torch.profiler` trace of one iteration, saved as a chrome trace in the `profile` folder of the output. `0` means no trace. Default: `0`"
+
+    args = [
+        Argument("enable", bool, optional=True, default=False, doc=doc_enable),
+        Argument("log_freq", int, optional=True, default=100, doc=doc_log_freq),
+        Argument("trace_freq", int, optional=True, default=0, doc=doc_trace_freq),
+    ]
+
+    doc_profiler = "The options of the profiler of the training loop. The per iteration stage times are written to `profile/profile.csv` and summarized in `profile/profile_summary.json` in the output folder."
+
+    return Argument("profiler", dict, sub_fields=args, sub_variants=[], optional=True, default={}, doc=doc_profiler)
+
+def async_validation():
+    doc_enable = "Evaluate the whole validation set in a background CPU process on snapshots of the model weights, instead of the first validation batch on the training process. The best checkpoint is then chosen by the validation loss of the evaluated weights. Default: `False`"
+    doc_max_pending = "The maximum number of weight snapshots waiting for the validation process. Default: `2`"
+    doc_num_threads = "The number of threads used by the validation process. Default: `1`"
+
+    args = [
+        Argument("enable", bool, optional=True, default=False, doc=doc_enable),
+        Argument("max_pending", int, optional=True, default=2, doc=doc_max_pending),
+        Argument("num_threads", int, optional=True, default=1, doc=doc_num_threads),
+    ]
+
+    doc_async_validation = "The options of the asynchronous validation. A snapshot is evaluated at the end of every epoch, and every `validation_freq` iterations when the validation process is idle."
+
+    return Argument("async_validation", dict, sub_fields=args, sub_variants=[], optional=True, default={}, doc=doc_async_validation)
+
+def dataloader_options():
+    doc_num_workers = "The number of subprocesses that load and collate the data in parallel with the model computation. `0` means the data is loaded in the main process. Default: `0`"
+    doc_pin_memory = "Copy the batches into page-locked memory before returning them, which speeds up the transfer to GPU. Default: `False`"
+    doc_prefetch_factor = "The number of batches loaded in advance by each worker. Only used when `num_workers > 0`. Default: `2`"
+    doc_persistent_workers = "Keep the worker processes alive between epochs instead of respawning them. Only used when `num_workers > 0`. Default: `False`"
+
+    args = [
+        Argument("num_workers", int, optional=True, default=0, doc=doc_num_workers),
+        Argument("pin_memory", bool, optional=True, default=False, doc=doc_pin_memory),
+        Argument("prefetch_factor", int, optional=True, default=2, doc=doc_prefetch_factor),
+        Argument("persistent_workers", bool, optional=True, default=False, doc=doc_persistent_workers),
+    ]
+
+    doc_dataloader_options = "The options of the DataLoader, which controls the parallel loading and prefetching of the data."
+
+    return Argument("dataloader_options", dict, sub_fields=args, sub_variants=[], optional=True, default={}, doc=doc_dataloader_options)
+
 def test_options():
     doc_display_freq = "Frequency, or every how many iteration to display the training log to screem. Default: `1`"
     doc_batch_size = "The batch size used in testing, Default: 1"
+    doc_use_ema = "Test the moving average of the weights if the checkpoint has one, see `train_options/ema`. Default: `True`"
     
     args = [
         Argument("batch_size", int, optional=True, default=1, doc=doc_batch_size),
+        Argument("use_ema", bool, optional=True, default=True, doc=doc_use_ema),
         Argument("display_freq", int, optional=True, default=1, doc=doc_display_freq),
+        dataloader_options(),
         loss_options()
     ]
 
@@ -335,6 +461,8 @@ def train_data_sub():
     doc_vlp = "Choose whether the overlap blocks are loaded when building dataset."
     doc_DM = "Choose whether the density matrix is loaded when building dataset."
     doc_separator = "the sepatator used to separate the prefix and suffix in the dataset directory. Default: '.'"
+    doc_cache_geometry = "Precompute the edge vectors, lengths and SK rotation matrices (also for the onsite environment) once when building the dataset, \
+        and reuse them in every step instead of recomputing them. Only valid for fixed structures, e.g. fitting NNSK/DFTBSK to eigenvalues. Default: False"
     
     args = [
         Argument("type", str, optional=True, default="DefaultDataset", doc="The type of dataset."),
@@ -344,7 +472,8 @@ def train_data_sub():
         Argument("get_Hamiltonian", bool, optional=True, default=False, doc=doc_ham),
         Argument("get_overlap", bool, optional=True, default=False, doc=doc_vlp),
         Argument("get_DM", bool, optional=True, default=False, doc=doc_DM),
-        Argument("get_eigenvalues", bool, optional=True, default=False, doc=doc_eig)
+        Argument("get_eigenvalues", bool, optional=True, default=False, doc=doc_eig),
+        Argument("cache_geometry", bool, optional=True, default=False, doc=doc_cache_geometry)
     ]
 
     doc_train = "The dataset settings for training."
@@ -359,6 +488,8 @@ def validation_data_sub():
     doc_vlp = "Choose whether the overlap blocks are loaded when building dataset."
     doc_DM = "Choose whether the density matrix is loaded when building dataset."
     doc_separator = "the sepatator used to separate the prefix and suffix in the dataset directory. Default: '.'"
+    doc_cache_geometry = "Precompute the edge vectors, lengths and SK rotation matrices (also for the onsite environment) once when building the dataset, \
+        and reuse them in every step instead of recomputing them. Only valid for fixed structures, e.g. fitting NNSK/DFTBSK to eigenvalues. Default: False"
 
     args = [
         Argument("type", str, optional=True, default="DefaultDataset", doc="The type of dataset."),
@@ -368,7 +499,8 @@ def validation_data_sub():
         Argument("get_Hamiltonian", bool, optional=True, default=False, doc=doc_ham),
         Argument("get_overlap", bool, optional=True, default=False, doc=doc_vlp),
         Argument("get_DM", bool, optional=True, default=False, doc=doc_DM),
-        Argument("get_eigenvalues", bool, optional=True, default=False, doc=doc_eig)
+        Argument("get_eigenvalues", bool, optional=True, default=False, doc=doc_eig),
+        Argument("cache_geometry", bool, optional=True, default=False, doc=doc_cache_geometry)
     ]
 
     doc_validation = "The dataset settings for validation."
@@ -383,6 +515,8 @@ def reference_data_sub():
     doc_vlp = "Choose whether the overlap blocks are loaded when building dataset."
     doc_DM = "Choose whether the density matrix is loaded when building dataset."
     doc_separator = "the sepatator used to separate the prefix and suffix in the dataset directory. Default: '.'"
+    doc_cache_geometry = "Precompute the edge vectors, lengths and SK rotation matrices (also for the onsite environment) once when building the dataset, \
+        and reuse them in every step instead of recomputing them. Only valid for fixed structures, e.g. fitting NNSK/DFTBSK to eigenvalues. Default: False"
 
     args = [
         Argument("type", str, optional=True, default="DefaultDataset", doc="The type of dataset."),
@@ -392,7 +526,8 @@ def reference_data_sub():
         Argument("get_Hamiltonian", bool, optional=True, default=False, doc=doc_ham),
         Argument("get_overlap", bool, optional=True, default=False, doc=doc_vlp),
         Argument("get_DM", bool, optional=True, default=False, doc=doc_DM),
-        Argument("get_eigenvalues", bool, optional=True, default=False, doc=doc_eig)
+        Argument("get_eigenvalues", bool, optional=True, default=False, doc=doc_eig),
+        Argument("cache_geometry", bool, optional=True, default=False, doc=doc_cache_geometry)
     ]
 
     doc_reference = "The dataset settings for reference."
@@ -622,6 +757,8 @@ def slem():
             Argument("res_update", bool, optional=True, default=True, doc="Whether to use residual update."),
             Argument("res_update_ratios", float, optional=True, default=0.5, doc="The ratios of residual update, should in (0,1)."),
             Argument("res_update_ratios_learnable", bool, optional=True, default=False, doc="Whether to make the ratios of residual update learnable."),
+            Argument("max_edge_chunk", [int, None], optional=True, default=None, doc="The maximum number of edges updated at once. The tensor products of the edges are computed chunk by chunk and their messages are accumulated on the nodes, so that the memory of the intermediate features is bounded for large structures. The result does not depend on it. Default: `None`, all the edges at once."),
+            Argument("edge_chunk_checkpoint", bool, optional=True, default=False, doc="Whether to recompute the activations of each edge chunk in the backward instead of keeping them, which bounds the memory in training as well at the cost of a second forward. Default: `False`"),
         ]
 
 
@@ -819,6 +956,7 @@ def loss_options():
     doc_train = "Loss options for training."
     doc_validation = "Loss options for validation."
     doc_reference = "Loss options for reference data in training."
+    doc_test = "Loss options for testing. Default: the loss options for training."
 
     hamil = [
         Argument("onsite_shift", bool, optional=True, default=False, doc="Whether to use onsite shift in loss function. Default: False"),
@@ -835,6 +973,9 @@ def loss_options():
         Argument("diff_weight", float, optional=True, default=0.01, doc="The weight of eigenvalue difference. Default: 0.01"),
         Argument("diff_valence", [dict,None], optional=True, default=None, doc="set the difference of the number of valence electrons in DFT and TB. eg {'A':6,'B':7}, Default: None, which means no difference"),
         Argument("spin_deg", int, optional=True, default=2, doc="The spin degeneracy of band structure. Default: 2"),
+        Argument("num_kpoints", [int, None], optional=True, default=None, doc="The number of k-points randomly drawn per structure at each step of the training loss, in addition to the k-point of the lowest reference eigenvalue. The draws are weighted by their probability, but the predicted eigenvalues are aligned by their minimum over the sampled k-points, so the loss approximates the loss over all the k-points and matches its alignment only when the k-point of the predicted minimum is drawn. All the k-points are still used for validation and test. Default: None, which means all the k-points"),
+        Argument("kpoint_importance", float, optional=True, default=0.5, doc="The fraction of the k-point sampling probability proportional to the weight of the k-point in the loss, given by its reference eigenvalues inside and outside the energy window, the rest is uniform. Default: 0.5"),
+        Argument("degeneracy_broadening", float, optional=True, default=1e-4, doc="The Lorentzian broadening (in eV) over which the gradients of nearly degenerate eigenvalues are averaged in the backward of the eigensolver, so that they do not depend on the eigenvectors chosen in a degenerate subspace. 0 gives the plain eigenvalue gradients. Default: 1e-4"),
     ]
 
     skints = [
@@ -856,6 +997,7 @@ def loss_options():
         Argument("train", dict, optional=False, sub_fields=[], sub_variants=[loss_args], doc=doc_train),
         Argument("validation", dict, optional=True, sub_fields=[], sub_variants=[loss_args], doc=doc_validation),
         Argument("reference", dict, optional=True, sub_fields=[], sub_variants=[loss_args], doc=doc_reference),
+        Argument("test", dict, optional=True, sub_fields=[], sub_variants=[loss_args], doc=doc_test),
     ]
 
     doc_loss_options = ""
@@ -940,7 +1082,7 @@ def normalize_test(data):
     da = test_data_options()
     to = test_options()
     
-    base = Argument("base", dict, [co, da, to, lo])
+    base = Argument("base", dict, [co, da, to])
     data = base.normalize_value(data)
     # data = base.normalize_value(data, trim_pattern="_*")
     base.check_value(data, strict=True)
@@ -1735,6 +1877,8 @@ def normalize_skf2nnsk(data):
         Argument('nstep', int, optional=False, doc="The number of steps for the training."),
         Argument('nsample', int, optional=True, default=256, doc="The number of steps for the training."),
         Argument('max_elmt_batch', int, optional=True, default=4, doc="The max number of elements in a batch."),
+        Argument('fixed_grid', bool, optional=True, default=False, doc="Whether to fit on a fixed uniform grid of `nsample` distances, with the dftb reference integrals computed once, instead of resampling the distances every step. Always True for the `LBFGS` optimizer, which then fits all the bond types in one batch."),
+        Argument('warm_start', bool, optional=True, default=False, doc="Whether to initialize the parameters by linear least squares on the fixed grid before the optimization. Supported for the `powerlaw` and `polyNpow` methods."),
         Argument('dis_freq', int, optional=True, default=1, doc="The frequency of the display."),
         Argument('save_freq', int, optional=True, default=1, doc="The frequency of the save."),
         Argument("optimizer", dict, sub_fields=[], optional=True, default={}, sub_variants=[optimizer()], doc = doc_optimizer),
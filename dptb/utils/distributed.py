@@ -0,0 +1,124 @@
+"""
+Helpers of the data-parallel training on CPU with the gloo backend of `torch.distributed`.
+
+The processes are either started by `torchrun`, which sets the `RANK`, `WORLD_SIZE`, `MASTER_ADDR` and
+`MASTER_PORT` environment variables, or by `launch`, which spawns `nproc` processes on the local machine.
+Every process holds a full copy of the model and a shard of each training batch order, and the gradients
+are averaged over the processes before each optimizer step.
+"""
+import os
+import socket
+import logging
+from typing import Callable, Iterable
+import torch
+import torch.distributed as dist
+
+log = logging.getLogger(__name__)
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+def init_distributed(backend: str="gloo") -> bool:
+    """
+    Join the process group described by the environment variables, if there is more than one process.
+
+    The intra-op threads of torch are divided among the processes of the node unless `OMP_NUM_THREADS` is set.
+    Returns whether the training is distributed.
+    """
+    if is_distributed():
+        return True
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size <= 1:
+        return False
+
+    dist.init_process_group(backend=backend)
+    if "OMP_NUM_THREADS" not in os.environ:
+        local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", world_size))
+        torch.set_num_threads(max(1, torch.get_num_threads() // local_world_size))
+    log.info(f"Initialized the {backend} process group: rank {get_rank()} of {get_world_size()}, {torch.get_num_threads()} threads per rank.")
+    return True
+
+
+def cleanup_distributed() -> None:
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def broadcast_parameters(module: torch.nn.Module, src: int=0) -> None:
+    """make the parameters and buffers of every process equal to the ones of the process `src`."""
+    if not is_distributed():
+        return
+    with torch.no_grad():
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            dist.broadcast(tensor.data, src=src)
+
+
+def all_reduce_gradients(parameters: Iterable[torch.nn.Parameter]) -> None:
+    """
+    Average the gradients over the processes, in one collective per dtype.
+
+    A parameter without gradient in a process contributes zeros, so that all processes take part in the same
+    collectives even if some parameters are not used by their batch.
+    """
+    if not is_distributed():
+        return
+    world_size = get_world_size()
+    groups = {}
+    for p in parameters:
+        if not p.requires_grad:
+            continue
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+        groups.setdefault(p.grad.dtype, []).append(p.grad)
+
+    for grads in groups.values():
+        flat = torch.cat([g.reshape(-1) for g in grads])
+        dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+        flat /= world_size
+        offset = 0
+        for g in grads:
+            g.copy_(flat[offset:offset + g.numel()].view_as(g))
+            offset += g.numel()
+
+
+def all_reduce_mean(tensor: torch.Tensor) -> torch.Tensor:
+    """the mean of a tensor over the processes."""
+    if not is_distributed():
+        return tensor
+    tensor = tensor.detach().clone()
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor / get_world_size()
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _run(rank: int, fn: Callable, nproc: int, port: int, kwargs: dict) -> None:
+    os.environ.update({
+        "RANK": str(rank),
+        "LOCAL_RANK": str(rank),
+        "WORLD_SIZE": str(nproc),
+        "LOCAL_WORLD_SIZE": str(nproc),
+        "MASTER_ADDR": "127.0.0.1",
+        "MASTER_PORT": str(port),
+        })
+    fn(**kwargs)
+
+
+def launch(fn: Callable, nproc: int, **kwargs) -> None:
+    """run `fn(**kwargs)` in `nproc` processes on this machine, as `torchrun --nproc_per_node nproc` would."""
+    torch.multiprocessing.spawn(_run, args=(fn, nproc, _free_port(), kwargs), nprocs=nproc, join=True)
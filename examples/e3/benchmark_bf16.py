@@ -0,0 +1,48 @@
+# Compare the accuracy and the throughput of the float32 and the bfloat16 autocast forward/backward of an e3 model.
+# Run in this folder: python benchmark_bf16.py [n_repeat]
+import sys
+import time
+import torch
+from dptb.utils.tools import j_loader
+from dptb.utils.argcheck import normalize, collect_cutoffs
+from dptb.nn.build import build_model
+from dptb.data import build_dataset, AtomicData, AtomicDataDict
+
+n_repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+jdata = normalize(j_loader("./input_short_cpu.json"))
+torch.manual_seed(0)
+model = build_model(checkpoint=None, model_options=jdata["model_options"], common_options=jdata["common_options"])
+dataset = build_dataset(**collect_cutoffs(jdata), **jdata["data_options"]["train"], **jdata["common_options"])
+dataset.E3statistics(model=model)
+data = AtomicData.to_AtomicDataDict(dataset[0].to(model.device))
+
+def run(model, data):
+    model.zero_grad()
+    out = model(data.copy())
+    loss = out[AtomicDataDict.EDGE_FEATURES_KEY].square().mean() + out[AtomicDataDict.NODE_FEATURES_KEY].square().mean()
+    loss.backward()
+    return out, [p.grad.clone() for p in model.parameters() if p.grad is not None]
+
+def timing(model, data):
+    run(model, data) # warm up
+    start = time.perf_counter()
+    for _ in range(n_repeat):
+        run(model, data)
+    return (time.perf_counter() - start) / n_repeat
+
+ref, ref_grads = run(model, data)
+t_fp32 = timing(model, data)
+
+model.enable_autocast(dtype=torch.bfloat16)
+out, grads = run(model, data)
+t_bf16 = timing(model, data)
+
+print(f"forward + backward of {data[AtomicDataDict.EDGE_INDEX_KEY].shape[1]} edges, averaged over {n_repeat} runs")
+print(f"float32:  {1000 * t_fp32:.1f} ms")
+print(f"bfloat16: {1000 * t_bf16:.1f} ms, speedup {t_fp32 / t_bf16:.2f}x")
+for key in [AtomicDataDict.NODE_FEATURES_KEY, AtomicDataDict.EDGE_FEATURES_KEY]:
+    err = (out[key] - ref[key]).abs()
+    print(f"{key}: max abs error {err.max().item():.3e}, relative mean error {(err.mean() / ref[key].abs().mean()).item():.3e}")
+grad_err = max(((g - r).norm() / r.norm().clamp(min=1e-12)).item() for g, r in zip(grads, ref_grads))
+print(f"largest relative error of the parameter gradients: {grad_err:.3e}")
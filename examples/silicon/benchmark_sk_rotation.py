@@ -0,0 +1,65 @@
+# Compare the per orbital pair type rotation of the SK blocks with the fused rotation of SKHamiltonian,
+# forward + backward on random bonds with the spd basis Si 3s/3p/d*.
+# Run in this folder: python benchmark_sk_rotation.py [n_edge] [n_repeat]
+import sys
+import time
+import torch
+from dptb.nn.hamiltonian import SKHamiltonian
+from dptb.nn.tensor_product import sk_rotation_matrices, split_rotation_matrices
+from dptb.utils.constants import anglrMId
+
+n_edge = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+n_repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+basis = {"Si": ["3s", "3p", "d*"]}
+
+def loop_rotation(hamiltonian, skparams, rotations):
+    """the rotation before the fusion: one H_z and two rotation matrices per orbital pair type."""
+    rot_mats = split_rotation_matrices(rotations, hamiltonian.lmax)
+    out = torch.zeros(skparams.shape[0], hamiltonian.idp.reduced_matrix_element, dtype=skparams.dtype)
+    for opairtype, sli in hamiltonian.idp_sk.orbpairtype_maps.items():
+        l1, l2 = anglrMId[opairtype[0]], anglrMId[opairtype[2]]
+        n_skp = min(l1, l2)+1
+        skparam = skparams[:, sli].reshape(skparams.shape[0], -1, n_skp).transpose(1, 2) # shape (N, n_skp, n_pair)
+        H_z = torch.sum(hamiltonian.skbasis[opairtype][None,:,:,:,None] * skparam[:,None, None, :, :], dim=-2)
+        HR = torch.einsum("nlm, nmoq, nko -> nqlk", rot_mats[l1], H_z, rot_mats[l2]).reshape(skparams.shape[0], -1)
+        if l1 < l2:
+            HR = HR * (-1)**(l1+l2)
+        out[:, hamiltonian.idp.orbpairtype_maps[opairtype]] = HR
+    return out
+
+def fused_rotation(hamiltonian, skparams, rotations):
+    return hamiltonian._fused_rotation(skparams, rotations) * hamiltonian.fused_sign
+
+def run(rotate, hamiltonian, skparams, vectors, cached):
+    skparams.grad = None
+    rotations = cached if cached is not None else sk_rotation_matrices(vectors, hamiltonian.lmax).type(skparams.dtype)
+    out = rotate(hamiltonian, skparams, rotations)
+    out.square().sum().backward()
+    return out
+
+def timing(rotate, hamiltonian, skparams, vectors, cached):
+    run(rotate, hamiltonian, skparams, vectors, cached) # warm up
+    start = time.perf_counter()
+    for _ in range(n_repeat):
+        run(rotate, hamiltonian, skparams, vectors, cached)
+    return (time.perf_counter() - start) / n_repeat
+
+print(f"forward + backward of {n_edge} edges with the basis {basis}, averaged over {n_repeat} runs")
+for dtype in [torch.float32, torch.float64]:
+    torch.manual_seed(0)
+    hamiltonian = SKHamiltonian(basis=basis, dtype=dtype)
+    vectors = torch.randn(n_edge, 3, dtype=dtype)
+    skparams = torch.randn(n_edge, hamiltonian.idp_sk.reduced_matrix_element, dtype=dtype, requires_grad=True)
+    rotations = sk_rotation_matrices(vectors, hamiltonian.lmax).type(dtype)
+
+    ref = run(loop_rotation, hamiltonian, skparams, vectors, rotations).detach()
+    ref_grad = skparams.grad.clone()
+    out = run(fused_rotation, hamiltonian, skparams, vectors, rotations).detach()
+    atol = 1e-4 if dtype == torch.float32 else 1e-10
+    assert torch.allclose(out, ref, atol=atol) and torch.allclose(skparams.grad, ref_grad, atol=atol)
+
+    for cached in [None, rotations]:
+        t_loop = timing(loop_rotation, hamiltonian, skparams, vectors, cached)
+        t_fused = timing(fused_rotation, hamiltonian, skparams, vectors, cached)
+        label = "rotations cached" if cached is not None else "rotations computed"
+        print(f"{str(dtype):14s} {label:19s} loop {1000 * t_loop:7.1f} ms, fused {1000 * t_fused:7.1f} ms, speedup {t_loop / t_fused:.2f}x")